@@ -0,0 +1,66 @@
+"""
+Compares two benchmark result files written by the benchmarks in this
+directory and prints the change in each numeric metric.
+
+    python benchmarks/compare.py benchmarks/results/old.json new.json
+"""
+import json
+import sys
+
+
+def load(path):
+    "Load a JSON results file"
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def numeric_metrics(results, prefix=''):
+    """
+    Flattens the numeric values of a results dict into {dotted.name: value},
+    skipping the benchmark parameters.
+    """
+    metrics = {}
+    for key, value in results.items():
+        if key == 'params':
+            continue
+        name = prefix + key
+        if isinstance(value, dict):
+            metrics.update(numeric_metrics(value, name + '.'))
+        elif isinstance(value, (int, long, float)) and \
+                not isinstance(value, bool):
+            metrics[name] = value
+    return metrics
+
+
+def compare(old, new):
+    """
+    Returns a list of (metric, old, new, percent change) for metrics present
+    in both results.
+    """
+    old_metrics = numeric_metrics(old)
+    new_metrics = numeric_metrics(new)
+    rows = []
+    for name in sorted(set(old_metrics) & set(new_metrics)):
+        before, after = old_metrics[name], new_metrics[name]
+        change = (100.0 * (after - before) / before) if before else None
+        rows.append((name, before, after, change))
+    return rows
+
+
+def main():
+    """
+    Prints a comparison table of two results files.
+    """
+    if len(sys.argv) != 3:
+        print 'usage: compare.py OLD.json NEW.json'
+        sys.exit(1)
+    old, new = load(sys.argv[1]), load(sys.argv[2])
+    if old.get('params') != new.get('params'):
+        print 'warning: benchmark parameters differ between runs'
+    for name, before, after, change in compare(old, new):
+        change_str = '%+.1f%%' % change if change is not None else 'n/a'
+        print '%-30s %14.4f %14.4f %10s' % (name, before, after, change_str)
+
+
+if __name__ == '__main__':
+    main()
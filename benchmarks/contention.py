@@ -0,0 +1,183 @@
+"""
+Lock contention benchmark for MessageBuffer vs. ShardedMessageBuffer.
+
+Runs the processor pipeline in-process (no network) for each shard count:
+a producer feeds pre-decoded records into the queue, one processor per shard
+adds them to the buffer, and a flusher flushes on an interval, holding every
+shard's lock while it renders. Reports records/sec and the time processors
+spent waiting on shard locks, written as JSON:
+
+    python benchmarks/contention.py --shards 1,2,4,8 --records 200000 \\
+        --output benchmarks/results/contention.json
+
+Under gevent only one greenlet runs at a time, so this mainly measures the
+routing overhead of sharding and lock waits caused by flushes; it is the
+baseline to compare against once shard workers run in threads or processes.
+"""
+from optparse import OptionParser
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from failnozzle import server  # noqa
+from failnozzle.buffer import MessageBuffer  # noqa
+from failnozzle.config import _validate_settings  # noqa
+from failnozzle.processing import MessageQueue, _process_one_message  # noqa
+from failnozzle.sharding import ShardedMessageBuffer  # noqa
+from failnozzle.sharding import ShardedMessageQueue, _partitions  # noqa
+import gevent
+import gevent.event
+
+from jinja2 import Environment, FileSystemLoader
+
+import loadgen
+
+
+class TimedLock(object):
+    """
+    Wraps a lock, accumulating the time spent waiting to acquire it.
+    """
+    def __init__(self, lock):
+        self.lock = lock
+        self.waited = 0.0
+        self.acquisitions = 0
+
+    def acquire(self):
+        "Acquire the wrapped lock, timing the wait"
+        started = time.time()
+        self.lock.acquire()
+        self.waited += time.time() - started
+        self.acquisitions += 1
+
+    def release(self):
+        "Release the wrapped lock"
+        self.lock.release()
+
+
+def make_records(options):
+    """
+    Builds the decoded records the producer will queue.
+    """
+    uniques = loadgen.synthesize_records(options.uniques,
+                                         options.traceback_lines,
+                                         options.kinds)
+    return [dict(uniques[i % len(uniques)],
+                 source='host%d' % (i % options.sources))
+            for i in range(options.records)]
+
+
+def run_once(shards, records, options):
+    """
+    Processes `records` with `shards` shards and returns the measurements.
+    """
+    template_dir = os.path.join(os.path.dirname(server.__file__))
+    env = Environment(loader=FileSystemLoader(template_dir))
+    subject_template = env.get_template('subject-template.txt')
+    body_template = env.get_template('body-template.txt')
+    if shards > 1:
+        message_buffer = ShardedMessageBuffer(subject_template,
+                                              body_template, shards)
+        message_queue = ShardedMessageQueue(message_buffer)
+        shard_buffers = message_buffer.shards
+    else:
+        message_buffer = MessageBuffer(subject_template, body_template)
+        message_queue = MessageQueue(message_buffer)
+        shard_buffers = [message_buffer]
+    for shard in shard_buffers:
+        shard.lock = TimedLock(shard.lock)
+
+    flushed = [0]
+    done = gevent.event.Event()
+    config = _validate_settings()  # pylint: disable=W0212
+
+    def process(queue, buf):
+        "Process records until killed"
+        while True:
+            # pylint: disable=W0212
+            _process_one_message(queue, buf, config)
+
+    def flush_loop():
+        "Flush periodically, as flush_trigger would"
+        while not done.is_set():
+            gevent.sleep(options.flush_interval)
+            total = message_buffer.total
+            message_buffer.flush()
+            flushed[0] += total
+
+    # pylint: disable=W0212
+    partitions = _partitions(message_queue, message_buffer)
+    processors = [gevent.spawn(process, queue, buf)
+                  for queue, buf in partitions]
+    flush_greenlet = gevent.spawn(flush_loop)
+
+    started = time.time()
+    for i, record in enumerate(records):
+        message_queue.put(record)
+        if i % options.batch == 0:
+            gevent.sleep(0)
+    while message_queue.qsize():
+        gevent.sleep(0.001)
+    elapsed = time.time() - started
+    done.set()
+    flush_greenlet.join()
+    gevent.killall(processors)
+    processed = flushed[0] + message_buffer.total
+
+    waited = sum(shard.lock.waited for shard in shard_buffers)
+    acquisitions = sum(shard.lock.acquisitions for shard in shard_buffers)
+    return {'shards': shards,
+            'processed': processed,
+            'seconds': elapsed,
+            'records_per_second': processed / elapsed,
+            'lock_wait_seconds': waited,
+            'lock_acquisitions': acquisitions,
+            'lock_wait_fraction': waited / elapsed}
+
+
+def main():
+    """
+    Runs the benchmark for each shard count and writes JSON results.
+    """
+    parser = OptionParser()
+    parser.add_option('--shards', default='1,2,4,8',
+                      help='comma separated shard counts')
+    parser.add_option('--records', type='int', default=100000)
+    parser.add_option('--uniques', type='int', default=500)
+    parser.add_option('--sources', type='int', default=50)
+    parser.add_option('--kinds', type='int', default=4)
+    parser.add_option('--traceback-lines', type='int', default=10)
+    parser.add_option('--batch', type='int', default=100,
+                      help='records queued between yields')
+    parser.add_option('--flush-interval', type='float', default=0.2)
+    parser.add_option('--output', help='write JSON results to this file')
+    options, _ = parser.parse_args()
+
+    records = make_records(options)
+    runs = [run_once(int(shards), records, options)
+            for shards in options.shards.split(',')]
+    results = {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': sys.version.split()[0],
+        'params': {'records': options.records,
+                   'uniques': options.uniques,
+                   'sources': options.sources,
+                   'kinds': options.kinds,
+                   'traceback_lines': options.traceback_lines,
+                   'batch': options.batch,
+                   'flush_interval': options.flush_interval},
+        'runs': dict(('shards_%d' % run['shards'], run) for run in runs),
+    }
+    encoded = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as handle:
+            handle.write(encoded + '\n')
+    print encoded
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Per-record emit cost of the logging handler, as paid inside an application.
+
+Logs records through a logger whose only handler is an AggregatorHandler
+pointed at a local UDP socket by name, once with the handler as it was
+before (the whole LogRecord dumped as JSON, and the name resolved at every
+send) and once with the lean handler. Both plain errors and errors with a
+traceback are logged. Reports microseconds per record and packet sizes,
+written as JSON:
+
+    python benchmarks/emit.py --records 50000 \\
+        --output benchmarks/results/emit.json
+"""
+from optparse import OptionParser
+import datetime
+import json
+import logging
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from failnozzle.loghandler import AggregatorHandler  # noqa
+
+
+class LegacyAggregatorHandler(logging.handlers.DatagramHandler):
+    """
+    AggregatorHandler as it was before the lean serializer.
+    """
+    def __init__(self, host, port, source, kind):
+        self.source = source
+        self.kind = kind
+        super(LegacyAggregatorHandler, self).__init__(host, port)
+
+    # pylint: disable=C0103
+    def makePickle(self, record):
+        "Dump the whole record as JSON"
+        exc_info = record.exc_info
+        if exc_info:
+            _ = self.format(record)
+            record.exc_info = None
+        str_ = json.dumps(record.__dict__)
+        if exc_info:
+            record.exc_info = exc_info
+        if sys.version_info[0] >= 3:
+            str_ = str_.encode('utf-8')
+        return str_
+
+    def emit(self, record):
+        "Add source and kind, then emit"
+        record.source = self.source
+        record.kind = self.kind
+        return super(LegacyAggregatorHandler, self).emit(record)
+
+
+class SizeRecorder(object):
+    """
+    Wraps a handler's makePickle to note the size of each packet.
+    """
+    def __init__(self, handler):
+        self.sizes = []
+        self.make_pickle = handler.makePickle
+        handler.makePickle = self
+
+    def __call__(self, record):
+        packet = self.make_pickle(record)
+        self.sizes.append(len(packet))
+        return packet
+
+
+def run_once(name, handler, records, with_traceback):
+    """
+    Logs `records` records through `handler`, returning the measurements.
+    """
+    logger = logging.getLogger('failnozzle.benchmarks.emit.%s' % name)
+    logger.propagate = False
+    logger.handlers = [handler]
+    sizes = SizeRecorder(handler)
+    started = time.time()
+    for i in range(records):
+        if with_traceback:
+            try:
+                raise ValueError('bad value %d' % (i % 100))
+            except ValueError:
+                logger.exception('Failed to handle request %d', i)
+        else:
+            logger.error('Failed to handle request %d', i)
+    elapsed = time.time() - started
+    handler.close()
+    return {'handler': name,
+            'traceback': with_traceback,
+            'records': records,
+            'seconds': elapsed,
+            'usec_per_record': elapsed * 1e6 / records,
+            'mean_packet_bytes': sum(sizes.sizes) / float(len(sizes.sizes))}
+
+
+def main():
+    """
+    Runs the benchmark with both handlers and writes JSON results.
+    """
+    parser = OptionParser()
+    parser.add_option('--records', type='int', default=50000)
+    parser.add_option('--output', help='write JSON results to this file')
+    options, _ = parser.parse_args()
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    port = receiver.getsockname()[1]
+
+    runs = []
+    for with_traceback in (False, True):
+        for name, handler_class in (('legacy', LegacyAggregatorHandler),
+                                    ('lean', AggregatorHandler)):
+            handler = handler_class('localhost', port, 'host1', 'app')
+            runs.append(run_once(name, handler, options.records,
+                                 with_traceback))
+    receiver.close()
+
+    results = {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': sys.version.split()[0],
+        'params': {'records': options.records},
+        'runs': dict(('%s%s' % (run['handler'],
+                                '_traceback' if run['traceback'] else ''),
+                      run) for run in runs),
+    }
+    encoded = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as handle:
+            handle.write(encoded + '\n')
+    print(encoded)
+
+
+if __name__ == '__main__':
+    main()
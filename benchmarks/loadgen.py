@@ -0,0 +1,146 @@
+"""
+Load generator for failnozzle.
+
+Synthesizes (or replays) JSON log records and sends them over UDP at a target
+rate, the same way AggregatorHandler would from a fleet of application hosts.
+
+    python benchmarks/loadgen.py --rate 5000 --duration 30 \\
+        --uniques 200 --sources 50 --traceback-lines 20
+"""
+from optparse import OptionParser
+import json
+import random
+import socket
+import time
+
+
+def synthesize_records(uniques, traceback_lines, kinds=1):
+    """
+    Builds `uniques` distinct log records (without a source), each with a
+    traceback of `traceback_lines` lines.
+    """
+    records = []
+    for i in range(uniques):
+        frames = ['  File "/srv/app/module%d.py", line %d, in func%d\n'
+                  '    do_something_%d()' % (line % 17, line, line, i)
+                  for line in range(traceback_lines)]
+        exc_text = '\n'.join(['Traceback (most recent call last):'] +
+                             frames +
+                             ['ValueError: synthetic error %d' % i])
+        records.append({'module': 'module%d' % i,
+                        'funcName': 'func%d' % i,
+                        'filename': 'module%d.py' % i,
+                        'pathname': '/srv/app/module%d.py' % i,
+                        'lineno': i,
+                        'message': 'Synthetic error %d' % i,
+                        'exc_text': exc_text,
+                        'kind': 'kind%d' % (i % kinds),
+                        'levelname': 'ERROR'})
+    return records
+
+
+def read_records(path):
+    """
+    Reads log records from a JSONL file (one JSON object per line) for replay.
+    """
+    records = []
+    with open(path) as handle:
+        for line in handle:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def encode_payloads(records, sources):
+    """
+    Pre-encodes every record once, returning a function that produces the
+    packet for record `i` sent from source `j`. Only the source is spliced in
+    at send time so the sender isn't limited by json.dumps.
+    """
+    bases = []
+    for record in records:
+        record = dict(record)
+        record.pop('source', None)
+        encoded = json.dumps(record)
+        bases.append(encoded[:-1])
+    source_suffixes = [', "source": %s}' % json.dumps('host%d' % j)
+                       for j in range(sources)]
+
+    def payload(i, j):
+        "Return the packet for record i from source j"
+        return bases[i] + source_suffixes[j]
+    return payload
+
+
+def send(address, payload, count_records, sources, rate, duration,
+         seed=None):
+    """
+    Sends packets to `address` at `rate` packets per second for `duration`
+    seconds (or as fast as possible if `rate` is 0).
+
+    Returns a dict describing what was sent.
+    """
+    rand = random.Random(seed)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sent = 0
+    errors = 0
+    started = time.time()
+    deadline = started + duration
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        if rate:
+            # Pace against the schedule rather than sleeping per packet, so
+            # that small sleep overshoots don't accumulate.
+            due = started + float(sent) / rate
+            if due > now:
+                time.sleep(due - now)
+                continue
+        data = payload(rand.randrange(count_records), rand.randrange(sources))
+        try:
+            sock.sendto(data, address)
+            sent += 1
+        except socket.error:
+            errors += 1
+    elapsed = time.time() - started
+    sock.close()
+    return {'sent': sent,
+            'send_errors': errors,
+            'send_seconds': elapsed,
+            'send_rate': sent / elapsed if elapsed else 0.0}
+
+
+def main():
+    """
+    Sends synthesized or replayed records to a running failnozzle.
+    """
+    parser = OptionParser()
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=1549)
+    parser.add_option('--rate', type='float', default=1000,
+                      help='packets per second, 0 for unthrottled')
+    parser.add_option('--duration', type='float', default=10)
+    parser.add_option('--uniques', type='int', default=100)
+    parser.add_option('--sources', type='int', default=10)
+    parser.add_option('--kinds', type='int', default=1)
+    parser.add_option('--traceback-lines', type='int', default=10)
+    parser.add_option('--replay', help='JSONL file of records to replay')
+    parser.add_option('--seed', type='int', default=None)
+    options, _ = parser.parse_args()
+
+    if options.replay:
+        records = read_records(options.replay)
+    else:
+        records = synthesize_records(options.uniques, options.traceback_lines,
+                                     options.kinds)
+    payload = encode_payloads(records, options.sources)
+    result = send((options.host, options.port), payload, len(records),
+                  options.sources, options.rate, options.duration,
+                  options.seed)
+    print json.dumps(result, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Memory footprint of one flush window in the MessageBuffer, with and without
+string interning (INTERN_STRINGS).
+
+Each mode runs in a fresh subprocess, decodes packets with json.loads the way
+the listener does (so every packet's strings are fresh objects), adds them to
+a MessageBuffer, and reports the RSS growth plus the deep size of the buffer
+(counting each shared object once). By default the window holds 10,000
+unique messages, each seen from 10 of 1,000 hosts, drawn from 100 distinct
+tracebacks:
+
+    python benchmarks/memory.py --output benchmarks/results/memory.json
+"""
+from optparse import OptionParser
+import datetime
+import gc
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+
+def rss_kb():
+    "Return this process's resident set size in kB (Linux only)"
+    with open('/proc/self/status') as handle:
+        for line in handle:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+def deep_size(obj, seen=None):
+    """
+    Returns the size in bytes of `obj` and everything reachable from it
+    through containers, counting each object once.
+    """
+    seen = set() if seen is None else seen
+    size = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+        elif hasattr(current, '__dict__'):
+            stack.append(current.__dict__)
+    return size
+
+
+def packets(options):
+    """
+    Yields the encoded packets for one flush window.
+    """
+    tracebacks = ['\n'.join(['Traceback (most recent call last):'] +
+                            ['  File "/srv/app/module%d.py", line %d, in f\n'
+                             '    call_%d()' % (t, line, line)
+                             for line in range(options.traceback_lines)] +
+                            ['ValueError: %d' % t])
+                  for t in range(options.tracebacks)]
+    for i in range(options.uniques):
+        record = {'module': 'module%d' % (i % 50),
+                  'funcName': 'func',
+                  'filename': 'module%d.py' % (i % 50),
+                  'pathname': '/srv/app/module%d.py' % (i % 50),
+                  'lineno': i,
+                  'message': 'Error %d' % i,
+                  'exc_text': tracebacks[i % len(tracebacks)],
+                  'kind': 'kind%d' % (i % options.kinds)}
+        for j in range(options.sources_per_unique):
+            record['source'] = 'host%04d.example.com' % (
+                (i * options.sources_per_unique + j) % options.hosts)
+            yield json.dumps(record)
+
+
+def measure(options):
+    """
+    Fills one MessageBuffer and returns its footprint. Runs in the child.
+    """
+    from failnozzle import settings
+    from failnozzle.buffer import MessageBuffer
+    from failnozzle.config import _validate_settings
+    from failnozzle.processing import _record_to_unique
+    settings.INTERN_STRINGS = options.mode == 'interned'
+
+    config = _validate_settings()  # pylint: disable=W0212
+
+    encoded = list(packets(options))
+    gc.collect()
+    before = rss_kb()
+    message_buffer = MessageBuffer(None, None)
+    for data in encoded:
+        record = json.loads(data)
+        unique, source = _record_to_unique(  # pylint: disable=W0212
+            record, config)
+        message_buffer.add(unique, source)
+    del record, unique, source
+    gc.collect()
+    after = rss_kb()
+    return {'mode': options.mode,
+            'packets': len(encoded),
+            'total_unique': message_buffer.total_unique,
+            'rss_growth_kb': after - before,
+            'deep_size_bytes': deep_size(message_buffer.counts_by_unique)}
+
+
+def main():
+    """
+    Measures each mode in a subprocess and writes JSON results.
+    """
+    parser = OptionParser()
+    parser.add_option('--uniques', type='int', default=10000)
+    parser.add_option('--hosts', type='int', default=1000)
+    parser.add_option('--sources-per-unique', type='int', default=10)
+    parser.add_option('--tracebacks', type='int', default=100)
+    parser.add_option('--traceback-lines', type='int', default=20)
+    parser.add_option('--kinds', type='int', default=5)
+    parser.add_option('--mode', help='measure a single mode (internal)')
+    parser.add_option('--output', help='write JSON results to this file')
+    options, _ = parser.parse_args()
+
+    if options.mode:
+        print json.dumps(measure(options))
+        return
+
+    runs = {}
+    for mode in ('plain', 'interned'):
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--mode', mode] + sys.argv[1:])
+        runs[mode] = json.loads(output.strip().splitlines()[-1])
+    results = {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': sys.version.split()[0],
+        'params': {'uniques': options.uniques,
+                   'hosts': options.hosts,
+                   'sources_per_unique': options.sources_per_unique,
+                   'tracebacks': options.tracebacks,
+                   'traceback_lines': options.traceback_lines,
+                   'kinds': options.kinds},
+        'runs': runs,
+        'deep_size_saved_fraction': (
+            1.0 - float(runs['interned']['deep_size_bytes']) /
+            runs['plain']['deep_size_bytes']),
+    }
+    encoded = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as handle:
+            handle.write(encoded + '\n')
+    print encoded
+
+
+if __name__ == '__main__':
+    main()
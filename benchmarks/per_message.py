@@ -0,0 +1,117 @@
+"""
+Per-message overhead benchmark for settings lookups.
+
+Turns pre-decoded records into unique messages and adds them to a
+MessageBuffer, once reading settings through context.setting for every
+message (as the pipeline did before settings were snapshotted) and once
+reading them from the snapshot installed by _validate_settings. Reports
+microseconds per message for each, written as JSON:
+
+    python benchmarks/per_message.py --records 200000 \\
+        --output benchmarks/results/per_message.json
+"""
+from optparse import OptionParser
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from failnozzle.buffer import MessageBuffer  # noqa
+from failnozzle.config import UniqueMessage, _validate_settings  # noqa
+from failnozzle.context import setting  # noqa
+from failnozzle.processing import _record_to_unique  # noqa
+
+import loadgen
+
+
+def lookup_record_to_unique(record):
+    """
+    Converts a record the way the pipeline did before the settings snapshot,
+    looking settings up on every call.
+    """
+    # pylint: disable=W0212
+    source = record.get(setting('SOURCE_FIELD_NAME'), None)
+    message_params = {k: v for k, v in record.items()
+                      if k in setting('UNIQUE_MSG_TUPLE',
+                                      UniqueMessage)._fields}
+    msg_str = message_params.get('message')
+    if msg_str and '\n' in msg_str:
+        if not message_params.get('exc_text'):
+            message_params['exc_text'] = msg_str
+        msg_str = msg_str[:msg_str.index('\n')]
+        message_params['message'] = msg_str
+    unique_message_impl = setting('UNIQUE_MSG_TUPLE', UniqueMessage)
+    all_params = dict(message_params)
+    for field in setting('UNIQUE_MSG_TUPLE', UniqueMessage)._fields:
+        if field not in all_params:
+            all_params[field] = None
+    return unique_message_impl(**all_params), source
+
+
+def run_once(name, convert, records):
+    """
+    Converts and buffers `records`, returning the measurements.
+    """
+    message_buffer = MessageBuffer(None, None)
+    started = time.time()
+    for record in records:
+        unique, source = convert(record)
+        message_buffer.add(unique, source)
+    elapsed = time.time() - started
+    return {'mode': name,
+            'records': len(records),
+            'seconds': elapsed,
+            'usec_per_message': elapsed * 1e6 / len(records)}
+
+
+def main():
+    """
+    Runs the benchmark both ways and writes JSON results.
+    """
+    parser = OptionParser()
+    parser.add_option('--records', type='int', default=200000)
+    parser.add_option('--uniques', type='int', default=500)
+    parser.add_option('--sources', type='int', default=50)
+    parser.add_option('--kinds', type='int', default=4)
+    parser.add_option('--traceback-lines', type='int', default=10)
+    parser.add_option('--output', help='write JSON results to this file')
+    options, _ = parser.parse_args()
+
+    uniques = loadgen.synthesize_records(options.uniques,
+                                         options.traceback_lines,
+                                         options.kinds)
+    records = [dict(uniques[i % len(uniques)],
+                    source='host%d' % (i % options.sources))
+               for i in range(options.records)]
+
+    config = _validate_settings()  # pylint: disable=W0212
+    runs = [
+        run_once('setting_lookups', lookup_record_to_unique, records),
+        run_once('snapshot',
+                 # pylint: disable=W0212
+                 lambda record: _record_to_unique(record, config),
+                 records),
+    ]
+    results = {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': sys.version.split()[0],
+        'params': {'records': options.records,
+                   'uniques': options.uniques,
+                   'sources': options.sources,
+                   'kinds': options.kinds,
+                   'traceback_lines': options.traceback_lines},
+        'runs': dict((run['mode'], run) for run in runs),
+    }
+    encoded = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as handle:
+            handle.write(encoded + '\n')
+    print encoded
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+A local SMTP sink that records the messages failnozzle sends, so benchmarks
+can count what made it into digests without a real mail server.
+"""
+from email import message_from_string
+import asyncore
+import re
+import smtpd
+import threading
+import time
+
+
+# Matches the default subject template, e.g.
+# "myhost errors: 5 total, 2 unique (app)"
+SUBJECT_TOTAL_RE = re.compile(r'errors: (\d+) total')
+
+
+class SinkServer(smtpd.SMTPServer):
+    """
+    Accepts every message and keeps (received time, subject, body) for each.
+    """
+    def __init__(self, address):
+        smtpd.SMTPServer.__init__(self, address, None)
+        self.messages = []
+        self.messages_lock = threading.Lock()
+
+    # Signature is fixed by smtpd.
+    # pylint: disable=W0613
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        """
+        Records an incoming message.
+        """
+        parsed = message_from_string(data)
+        with self.messages_lock:
+            self.messages.append((time.time(), parsed['Subject'],
+                                  parsed.get_payload()))
+
+    @property
+    def port(self):
+        """
+        The port the sink is bound to (useful when binding to port 0).
+        """
+        return self.socket.getsockname()[1]
+
+    def digests(self):
+        """
+        Returns a list of (received time, total) for each digest email.
+        Pages and other non-digest mail are skipped.
+        """
+        with self.messages_lock:
+            messages = list(self.messages)
+        digests = []
+        for received, subject, _ in messages:
+            match = SUBJECT_TOTAL_RE.search(subject or '')
+            if match:
+                digests.append((received, int(match.group(1))))
+        return digests
+
+    def counted(self):
+        """
+        Returns the total number of messages counted across all digests.
+        """
+        return sum(total for _, total in self.digests())
+
+
+def start_sink(host='127.0.0.1', port=0):
+    """
+    Starts a SinkServer in a background thread and returns it.
+    """
+    server = SinkServer((host, port))
+    thread = threading.Thread(target=asyncore.loop,
+                              kwargs=dict(timeout=0.1))
+    thread.daemon = True
+    thread.start()
+    return server
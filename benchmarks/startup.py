@@ -0,0 +1,148 @@
+"""
+Startup benchmark for failnozzle.
+
+Measures, each in a fresh interpreter:
+
+* how long `import failnozzle.server` takes, and whether it monkey patched
+  the process (it shouldn't)
+* the time from exec'ing the daemon to its UDP socket being bound (its
+  "Listening on" log line), first with an empty template cache and then
+  with a warm one
+
+Results are written as JSON:
+
+    python benchmarks/startup.py --runs 10 \\
+        --output benchmarks/results/startup.json
+
+As with throughput.py, --engine asyncio --python python3 measures the
+asyncio engine.
+"""
+from optparse import OptionParser
+import datetime
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from throughput import REPO_DIR, free_udp_port, git_revision, percentile, \
+    read_log, wait_for
+
+
+CONFIG_TEMPLATE = """
+import logging
+UDP_BIND = ('127.0.0.1', %(udp_port)d)
+REPORT_TO = 'report@example.com'
+REPORT_FROM = 'failnozzle@example.com'
+TEMPLATE_CACHE_DIR = %(cache_dir)r
+ENGINE = %(engine)r
+LOG_LEVEL = logging.INFO
+"""
+
+IMPORT_SCRIPT = """
+import json, time
+started = time.time()
+import failnozzle.server
+took = time.time() - started
+import gevent.monkey
+print(json.dumps({'seconds': took,
+                  'patched': gevent.monkey.is_module_patched('socket')}))
+"""
+
+
+def time_import(python):
+    """
+    Imports failnozzle.server in a fresh `python`, returning the seconds it
+    took and whether the socket module ended up patched.
+    """
+    output = subprocess.check_output([python, '-c', IMPORT_SCRIPT],
+                                     cwd=REPO_DIR)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def time_startup(options, workdir, cache_dir):
+    """
+    Starts the daemon and returns the seconds from exec to its socket being
+    bound, then stops it.
+    """
+    config_path = os.path.join(workdir, 'startup_config.py')
+    log_path = os.path.join(workdir, 'failnozzle.log')
+    with open(config_path, 'w') as handle:
+        handle.write(CONFIG_TEMPLATE % dict(udp_port=free_udp_port(),
+                                            cache_dir=cache_dir,
+                                            engine=options.engine))
+    log_handle = open(log_path, 'w')
+    started = time.time()
+    daemon = subprocess.Popen([options.python, '-m', 'failnozzle.server',
+                               config_path],
+                              cwd=REPO_DIR, stdout=log_handle,
+                              stderr=subprocess.STDOUT)
+    try:
+        if not wait_for(lambda: 'Listening on' in read_log(log_path), 30,
+                        interval=0.001):
+            raise Exception('failnozzle did not start, see %s' % log_path)
+        took = time.time() - started
+        daemon.send_signal(signal.SIGTERM)
+        wait_for(lambda: daemon.poll() is not None, 10)
+    finally:
+        if daemon.poll() is None:
+            daemon.kill()
+        log_handle.close()
+    return took
+
+
+def summarize(values):
+    "Return the min, median and max of `values`"
+    return {'min': min(values), 'median': percentile(values, 0.5),
+            'max': max(values)}
+
+
+def main():
+    """
+    Runs the benchmark and writes JSON results.
+    """
+    parser = OptionParser()
+    parser.add_option('--runs', type='int', default=10)
+    parser.add_option('--engine', default='gevent',
+                      help="the daemon's ENGINE (gevent or asyncio)")
+    parser.add_option('--python', default=sys.executable,
+                      help='the Python to run the daemon with')
+    parser.add_option('--output', help='write JSON results to this file')
+    options, _ = parser.parse_args()
+
+    imports = [time_import(options.python) for _run in range(options.runs)]
+
+    workdir = tempfile.mkdtemp(prefix='failnozzle-startup-')
+    try:
+        cache_dir = os.path.join(workdir, 'template-cache')
+        os.mkdir(cache_dir)
+        cold = time_startup(options, workdir, cache_dir)
+        warm = [time_startup(options, workdir, cache_dir)
+                for _run in range(options.runs)]
+    finally:
+        shutil.rmtree(workdir)
+
+    results = {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'git_revision': git_revision(),
+        'python': sys.version.split()[0],
+        'params': {'runs': options.runs,
+                   'engine': options.engine,
+                   'daemon_python': options.python},
+        'import_seconds': summarize([run['seconds'] for run in imports]),
+        'import_patched': any(run['patched'] for run in imports),
+        'startup_cold_seconds': cold,
+        'startup_warm_seconds': summarize(warm),
+    }
+    encoded = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as handle:
+            handle.write(encoded + '\n')
+    print(encoded)
+
+
+if __name__ == '__main__':
+    main()
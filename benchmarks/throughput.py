@@ -0,0 +1,254 @@
+"""
+End-to-end throughput benchmark for failnozzle.
+
+Starts a failnozzle daemon on a free local port with a local SMTP sink, drives
+it with the load generator, and reports:
+
+* sustained packets/sec counted in digests
+* drop rate (packets sent vs. instances counted in digests)
+* flush latency (from the daemon's "Flush took" log lines)
+* peak RSS of the daemon
+
+Results are written as JSON so runs can be compared with compare.py:
+
+    python benchmarks/throughput.py --rate 5000 --duration 30 \\
+        --output benchmarks/results/baseline.json
+
+To compare engines, run it once as it is and once with the asyncio engine
+under a Python 3 that has failnozzle's dependencies:
+
+    python benchmarks/throughput.py --engine asyncio --python python3 ...
+"""
+from optparse import OptionParser
+import datetime
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import loadgen
+import smtpsink
+
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FLUSH_TOOK_RE = re.compile(r'Flush took ([0-9.]+) seconds')
+
+CONFIG_TEMPLATE = """
+import logging
+UDP_BIND = ('127.0.0.1', %(udp_port)d)
+SMTP_HOST = '127.0.0.1'
+SMTP_PORT = %(smtp_port)d
+SMTP_USE_SSL = False
+SMTP_USER = ''
+SMTP_PASSWORD = ''
+REPORT_TO = 'report@example.com'
+REPORT_FROM = 'failnozzle@example.com'
+PAGER_TO = 'pager@example.com'
+PAGER_FROM = 'failnozzle@example.com'
+PAGER_LIMIT = 1 << 62
+FLUSH_SECONDS = %(flush_seconds)r
+FLUSH_MAX_SECONDS = %(flush_seconds)r
+MESSAGE_BUFFER_SHARDS = %(shards)d
+ENGINE = %(engine)r
+LOG_LEVEL = logging.INFO
+"""
+
+
+def free_udp_port():
+    """
+    Returns a UDP port on localhost that is free right now.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def proc_status_kb(pid, field):
+    """
+    Reads a kB field (e.g. VmHWM) from /proc/<pid>/status, or None if it
+    isn't available on this platform.
+    """
+    try:
+        with open('/proc/%d/status' % pid) as handle:
+            for line in handle:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def wait_for(predicate, timeout, interval=0.1):
+    """
+    Polls `predicate` until it returns True or `timeout` seconds pass.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return predicate()
+
+
+def read_log(path):
+    "Return the contents of the daemon's log"
+    with open(path) as handle:
+        return handle.read()
+
+
+def percentile(values, fraction):
+    """
+    Returns the value at `fraction` (0..1) of the sorted values, or None.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def git_revision():
+    "Return the current git revision of the repo, if available"
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=REPO_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    """
+    Runs one benchmark and returns the results as a dict.
+    """
+    sink = smtpsink.start_sink()
+    udp_port = free_udp_port()
+    workdir = tempfile.mkdtemp(prefix='failnozzle-bench-')
+    config_path = os.path.join(workdir, 'bench_config.py')
+    log_path = os.path.join(workdir, 'failnozzle.log')
+    config = CONFIG_TEMPLATE % dict(udp_port=udp_port,
+                                    smtp_port=sink.port,
+                                    flush_seconds=options.flush_seconds,
+                                    shards=options.shards,
+                                    engine=options.engine)
+    with open(config_path, 'w') as handle:
+        handle.write(config)
+
+    log_handle = open(log_path, 'w')
+    daemon = subprocess.Popen([options.python, '-m', 'failnozzle.server',
+                               config_path],
+                              cwd=REPO_DIR, stdout=log_handle,
+                              stderr=subprocess.STDOUT)
+    try:
+        if not wait_for(lambda: 'Listening on' in read_log(log_path), 30):
+            raise Exception('failnozzle did not start, see %s' % log_path)
+
+        if options.replay:
+            records = loadgen.read_records(options.replay)
+        else:
+            records = loadgen.synthesize_records(options.uniques,
+                                                 options.traceback_lines,
+                                                 options.kinds)
+        payload = loadgen.encode_payloads(records, options.sources)
+        sent = loadgen.send(('127.0.0.1', udp_port), payload, len(records),
+                            options.sources, options.rate, options.duration,
+                            options.seed)
+        sent_at = time.time()
+
+        # Give the daemon a couple of flushes to report everything it took
+        # in, then stop it cleanly so the final flush runs.
+        wait_for(lambda: sink.counted() >= sent['sent'],
+                 2 * options.flush_seconds + options.grace_seconds)
+        peak_rss_kb = proc_status_kb(daemon.pid, 'VmHWM')
+        daemon.send_signal(signal.SIGTERM)
+        wait_for(lambda: daemon.poll() is not None, options.grace_seconds)
+        wait_for(lambda: sink.counted() >= sent['sent'], 1)
+    finally:
+        if daemon.poll() is None:
+            daemon.kill()
+        log_handle.close()
+
+    counted = sink.counted()
+    digests = sink.digests()
+    flush_times = [float(took)
+                   for took in FLUSH_TOOK_RE.findall(read_log(log_path))]
+    last_digest_at = max([received for received, _ in digests] or [None])
+
+    return {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'git_revision': git_revision(),
+        'python': sys.version.split()[0],
+        'params': {'rate': options.rate,
+                   'duration': options.duration,
+                   'uniques': len(records),
+                   'sources': options.sources,
+                   'kinds': options.kinds,
+                   'traceback_lines': options.traceback_lines,
+                   'replay': options.replay,
+                   'flush_seconds': options.flush_seconds,
+                   'shards': options.shards,
+                   'engine': options.engine,
+                   'daemon_python': options.python},
+        'sent': sent['sent'],
+        'send_errors': sent['send_errors'],
+        'send_rate': sent['send_rate'],
+        'counted': counted,
+        'digests': len(digests),
+        'sustained_pps': counted / sent['send_seconds'],
+        'drop_rate': (1.0 - float(counted) / sent['sent']
+                      if sent['sent'] else 0.0),
+        'flush_seconds_mean': (sum(flush_times) / len(flush_times)
+                               if flush_times else None),
+        'flush_seconds_p50': percentile(flush_times, 0.5),
+        'flush_seconds_max': max(flush_times or [None]),
+        'drain_seconds': (last_digest_at - sent_at
+                          if last_digest_at else None),
+        'peak_rss_kb': peak_rss_kb,
+        'log': log_path,
+    }
+
+
+def main():
+    """
+    Parses options, runs the benchmark, and writes the JSON results.
+    """
+    parser = OptionParser()
+    parser.add_option('--rate', type='float', default=2000,
+                      help='packets per second, 0 for unthrottled')
+    parser.add_option('--duration', type='float', default=10)
+    parser.add_option('--uniques', type='int', default=100)
+    parser.add_option('--sources', type='int', default=10)
+    parser.add_option('--kinds', type='int', default=1)
+    parser.add_option('--traceback-lines', type='int', default=10)
+    parser.add_option('--replay', help='JSONL file of records to replay')
+    parser.add_option('--flush-seconds', type='float', default=2)
+    parser.add_option('--shards', type='int', default=1,
+                      help='MESSAGE_BUFFER_SHARDS for the daemon')
+    parser.add_option('--engine', default='gevent',
+                      help="ENGINE for the daemon: 'gevent' or 'asyncio'")
+    parser.add_option('--python', default=sys.executable,
+                      help='Python to run the daemon with (asyncio needs '
+                           'Python 3)')
+    parser.add_option('--grace-seconds', type='float', default=10)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--output', help='write JSON results to this file')
+    options, _ = parser.parse_args()
+
+    results = run(options)
+    encoded = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        output_dir = os.path.dirname(options.output)
+        if output_dir and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        with open(options.output, 'w') as handle:
+            handle.write(encoded + '\n')
+    print encoded
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""
+An asyncio engine for failnozzle, as an alternative to gevent: selected with
+ENGINE = 'asyncio', or run directly with
+
+    python -m failnozzle.aio [config file]
+
+It needs Python 3, and gevent installed, since the queue, buffer and
+settings code it shares with the gevent engine imports it (though nothing
+runs on gevent's hub). Nothing is monkey patched: the UDP socket is read by a
+DatagramProtocol, records are processed by callbacks on the event loop, a
+batch at a time, and flushes are scheduled with call_later. Emails, pages,
+and digests for the sinks are sent from a thread pool, so blocking smtplib
+calls don't hold up the loop.
+
+The messages go through the same MessageQueue (and overflow policy),
+MessageBuffer, MessageRate, templates and settings as with gevent. What
+relies on greenlets isn't available (see _GEVENT_ONLY), and flushes happen
+every FLUSH_SECONDS, without the early flushes and flood backoff of the
+gevent FlushScheduler.
+
+The module is written without async/await so that it still compiles on
+Python 2, where the gevent engine runs.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import json
+import logging
+import signal
+import socket
+import sys
+import time
+
+from failnozzle import relay, settings, udpstats
+from failnozzle.clock import monotonic
+from failnozzle.config import _validate_settings, current_config
+from failnozzle.context import setting
+from failnozzle.flushing import _flush_sends, _merge_relay_batch, check_rates
+from failnozzle.mail import pager
+from failnozzle.pipeline import _create_queue_rate_buffer
+from failnozzle.processing import _make_fake_record, _record_to_unique
+from failnozzle.sharding import _partitions
+
+
+# Settings for features built on greenlets, which the asyncio engine can't
+# run.
+_GEVENT_ONLY = ('PIPELINES', 'RELAY_TO', 'RENDER_POOL_SIZE', 'SPOOL_FILE',
+                'WEBHOOK_URL', 'NOTIFY_NEW_ERRORS')
+
+# How many queued records to process per shard before letting the loop read
+# the socket again.
+_BATCH = 500
+
+
+class DatagramListener(asyncio.DatagramProtocol):
+    """
+    Hands each datagram to `engine`, along with up to _BATCH more already
+    waiting in `sock`: reading them here costs far less than a trip around
+    the loop for each.
+    """
+    def __init__(self, engine, sock):
+        self.engine = engine
+        self.sock = sock
+
+    def datagram_received(self, data, _addr):
+        """
+        Hands `data`, and whatever else is waiting, to the engine.
+        """
+        self.engine.receive(data)
+        self.engine.read_waiting(self.sock, _BATCH)
+
+    def error_received(self, exc):
+        """
+        Logs an error on the socket; the loop keeps reading.
+        """
+        logging.warning('Error on the UDP socket: %s', exc)
+
+
+class Engine(object):
+    """
+    Receives, processes and flushes messages on `loop`, for the queue, rate
+    and buffer from _create_queue_rate_buffer.
+    """
+    def __init__(self, loop, message_queue, message_rate, message_buffer):
+        self.loop = loop
+        self.message_queue = message_queue
+        self.message_rate = message_rate
+        self.message_buffer = message_buffer
+        self.partitions = _partitions(message_queue, message_buffer)
+        self.config = current_config()
+        self.executor = ThreadPoolExecutor(setting('ASYNCIO_SEND_THREADS'))
+        self.errors = 0
+        self.processing = None
+        self.flush_timer = None
+        self.sending = None
+
+    def receive(self, data):
+        """
+        Decodes a packet and queues the record it holds, or merges a relayed
+        batch into the buffer.
+        """
+        try:
+            data = data[:self.config.incoming_message_max_size]
+            if relay.is_batch(data):
+                _merge_relay_batch(self.message_buffer, data)
+                return
+            record = vars(logging.makeLogRecord(json.loads(data)))
+        # Too general an exception but we want to make sure we recover
+        # cleanly.
+        # pylint: disable=W0703
+        except Exception as exc:
+            self.errors += 1
+            logging.exception('Error on incoming packet: %s', exc)
+            record = _make_fake_record(self.errors, exc)
+        self.message_queue.put(record)
+        if self.processing is None:
+            self.processing = self.loop.call_soon(self.process)
+
+    def process(self):
+        """
+        Processes up to _BATCH queued records per shard, then, if any are
+        left, schedules itself to carry on after the loop's other callbacks.
+        """
+        self.processing = None
+        left = 0
+        for shard_queue, shard_buffer in self.partitions:
+            for _ in range(min(shard_queue.qsize(), _BATCH)):
+                try:
+                    unique, source = _record_to_unique(shard_queue.get(),
+                                                       self.config)
+                    shard_buffer.add(unique, source)
+                # We want to catch everything.
+                # pylint: disable=W0703
+                except Exception:
+                    logging.exception('Unhandled exception while processing '
+                                      'message')
+            left += shard_queue.qsize()
+        if left:
+            self.processing = self.loop.call_soon(self.process)
+
+    def start(self):
+        """
+        Starts the flush schedule.
+        """
+        self.flush_timer = self.loop.call_later(setting('FLUSH_SECONDS'),
+                                                self.tick)
+
+    def tick(self):
+        """
+        Flushes (unless there's nothing to report, or the last flush is still
+        sending), and schedules the next tick FLUSH_SECONDS after this one.
+        """
+        self.flush_timer = self.loop.call_later(setting('FLUSH_SECONDS'),
+                                                self.tick)
+        if self.sending is not None and not self.sending.done():
+            logging.warning('Previous flush is still sending, waiting for '
+                            'the next one')
+            return
+        buf = self.message_buffer
+        accounting = buf.accounting
+        if accounting.added == 0 and not accounting.total_shed and \
+                not accounting.dropped:
+            logging.debug('Nothing to flush, skipping')
+            # The rates still need to know, so incidents can recover.
+            notices = check_rates(buf, self.message_rate)
+            if notices:
+                self.loop.run_in_executor(self.executor, pager, notices)
+            return
+        self.sending = self.flush()
+
+    def flush(self):
+        """
+        Flushes the buffer, sending the results from the thread pool.
+        Returns a future that's done once they're sent.
+        """
+        started = time.time()
+        sending = asyncio.gather(*[
+            self.loop.run_in_executor(self.executor, func, *args)
+            for func, args in _flush_sends(self.message_buffer,
+                                           self.message_rate)])
+        sending.add_done_callback(lambda _: logging.info(
+            'Flush took %.3f seconds', time.time() - started))
+        return sending
+
+    def sample_drops(self, drop_counter):
+        """
+        Notes datagrams the kernel dropped, every UDP_DROP_SAMPLE_SECONDS.
+        """
+        dropped = drop_counter.sample()
+        if dropped:
+            logging.warning('Kernel dropped %d incoming datagrams', dropped)
+            self.message_buffer.add_dropped(dropped)
+        self.loop.call_later(setting('UDP_DROP_SAMPLE_SECONDS'),
+                             self.sample_drops, drop_counter)
+
+    def read_waiting(self, sock, limit, deadline=None):
+        """
+        Handles up to `limit` packets already waiting in the non-blocking
+        `sock`, stopping early if the monotonic clock reaches `deadline`.
+        Returns the number of packets read.
+        """
+        read = 0
+        max_size = self.config.incoming_message_max_size
+        while read < limit and (deadline is None or monotonic() < deadline):
+            try:
+                data = sock.recv(max_size)
+            except socket.error as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            self.receive(data)
+            read += 1
+        return read
+
+    def drain(self, sock, deadline):
+        """
+        Handles the packets already waiting in `sock`, until there are none
+        left or the monotonic clock reaches `deadline`, then processes
+        everything queued. Returns the number of packets read.
+        """
+        drained = self.read_waiting(sock, sys.maxsize, deadline)
+        if self.processing is not None:
+            self.processing.cancel()
+        while self.message_queue.qsize() and monotonic() < deadline:
+            self.process()
+        if self.processing is not None:
+            self.processing.cancel()
+        return drained
+
+    def stop(self, sock, transport):
+        """
+        Stops without losing messages that were accepted, like
+        shutdown_pipelines: reads what's waiting in the socket, processes the
+        queue, then flushes one last time, waiting for the previous flush to
+        send first.
+        """
+        logging.info('Shutting down')
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+        drained = self.drain(sock, monotonic() +
+                             setting('SHUTDOWN_DRAIN_SECONDS'))
+        logging.info('Read %d waiting packets', drained)
+        transport.close()
+        unprocessed = self.message_queue.qsize()
+        if unprocessed:
+            logging.warning('Gave up on %d unprocessed messages',
+                            unprocessed)
+
+        timeout = setting('SHUTDOWN_FLUSH_SECONDS')
+        if self.sending is not None:
+            self.loop.run_until_complete(asyncio.wait([self.sending],
+                                                      timeout=timeout))
+        final = self.flush()
+        done, _ = self.loop.run_until_complete(asyncio.wait([final],
+                                                            timeout=timeout))
+        if not done:
+            logging.warning('Gave up waiting for the final flush after %d '
+                            'seconds', timeout)
+        for sink in self.message_buffer.sinks:
+            if not sink.close(timeout):
+                logging.warning('Gave up on undelivered digests for %r', sink)
+        self.executor.shutdown(wait=False)
+        logging.info('Shut down')
+        return bool(done) and not unprocessed
+
+
+def _bind():
+    """
+    Creates the non-blocking UDP socket to listen on, bound to UDP_BIND.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if setting('UDP_RECEIVE_BUFFER_BYTES', None):
+        granted = udpstats.set_receive_buffer(
+            sock, setting('UDP_RECEIVE_BUFFER_BYTES'))
+        if granted < setting('UDP_RECEIVE_BUFFER_BYTES'):
+            logging.warning('Asked for a %d byte receive buffer but got %d; '
+                            'raise net.core.rmem_max',
+                            setting('UDP_RECEIVE_BUFFER_BYTES'), granted)
+    sock.bind(setting('UDP_BIND'))
+    sock.setblocking(False)
+    return sock
+
+
+def check_settings():
+    """
+    Raises AssertionError if any features that need gevent are configured.
+    """
+    for name in _GEVENT_ONLY:
+        assert not setting(name, None), \
+            "%s isn't supported by the asyncio engine" % name
+
+
+def main(config_file=None):
+    """
+    Loads the settings, with `config_file` if given, then runs failnozzle.
+    """
+    settings.load(config_file)
+    run()
+
+
+def run():
+    """
+    Runs failnozzle on an asyncio event loop until SIGTERM (or Ctrl-C).
+    """
+    logging.basicConfig(level=setting('LOG_LEVEL'),
+                        format=setting('LOG_FORMAT'))
+    logging.info('Starting up with the asyncio engine')
+    _validate_settings()
+    check_settings()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    engine = Engine(loop, *_create_queue_rate_buffer())
+    sock = _bind()
+    transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: DatagramListener(engine, sock), sock=sock))
+    logging.info('Listening on %r', setting('UDP_BIND'))
+    loop.call_later(setting('UDP_DROP_SAMPLE_SECONDS'), engine.sample_drops,
+                    udpstats.DropCounter(sock))
+    engine.start()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        engine.stop(sock, transport)
+        loop.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,465 @@
+"""
+The buffer that counts incoming messages between flushes, and reports on
+them when flushed.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import logging
+import time
+
+import gevent.lock
+
+from failnozzle.compat import iteritems, itervalues, text_type
+from failnozzle.context import _offload, setting
+from failnozzle.counts import _counts_factory
+from failnozzle.fingerprint import fingerprint
+from failnozzle.interning import StringInterner
+
+
+class BufferAccounting(object):
+    """
+    What a MessageBuffer counts besides its messages since the last flush:
+    the messages added, those shed before they could be added and those only
+    counted as overflow (both by kind), the datagrams the kernel dropped, and
+    the approximate bytes held by kind. `quota_shards` is how many buffers
+    share the kind quotas (see ShardedMessageBuffer).
+    """
+    def __init__(self, quota_shards=1):
+        self.added = 0
+        self.shed_by_kind = defaultdict(int)
+        self.overflow_by_kind = defaultdict(int)
+        self.bytes_by_kind = defaultdict(int)
+        self.dropped = 0
+        self.quota_shards = quota_shards
+
+    @property
+    def total_shed(self):
+        """
+        Computes the total number of messages shed.
+        """
+        return sum(self.shed_by_kind.values())
+
+    @property
+    def total_overflow(self):
+        """
+        Computes the total number of messages only counted as overflow.
+        """
+        return sum(self.overflow_by_kind.values())
+
+    def merge(self, other):
+        """
+        Adds the counts of another BufferAccounting to this one.
+        """
+        self.added += other.added
+        self.dropped += other.dropped
+        for mine, theirs in ((self.shed_by_kind, other.shed_by_kind),
+                             (self.overflow_by_kind, other.overflow_by_kind),
+                             (self.bytes_by_kind, other.bytes_by_kind)):
+            for kind, count in iteritems(theirs):
+                mine[kind] += count
+
+    def clear(self):
+        """
+        Resets the counts for the next flush.
+        """
+        self.added = 0
+        self.shed_by_kind.clear()
+        self.overflow_by_kind.clear()
+        self.bytes_by_kind.clear()
+        self.dropped = 0
+
+
+class MessageBuffer(object):
+    """
+    Stores and organizes incoming messages by their source (the host that
+    produced them) and kind (the application that produced them) in a
+    concurrency-safe way. Can be flushed to produce a report about the messages
+    it's seen before forgetting those messages.
+
+    The approximate bytes held for each kind are tracked, and once a kind
+    holds more than its quota (see BUFFER_KIND_QUOTAS) its new unique
+    messages are only counted, as overflow. What's shed, dropped and
+    overflowing is counted in `accounting`, a BufferAccounting.
+    """
+    # Besides its messages and accounting, a buffer holds what its flushes
+    # use: templates, interner, seen-set, history, render pool and sinks.
+    # pylint: disable=R0902
+    def __init__(self, subject_template, body_template, interner=None,
+                 history=None, seen=None):
+        self.counts_by_unique = defaultdict(_counts_factory())
+        # Its `added` count is cheaper than `total` for checking often.
+        self.accounting = BufferAccounting()
+        self.new_uniques = set()
+        # Called with each unique message that `seen` has never seen before.
+        self.new_listeners = []
+        self.lock = gevent.lock.Semaphore()
+        self.subject_template = subject_template
+        self.body_template = body_template
+        if interner is None and setting('INTERN_STRINGS', True):
+            interner = StringInterner()
+        self.interner = interner
+        self.history = history
+        self.seen = seen
+        # A render.RenderPool for big reports, or None to render them here.
+        self.render_pool = None
+        # Where digests go besides email (see sinks.py).
+        self.sinks = []
+
+    @contextmanager
+    def locked(self):
+        """
+        A context manager for locking (when manipulating shared data like
+        counts_by_unique).
+        """
+        self.lock.acquire()
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    def set_templates(self, subject_template, body_template):
+        """
+        Replaces the templates used by the next flush, keeping the buffered
+        messages.
+        """
+        with self.locked():
+            self.subject_template = subject_template
+            self.body_template = body_template
+
+    def add(self, unique_message, source):
+        """
+        Adds an occurrance of a unique message from `source`.
+
+        If interning is on, every source is swapped for the single copy held
+        by the interner, so the buffer doesn't keep a fresh copy of the same
+        hostname for every unique message.
+        """
+        with self.locked():
+            counts = self.counts_by_unique.get(unique_message)
+            if counts is None:
+                if self._overflow(unique_message, 1):
+                    return
+                unique_message = self._admit(unique_message)
+                counts = self.counts_by_unique[unique_message]
+            if self.interner is not None:
+                source = self.interner.intern(source)
+            sources = counts.sources
+            known = len(sources)
+            counts.increment(source)
+            if len(sources) != known:
+                self._count_sources(unique_message, len(sources) - known)
+            self.accounting.added += 1
+
+    def add_counts(self, unique_message, sources, first_seen, last_seen):
+        """
+        Adds pre-aggregated occurrances of a unique message (e.g. from a
+        relay): `sources` maps each source to a count.
+        """
+        with self.locked():
+            if unique_message not in self.counts_by_unique:
+                if self._overflow(unique_message, sum(itervalues(sources))):
+                    return
+                unique_message = self._admit(unique_message)
+            if self.interner is not None:
+                sources = dict((self.interner.intern(source), count)
+                               for source, count in iteritems(sources))
+            counts = self.counts_by_unique[unique_message]
+            known = len(counts.sources)
+            counts.merge(sources, first_seen, last_seen)
+            if len(counts.sources) != known:
+                self._count_sources(unique_message,
+                                    len(counts.sources) - known)
+            self.accounting.added += sum(itervalues(sources))
+
+    def _admit(self, unique_message):
+        """
+        Prepares a unique message that isn't in the buffer yet, returning the
+        copy to store. Its strings are interned, and it is checked against
+        (and added to) the seen-set. Callers must hold the lock.
+        """
+        if self.interner is not None:
+            unique_message = self.interner.intern_fields(unique_message)
+        if self.seen is not None and self.seen.add(
+                fingerprint(unique_message)):
+            self.new_uniques.add(unique_message)
+            for listener in self.new_listeners:
+                listener(unique_message)
+        kind = getattr(unique_message, 'kind', None)
+        self.accounting.bytes_by_kind[kind] += _entry_bytes(unique_message)
+        return unique_message
+
+    def _overflow(self, unique_message, count):
+        """
+        If the kind of `unique_message`, which isn't in the buffer yet, is
+        over its quota, counts `count` occurrances of it as overflow and
+        returns True. Callers must hold the lock.
+        """
+        kind = getattr(unique_message, 'kind', None)
+        quota = setting('BUFFER_KIND_QUOTAS', {}).get(
+            kind, setting('BUFFER_DEFAULT_KIND_QUOTA', None))
+        accounting = self.accounting
+        # Each shard gets an even share of the quota.
+        if quota is None or accounting.bytes_by_kind.get(kind, 0) * \
+                accounting.quota_shards < quota:
+            return False
+        accounting.overflow_by_kind[kind] += count
+        accounting.added += count
+        return True
+
+    def _count_sources(self, unique_message, count):
+        """
+        Accounts for `count` sources newly held for `unique_message`. Callers
+        must hold the lock.
+        """
+        kind = getattr(unique_message, 'kind', None)
+        self.accounting.bytes_by_kind[kind] += count * _SOURCE_BYTES
+
+    def add_shed(self, kind, count=1):
+        """
+        Records that `count` messages of `kind` were shed before they could be
+        added, so that the next report can say so.
+        """
+        with self.locked():
+            self.accounting.shed_by_kind[kind] += count
+
+    def add_dropped(self, count):
+        """
+        Records that the kernel dropped `count` datagrams before they could be
+        read, so that the next report can say so.
+        """
+        with self.locked():
+            self.accounting.dropped += count
+
+    def contains(self, unique_message):
+        """
+        Returns True if the buffer already holds `unique_message`.
+        """
+        return unique_message in self.counts_by_unique
+
+    def total_matching(self, pred):
+        """
+        Computes the total number of received messages in the buffer
+        that match the predicate.
+        """
+        return sum([counts.total
+                    for (uniq_msg, counts)
+                    in self.counts_by_unique.items()
+                    if pred(uniq_msg)])
+
+    @property
+    def total(self):
+        """
+        Return the total count of all messages in the buffer.
+        """
+        return self.total_matching(lambda um: True)
+
+    @property
+    def total_unique(self):
+        """
+        Computes the total number of _unique_ received messages in the buffer.
+        """
+        return len(self.counts_by_unique)
+
+    @property
+    def unique_messages(self):
+        """
+        Get the unique messages held by this buffer.
+        """
+        return list(self.counts_by_unique)
+
+    @property
+    def kinds(self):
+        """
+        Returns a set of the unique kinds of messages in the buffer.
+        """
+        return set(unique.kind for unique in self.counts_by_unique)
+
+    @property
+    def sorted_counts(self):
+        """
+        Returns a list of pairs of unique message and count, with never
+        before seen messages first, and then in reverse order of count.
+        """
+        new_uniques = self.new_uniques
+        return sorted(self.counts_by_unique.items(),
+                      key=lambda item: (item[0] in new_uniques,
+                                        item[1].total),
+                      reverse=True)
+
+    def flush(self, snapshot=False):
+        """
+        Flushes the buffer. This returns the subject line and body of a report
+        about the contents of the buffer, and its unique messages, then
+        removes all messages from the buffer. With `snapshot`, the report's
+        template parameters (or None if there was nothing to report) are
+        returned too.
+        """
+        params = None
+        unique_messages = []
+        flushed_counts = None
+        with self.locked():
+            # here we want the whole count, not just the
+            # messages/errors that are pageable, since we want to
+            # report even on just monitoring errors...
+            total = self.total
+            accounting = self.accounting
+            if total > 0 or accounting.shed_by_kind or accounting.dropped or \
+                    accounting.overflow_by_kind:
+                try:
+                    sorted_counts = self.sorted_counts
+                    # Copied, since clearing the buffer empties new_uniques.
+                    new_uniques = set(self.new_uniques)
+                    params = dict(server_name=setting('SERVER_NAME'),
+                                  total=total,
+                                  total_unique=self.total_unique,
+                                  sorted_counts=sorted_counts,
+                                  kinds=self.kinds,
+                                  new_messages=new_uniques,
+                                  total_new=len(new_uniques),
+                                  trends=None,
+                                  trend_hours=setting('HISTORY_TREND_HOURS',
+                                                      24),
+                                  total_shed=accounting.total_shed,
+                                  shed_by_kind=sorted(
+                                      accounting.shed_by_kind.items()),
+                                  total_dropped=accounting.dropped,
+                                  total_overflow=accounting.total_overflow,
+                                  overflow_by_kind=sorted(
+                                      accounting.overflow_by_kind.items()),
+                                  bytes_by_kind=sorted(
+                                      accounting.bytes_by_kind.items()))
+                    unique_messages = self.unique_messages
+                # Too general an exception but we want to make sure we recover
+                # cleanly.
+                # pylint: disable=W0703
+                except Exception as exc:
+                    # pylint: disable=E1205
+                    logging.exception('Could not render report', exc)
+                    params = None
+
+                if self.history is not None:
+                    # Copied, since clearing the buffer empties it.
+                    flushed_counts = dict(self.counts_by_unique)
+
+            self._clear()
+            subject_template = self.subject_template
+            body_template = self.body_template
+
+        # The history is read and written outside the lock too, so the
+        # processors don't wait on SQLite.
+        if flushed_counts is not None:
+            if params is not None:
+                params['trends'] = self._trends(params['sorted_counts'])
+            self._record_history(flushed_counts)
+
+        # Rendering happens outside the lock, so processors can keep adding
+        # messages for the next report meanwhile.
+        subject, report = None, None
+        if params is not None:
+            try:
+                subject, report = self._render(subject_template,
+                                               body_template, params)
+            # pylint: disable=W0703
+            except Exception as exc:
+                # pylint: disable=E1205
+                logging.exception('Could not render report', exc)
+        if snapshot:
+            return subject, report, unique_messages, params
+        return subject, report, unique_messages
+
+    def _render(self, subject_template, body_template, params):
+        """
+        Returns the subject and body rendered from `params`: in the render
+        pool if there is one and the report has at least
+        RENDER_POOL_THRESHOLD unique messages, or else in this process.
+        """
+        if self.render_pool is not None and \
+                params['total_unique'] >= setting('RENDER_POOL_THRESHOLD',
+                                                  2000):
+            return self.render_pool.render(subject_template, body_template,
+                                           params)
+        return (subject_template.render(params),
+                body_template.render(params))
+
+    def _trends(self, sorted_counts):
+        """
+        Returns a dict of unique message to its total count over the previous
+        HISTORY_TREND_HOURS (not including this flush), from the history, or
+        None if there is no history or it can't be read.
+        """
+        if self.history is None:
+            return None
+        by_fingerprint = dict((fingerprint(unique), unique)
+                              for unique, _ in sorted_counts)
+        since = time.time() - setting('HISTORY_TREND_HOURS', 24) * 3600
+        try:
+            totals = _offload(self.history.totals_since,
+                              list(by_fingerprint.keys()), since)
+        # Too general an exception but the report matters more than the
+        # trends.
+        # pylint: disable=W0703
+        except Exception as exc:
+            logging.exception('Could not read history: %s', exc)
+            return None
+        return dict((by_fingerprint[fprint], total)
+                    for fprint, total in iteritems(totals))
+
+    def _record_history(self, counts_by_unique):
+        """
+        Records flushed counts (a dict of unique message to MessageCounts) in
+        the history.
+        """
+        if self.history is None:
+            return
+        try:
+            _offload(self.history.record, counts_by_unique)
+        # Too general an exception but the report matters more than the
+        # history.
+        # pylint: disable=W0703
+        except Exception as exc:
+            logging.exception('Could not record history: %s', exc)
+
+    def drain(self):
+        """
+        Removes all messages from the buffer without reporting on them,
+        returning (counts by unique message, shed counts by kind, dropped
+        datagrams). Overflow counts are included in the shed counts, which is
+        all a relay batch can carry.
+        """
+        with self.locked():
+            counts_by_unique = dict(self.counts_by_unique)
+            accounting = self.accounting
+            shed_by_kind = dict(accounting.shed_by_kind)
+            for kind, count in iteritems(accounting.overflow_by_kind):
+                shed_by_kind[kind] = shed_by_kind.get(kind, 0) + count
+            dropped = accounting.dropped
+            self._clear()
+            return counts_by_unique, shed_by_kind, dropped
+
+    def _clear(self):
+        """
+        Forgets all messages. Callers must hold the lock.
+        """
+        self.counts_by_unique.clear()
+        self.accounting.clear()
+        self.new_uniques.clear()
+        if self.seen is not None:
+            self.seen.sync()
+        if self.interner is not None:
+            self.interner.clear()
+
+
+# Rough bytes held for each unique message (its namedtuple, MessageCounts and
+# their dict entries) besides its strings, and for each of its sources (a
+# dict entry and count; the source string itself is interned and shared).
+_ENTRY_BYTES = 800
+_SOURCE_BYTES = 100
+
+
+def _entry_bytes(unique_message):
+    """
+    Estimates the bytes held for a newly buffered unique message. Its strings
+    are counted in full, even when interned.
+    """
+    return _ENTRY_BYTES + sum(len(value) for value in unique_message
+                              if isinstance(value, (bytes, text_type)))
@@ -0,0 +1,68 @@
+"""
+A monotonic clock, for scheduling that mustn't be thrown off when the wall
+clock is changed, and conversions between local datetimes and seconds since
+the epoch.
+
+Python 2 has no time.monotonic, so on Linux this calls clock_gettime
+directly, falling back to time.time where that isn't available.
+"""
+from datetime import datetime
+import ctypes
+import ctypes.util
+import os
+import time
+
+
+_CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+    "struct timespec"
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _load_clock_gettime():
+    "Return libc's clock_gettime, or None if it can't be found"
+    if not hasattr(os, 'uname') or os.uname()[0] != 'Linux':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    return clock_gettime
+
+
+def _clock_gettime_monotonic():
+    "Seconds from CLOCK_MONOTONIC"
+    spec = _Timespec()
+    if _CLOCK_GETTIME(_CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return spec.tv_sec + spec.tv_nsec / 1e9
+
+
+_CLOCK_GETTIME = _load_clock_gettime()
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic  # pylint: disable=E1101,C0103
+elif _CLOCK_GETTIME is not None:
+    monotonic = _clock_gettime_monotonic  # pylint: disable=C0103
+else:
+    monotonic = time.time  # pylint: disable=C0103
+
+
+def to_epoch(when):
+    "Convert a local datetime to seconds since the epoch"
+    if when is None:
+        return None
+    return time.mktime(when.timetuple()) + when.microsecond / 1e6
+
+
+def from_epoch(when):
+    "Convert seconds since the epoch to a local datetime"
+    if when is None:
+        return None
+    return datetime.fromtimestamp(when)
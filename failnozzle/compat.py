@@ -0,0 +1,72 @@
+"""
+The few names that differ between Python 2 and Python 3, so that the rest of
+failnozzle runs unchanged on either. (Only the asyncio engine, aio.py, needs
+Python 3.)
+"""
+import sys
+
+
+__all__ = ['PY3', 'BytesIO', 'exec_file', 'httplib', 'iteritems',
+           'itervalues', 'load_source', 'pickle', 'text_type', 'urlparse',
+           'xrange']
+
+PY3 = sys.version_info[0] >= 3
+
+# Pylint checks under one Python at a time.
+# pylint: disable=C0103,E0401,E0611,F0401,W0611,W0622
+if PY3:
+    import http.client as httplib
+    from io import BytesIO
+    import pickle
+    from urllib import parse as urlparse
+
+    text_type = str
+    xrange = range
+
+    def iteritems(mapping):
+        "An iterator over the items of a dict"
+        return iter(mapping.items())
+
+    def itervalues(mapping):
+        "An iterator over the values of a dict"
+        return iter(mapping.values())
+
+    def exec_file(path, namespace):
+        "Runs the Python file at `path` in `namespace`"
+        with open(path) as handle:
+            code = compile(handle.read(), path, 'exec')
+        exec(code, namespace)
+
+    def load_source(name, path):
+        "Imports the Python file at `path` as the module `name`"
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        return module
+else:
+    import cPickle as pickle
+    import httplib
+    from cStringIO import StringIO as BytesIO
+    import urlparse
+
+    text_type = unicode
+    xrange = xrange
+
+    def iteritems(mapping):
+        "An iterator over the items of a dict"
+        return mapping.iteritems()
+
+    def itervalues(mapping):
+        "An iterator over the values of a dict"
+        return mapping.itervalues()
+
+    def exec_file(path, namespace):
+        "Runs the Python file at `path` in `namespace`"
+        execfile(path, namespace)
+
+    def load_source(name, path):
+        "Imports the Python file at `path` as the module `name`"
+        import imp
+        return imp.load_source(name, path)
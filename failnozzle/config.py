@@ -0,0 +1,253 @@
+"""
+An immutable snapshot of failnozzle's settings.
+
+Reading a setting through failnozzle.context.setting costs a hasattr and a
+getattr on the settings module, and several settings are needed for every
+incoming message. A Config copies every setting once, fills in defaults, and
+precomputes the values derived from them that the per-message code needs, so
+the pipeline can read plain attributes instead.
+
+Also checks the settings at startup and reload, and holds the Config in use
+(see current_config and install_config).
+"""
+from collections import namedtuple
+import re
+
+from failnozzle import settings
+from failnozzle.compat import text_type
+from failnozzle.context import current_pipeline
+
+
+class Config(object):
+    """
+    A snapshot of the UPPER_CASE names of `settings_module`, with
+    `defaults` (a dict of setting name to value) filling in any that are
+    missing, and `overrides` (another such dict, e.g. a pipeline's) taking
+    precedence over both. Settings are read as attributes, e.g.
+    config.FLUSH_SECONDS, and the snapshot can't be changed once built.
+
+    Derived values:
+
+    * unique_msg_tuple: the UNIQUE_MSG_TUPLE class
+    * unique_fields: the set of its fields
+    * shard_fields: its fields that can be used to pick a shard
+    * source_field_name, incoming_message_max_size: the corresponding
+      settings
+    * monitoring_marker_re: a compiled regex matching any of the
+      MONITORING_ERROR_MARKERS, or None if there are none
+    * exc_text_keep: (EXC_TEXT_KEEP_LINES, EXC_TEXT_KEEP_BYTES), or None if
+      both are None and tracebacks are kept whole
+    """
+    # Unique message fields that processing may rewrite, so they can't be used
+    # to pick a shard from a raw incoming record.
+    UNSHARDABLE_FIELDS = frozenset(['message', 'exc_text'])
+
+    def __init__(self, settings_module, defaults, overrides=None):
+        values = dict(defaults)
+        values.update((name, getattr(settings_module, name))
+                      for name in dir(settings_module) if name.isupper())
+        values.update(overrides or {})
+        self._set('_values', values)
+
+        unique_msg_tuple = values.get('UNIQUE_MSG_TUPLE')
+        # pylint: disable=W0212
+        fields = getattr(unique_msg_tuple, '_fields', ())
+        self._set('unique_msg_tuple', unique_msg_tuple)
+        self._set('unique_fields', frozenset(fields))
+        self._set('shard_fields', tuple(field for field in fields
+                                        if field not in
+                                        self.UNSHARDABLE_FIELDS))
+        self._set('source_field_name', values.get('SOURCE_FIELD_NAME'))
+        self._set('incoming_message_max_size',
+                  values.get('INCOMING_MESSAGE_MAX_SIZE'))
+
+        markers = values.get('MONITORING_ERROR_MARKERS') or []
+        if markers:
+            marker_re = re.compile(u'|'.join(re.escape(text_type(marker))
+                                             for marker in markers))
+        else:
+            marker_re = None
+        self._set('monitoring_marker_re', marker_re)
+
+        exc_text_keep = (values.get('EXC_TEXT_KEEP_LINES'),
+                         values.get('EXC_TEXT_KEEP_BYTES'))
+        self._set('exc_text_keep', None if exc_text_keep == (None, None)
+                  else exc_text_keep)
+
+    def _set(self, name, value):
+        "Set an attribute while building the snapshot"
+        object.__setattr__(self, name, value)
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError("Couldn't find setting %s" % name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Config is immutable, not setting %s' % name)
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def get(self, name, default=None):
+        """
+        Returns a setting, or `default` if it isn't set.
+        """
+        return self._values.get(name, default)
+
+
+# What can run failnozzle (see ENGINE).
+ENGINES = ('gevent', 'asyncio')
+
+
+# What MessageQueue does with an incoming message when it is full.
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_SHED_DUPLICATES = 'shed_duplicates'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST,
+                     OVERFLOW_SHED_DUPLICATES)
+
+
+# namedtuples are class-like in usage, so ignore Pylint's objection
+# pylint: disable=C0103
+UniqueMessage = namedtuple('UniqueMessage',
+                           ['module', 'funcName', 'filename', 'message',
+                            'pathname', 'lineno', 'exc_text', 'kind'])
+# pylint: enable=C0103
+
+
+def _default_fake_record(count, exception):
+    """
+    Creates the default fake record
+    """
+    fake_record = dict(module='unknown',
+                       funcName='unknown',
+                       filename='unknown',
+                       pathname='unknown',
+                       lineno=0,
+                       exc_text='Internal error: %d %r' % (count,
+                                                           exception),
+                       kind='unknown',
+                       message='unknown')
+    return fake_record
+
+
+# The settings snapshot installed by _validate_settings.
+_CONFIG = None
+
+
+def _build_config(overrides=None):
+    """
+    Takes a snapshot of the current settings, with `overrides` (a dict of
+    setting name to value) taking precedence.
+    """
+    return Config(settings, {'UNIQUE_MSG_TUPLE': UniqueMessage,
+                             'INTERNAL_ERROR_FUNC': _default_fake_record},
+                  overrides)
+
+
+def current_config():
+    """
+    Returns the settings snapshot of the pipeline the running greenlet works
+    for, if it has its own; otherwise the one installed by
+    _validate_settings, or, if none has been installed (as in unit tests), a
+    fresh snapshot of the current settings.
+    """
+    pipeline = current_pipeline()
+    if pipeline is not None and pipeline.config is not None:
+        return pipeline.config
+    if _CONFIG is not None:
+        return _CONFIG
+    return _build_config()
+
+
+def install_config(config):
+    """
+    Installs `config` as the snapshot current_config returns for greenlets
+    whose pipeline has none of its own; None goes back to fresh snapshots.
+    """
+    global _CONFIG  # pylint: disable=W0603
+    _CONFIG = config
+
+
+def _validate_settings():
+    """
+    Validate the settings to make sure we are sane, then install a snapshot of
+    them for the message pipeline to use instead of looking settings up for
+    every message. Returns the snapshot.
+    """
+    config = _check_settings(_build_config())
+    _check_pipelines(config)
+    install_config(config)
+    return config
+
+
+def _check_settings(config):
+    """
+    Checks a settings snapshot, raising AssertionError if it isn't sane.
+    Returns the snapshot.
+    """
+    # The below can be over-ridden to customize.  If they are, they must be
+    # non-null.
+    not_none_params = ['EMAIL_BODY_TEMPLATE',
+                       'EMAIL_SUBJECT_TEMPLATE',
+                       'EMAIL_TEMPLATE_DIR',
+                       'INTERNAL_ERROR_FUNC',
+                       'SOURCE_FIELD_NAME',
+                       'UNIQUE_MSG_TUPLE']
+
+    for param in not_none_params:
+        val = config.get(param, 'X')
+        assert val is not None, 'Must specify a non-None value for %s' % param
+
+    assert config.get('ENGINE', 'gevent') in ENGINES, \
+        'ENGINE must be in %r' % (ENGINES,)
+
+    policy = config.get('MESSAGE_QUEUE_OVERFLOW_POLICY', OVERFLOW_DROP_NEWEST)
+    assert policy in OVERFLOW_POLICIES, \
+        'MESSAGE_QUEUE_OVERFLOW_POLICY must be in %r' % (OVERFLOW_POLICIES,)
+
+    if config.get('SPOOL_FILE', None) and \
+            config.get('MESSAGE_QUEUE_MAX_SIZE', 0):
+        assert config.SPOOL_HIGH_WATER < config.MESSAGE_QUEUE_MAX_SIZE, \
+            'SPOOL_HIGH_WATER must be below MESSAGE_QUEUE_MAX_SIZE'
+    return config
+
+
+# Files a pipeline keeps to itself, so two pipelines can't name the same one.
+_PIPELINE_FILE_SETTINGS = ('HISTORY_DB', 'SEEN_SET_FILE', 'PAGER_STATE_FILE')
+
+
+def _check_pipelines(config):
+    """
+    Checks that the PIPELINES of a settings snapshot can be told apart: on
+    each UDP_BIND, at most one pipeline without KINDS takes every kind the
+    others don't, no kind goes to two pipelines, and no two pipelines share
+    a file.
+    """
+    claimed = {}
+    catch_alls = {}
+    files = {}
+    for name, overrides in sorted(config.get('PIPELINES', {}).items()):
+        bind = tuple(overrides.get('UDP_BIND', config.get('UDP_BIND')) or ())
+        kinds = overrides.get('KINDS')
+        if kinds:
+            for kind in kinds:
+                assert (bind, kind) not in claimed, \
+                    'Pipelines %s and %s both take kind %s on %r' % (
+                        claimed.get((bind, kind)), name, kind, bind)
+                claimed[(bind, kind)] = name
+        else:
+            assert bind not in catch_alls, \
+                'Pipelines %s and %s both take every kind on %r' % (
+                    catch_alls.get(bind), name, bind)
+            catch_alls[bind] = name
+        for file_setting in _PIPELINE_FILE_SETTINGS:
+            path = overrides.get(file_setting, config.get(file_setting))
+            if path:
+                assert (file_setting, path) not in files, \
+                    'Pipelines %s and %s both use %s %s' % (
+                        files.get((file_setting, path)), name, file_setting,
+                        path)
+                files[(file_setting, path)] = name
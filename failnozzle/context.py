@@ -0,0 +1,75 @@
+"""
+The pipeline the running greenlet works for, and the settings it sees.
+
+Each of the daemon's pipelines (see PIPELINES) overrides some settings.
+Greenlets note the pipeline they work for, so that `setting` can give its
+overrides precedence over the settings module, and greenlets spawned with
+_spawn inherit it.
+"""
+import gevent
+
+from failnozzle import settings
+
+# Pylint doesn't grasp gevent and socket.
+# pylint: disable=E1101
+
+
+_SENTINEL = object()
+
+
+def setting(name, default=_SENTINEL):
+    """
+    Return a setting value or a default if it is not present.
+
+    Note that, unlike many getattr-like functions, if the caller does *not*
+    provide a default, and the setting is not found, this function will raise
+    an Exception.  That allows the code in this module to provide empty default
+    values for certain settings -- so that unit testing doesn't require full
+    settings.  But, at the same time, for all other settings, if one is
+    missing, the code will fail loudly and specifically.
+
+    A setting overridden by the pipeline the running greenlet works for (see
+    Pipeline) takes that pipeline's value.
+    """
+    pipeline = current_pipeline()
+    if pipeline is not None and name in pipeline.overrides:
+        return pipeline.overrides[name]
+
+    if hasattr(settings, name):
+        return getattr(settings, name)
+
+    if default != _SENTINEL:
+        return default
+
+    raise Exception("Couldn't find setting %s" % name)
+
+
+def current_pipeline():
+    """
+    Returns the Pipeline the running greenlet works for, or None if it works
+    for none (as in unit tests).
+    """
+    return getattr(gevent.getcurrent(), 'failnozzle_pipeline', None)
+
+
+def _spawn(func, *args):
+    """
+    Like gevent.spawn, but the new greenlet works for the same pipeline as the
+    running one.
+    """
+    pipeline = current_pipeline()
+    greenlet = gevent.spawn(func, *args)
+    if pipeline is not None:
+        greenlet.failnozzle_pipeline = pipeline
+    return greenlet
+
+
+def _offload(func, *args):
+    """
+    Calls `func(*args)`, which blocks (e.g. on SQLite), in the gevent hub's
+    thread pool, so the other greenlets keep running meanwhile. The asyncio
+    engine has no hub, so there it is just called.
+    """
+    if setting('ENGINE', 'gevent') != 'gevent':
+        return func(*args)
+    return gevent.get_hub().threadpool.apply(func, args)
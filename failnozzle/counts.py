@@ -0,0 +1,162 @@
+"""
+Counts of a unique message's occurrences by source.
+"""
+from collections import defaultdict
+from datetime import datetime
+from functools import partial
+
+from failnozzle.compat import iteritems
+from failnozzle.context import setting
+from failnozzle.sketch import HyperLogLog
+
+
+class MessageCounts(object):
+    """
+    Tracks the number of a times a unique incoming message was received, by its
+    source. Also maintains the first and last seen date of the message.
+    """
+    def __init__(self):
+        self.sources = defaultdict(int)
+        self.first_seen = None
+        self.last_seen = None
+
+    def increment(self, source):
+        """
+        Increments the count of the message for `source`, and updates the first
+        and last seen dates accordingly.
+        """
+        self._count(source, 1)
+        now = datetime.now()
+        if self.first_seen is None:
+            self.first_seen = now
+        self.last_seen = now
+
+    def merge(self, sources, first_seen, last_seen):
+        """
+        Adds counts by source that were seen between `first_seen` and
+        `last_seen`, widening the first and last seen dates to include them.
+        """
+        for source, count in iteritems(sources):
+            self._count(source, count)
+        if first_seen is not None and (self.first_seen is None or
+                                       first_seen < self.first_seen):
+            self.first_seen = first_seen
+        if last_seen is not None and (self.last_seen is None or
+                                      last_seen > self.last_seen):
+            self.last_seen = last_seen
+
+    @property
+    def total(self):
+        """
+        Computes the total number of times this message was seen, across all
+        sources.
+        """
+        return sum(self.sources.values())
+
+    @property
+    def sources_sorted(self):
+        """
+        Returns a list of pairs of source name and count, sorted by the source
+        name.
+        """
+        return sorted(self.sources.items())
+
+    @property
+    def distinct_sources(self):
+        """
+        The number of different sources the message was seen from.
+        """
+        return len(self.sources)
+
+    # Whether `sources` holds only some of the sources (see TopSourceCounts).
+    sources_approximate = False
+
+    def _count(self, source, count):
+        """
+        Adds `count` to the count for `source`.
+        """
+        self.sources[source] += count
+
+
+class TopSourceCounts(MessageCounts):
+    """
+    MessageCounts that keeps counts for at most `top_k` sources, for errors
+    seen across a whole fleet. Past that, the number of distinct sources is
+    estimated with a HyperLogLog of 2^`precision` registers, and `sources`
+    keeps the busiest sources using the Space-Saving algorithm: a new source
+    takes over the smallest count, plus its own, so counts still add up to
+    the total, and any source with more than total / `top_k` is kept.
+
+    A source's count in `sources` is exact if it was kept from its first
+    message; otherwise it includes the count it took over (its entry in
+    `overcounts`), which `sources_sorted` leaves out.
+    """
+    def __init__(self, top_k, precision):
+        super(TopSourceCounts, self).__init__()
+        self.top_k = top_k
+        self.precision = precision
+        self.distinct = None
+        self.overcounts = {}
+
+    def _count(self, source, count):
+        """
+        Adds `count` to the count for `source`, evicting the source with the
+        smallest count if `source` is new and there are already `top_k`.
+        """
+        sources = self.sources
+        if source in sources or len(sources) < self.top_k:
+            sources[source] += count
+        else:
+            if self.distinct is None:
+                self.distinct = HyperLogLog(self.precision)
+                for known in sources:
+                    self.distinct.add(known)
+            smallest = min(sources, key=sources.get)
+            self.overcounts.pop(smallest, None)
+            self.overcounts[source] = sources.pop(smallest)
+            sources[source] = self.overcounts[source] + count
+        if self.distinct is not None:
+            self.distinct.add(source)
+
+    @property
+    def sources_approximate(self):
+        """
+        Whether sources have been evicted, so `sources` holds only the top
+        ones and `distinct_sources` is an estimate.
+        """
+        return self.distinct is not None
+
+    @property
+    def distinct_sources(self):
+        """
+        The number of different sources the message was seen from, estimated
+        once there have been more than `top_k`.
+        """
+        if self.distinct is None:
+            return len(self.sources)
+        return max(self.distinct.estimate(), len(self.sources))
+
+    @property
+    def sources_sorted(self):
+        """
+        Returns a list of pairs of source name and count: sorted by name
+        while every source is kept, or else the busiest first, counting only
+        the messages each source is known to have sent.
+        """
+        if self.distinct is None:
+            return sorted(self.sources.items())
+        return sorted(((source, count - self.overcounts.get(source, 0))
+                       for source, count in iteritems(self.sources)),
+                      key=lambda item: (-item[1], item[0]))
+
+
+def _counts_factory():
+    """
+    Returns a function making the MessageCounts for a unique message: a
+    TopSourceCounts if SOURCES_TOP_K is set, or else a MessageCounts.
+    """
+    top_k = setting('SOURCES_TOP_K', None)
+    if top_k:
+        return partial(TopSourceCounts, top_k,
+                       setting('SOURCES_HLL_PRECISION', 10))
+    return MessageCounts
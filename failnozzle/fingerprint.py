@@ -0,0 +1,20 @@
+"""
+Stable fingerprints for unique messages.
+
+Python's hash() is fine for sharding within one process, but anything kept
+across restarts (history, the seen-set) needs an identifier that doesn't
+change between processes or versions of Python.
+"""
+import hashlib
+import json
+
+
+def fingerprint(unique_message):
+    """
+    Returns a stable hex fingerprint of a unique message (any namedtuple),
+    derived from its field names and values.
+    """
+    # pylint: disable=W0212
+    encoded = json.dumps(sorted(unique_message._asdict().items()),
+                         separators=(',', ':'))
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
@@ -0,0 +1,294 @@
+"""
+Flushing the buffer: sending its digest, checking the error rates and
+paging, and relaying to an upstream failnozzle.
+"""
+from collections import defaultdict, namedtuple
+import logging
+import time
+
+import gevent
+import gevent.socket
+
+from failnozzle import relay, sinks
+from failnozzle.compat import iteritems
+from failnozzle.config import current_config
+from failnozzle.context import _spawn, setting
+from failnozzle.mail import calc_recips, is_not_just_monitoring_error, \
+    mailer, pager
+from failnozzle.paging import ESCALATE, PAGE, RECOVERED
+from failnozzle.processing import _package_unique_message
+
+# Pylint doesn't grasp gevent and socket.
+# pylint: disable=E1101
+
+
+def drop_sampler(drop_counter, message_buffer):
+    """
+    Every UDP_DROP_SAMPLE_SECONDS, logs how many datagrams the kernel dropped
+    on the listening socket and records them in the buffer for the next
+    report.
+    """
+    while True:
+        gevent.sleep(setting('UDP_DROP_SAMPLE_SECONDS'))
+        _sample_drops(drop_counter, message_buffer)
+
+
+def _sample_drops(drop_counter, message_buffer):
+    """
+    Takes one sample of the kernel's drop count, returning the new drops.
+    """
+    dropped = drop_counter.sample()
+    if dropped:
+        logging.warn('Kernel dropped %d incoming datagrams (%d total); '
+                     'failnozzle is not reading fast enough or '
+                     'UDP_RECEIVE_BUFFER_BYTES is too small',
+                     dropped, drop_counter.last)
+        message_buffer.add_dropped(dropped)
+    return dropped
+
+
+def flusher(message_buffer, message_rate):
+    """
+    Checks the incoming message rate, using a background pager
+    greenlet if non-just-monitoring rate exceeded, and flushes the
+    message buffer, using a background emailer greenlet to send the
+    email.
+    """
+    if setting('RELAY_TO', None):
+        relay_flusher(message_buffer)
+        return
+
+    started = time.time()
+    join_greenlets = [_spawn(func, *args) for func, args
+                      in _flush_sends(message_buffer, message_rate)]
+
+    # Wait for the pager & mailer. This is for shutdown, so we don't actually
+    # exit until these have both had a chance to finish.
+    if join_greenlets:
+        gevent.joinall(join_greenlets)
+
+    logging.info('Flush took %.3f seconds', time.time() - started)
+
+
+def _flush_sends(message_buffer, message_rate):
+    """
+    Checks the incoming message rate and flushes the message buffer. Returns
+    what to send as a result, as (function, args) pairs: a page if a rate
+    went over its limit, the report's email, and the digest to each sink.
+    """
+    sends = []
+    accounting = message_buffer.accounting
+    if accounting.total_shed:
+        logging.warn("Shed %d messages since the last flush: %r",
+                     accounting.total_shed, dict(accounting.shed_by_kind))
+    _log_accounting(message_buffer)
+    notices = check_rates(message_buffer, message_rate)
+    if notices:
+        logging.debug('Flusher is sending a page')
+        sends.append((pager, (notices,)))
+    else:
+        logging.debug('Flusher is NOT sending a page')
+
+    # Flush the buffer and email a report.
+    subject, report, unique_messages, params = message_buffer.flush(
+        snapshot=True)
+
+    recips = calc_recips(unique_messages)
+    logging.debug("Calculated recips = %s", recips)
+
+    if report:
+        logging.debug('Flusher is sending a report')
+        sends.append((mailer, (recips, subject, report)))
+    else:
+        logging.debug('Flusher is NOT sending a report')
+
+    if params is not None and message_buffer.sinks:
+        document = sinks.digest_document(params)
+        for sink in message_buffer.sinks:
+            sends.append((sink.send, (document,)))
+    return sends
+
+
+# Something to tell the pager: a paging.PAGE, ESCALATE, or RECOVERED `event`
+# for the global rate (if `kind` is None) or a kind's rate, and a description.
+# pylint: disable=C0103
+PageNotice = namedtuple('PageNotice', ['event', 'kind', 'text'])
+# pylint: enable=C0103
+
+_GLOBAL_PAGE_TEXT = {
+    PAGE: u'Danger: received %(total)d errors within the alert window.',
+    ESCALATE: u'Still climbing: received %(total)d errors within the alert '
+              u'window, up from %(paged_total)d when paged.',
+    RECOVERED: u'Recovered: the error rate has been under the limit for '
+               u'%(minutes)d minutes.',
+}
+
+_KIND_PAGE_TEXT = {
+    PAGE: u'Danger: received %(total)d %(kind)s errors within the alert '
+          u'window (limit %(limit)d), %(source_total)d of them from '
+          u'%(source)s.',
+    ESCALATE: u'Still climbing: received %(total)d %(kind)s errors within '
+              u'the alert window, up from %(paged_total)d when paged, '
+              u'%(source_total)d of them from %(source)s.',
+    RECOVERED: u'Recovered: %(kind)s errors have been under the limit for '
+               u'%(minutes)d minutes.',
+}
+
+
+def _log_accounting(message_buffer):
+    """
+    Logs the approximate bytes the buffer holds by kind, and the messages
+    only counted because their kind was over its quota.
+    """
+    accounting = message_buffer.accounting
+    bytes_by_kind = accounting.bytes_by_kind
+    if bytes_by_kind:
+        logging.info('Buffer holds ~%d bytes: %s',
+                     sum(bytes_by_kind.values()),
+                     ', '.join('%s ~%d' % item
+                               for item in sorted(bytes_by_kind.items())))
+    if accounting.total_overflow:
+        logging.warn('Counted %d new messages over their kind quota as '
+                     'overflow: %r', accounting.total_overflow,
+                     dict(accounting.overflow_by_kind))
+
+
+def check_rates(message_buffer, message_rate):
+    """
+    Adds the buffer's counts to the message rates and returns a PageNotice
+    for each rate that should page, escalate, or say it has recovered.
+    """
+    pager_state = message_rate.pager_state
+    minutes = pager_state.recovery // 60
+    notices = []
+
+    # Check the message rate, not including "just monitoring" messages
+    # in the message rate.  TODO: at some point, if this becomes more
+    # complex, make it more config-y.
+    # Messages shed by a full queue, over their kind's quota or dropped by
+    # the kernel count too: they were real errors. Kinds with their own limit
+    # in PAGER_KIND_LIMITS only count towards that.
+    kind_limits = setting('PAGER_KIND_LIMITS', {})
+    accounting = message_buffer.accounting
+    total_matching = message_buffer.total_matching(
+        lambda unique_message: is_not_just_monitoring_error(unique_message)
+        and getattr(unique_message, 'kind', None) not in kind_limits) + \
+        sum(count for kind, count in iteritems(accounting.shed_by_kind)
+            if kind not in kind_limits) + \
+        sum(count for kind, count in iteritems(accounting.overflow_by_kind)
+            if kind not in kind_limits) + accounting.dropped
+    logging.debug("Found %d non-monitoring messages, %d total",
+                  total_matching, message_buffer.total)
+    exceeded, total = message_rate.add_and_check(total_matching)
+    event = pager_state.update('global', exceeded, total)
+    if event is not None:
+        paged_total = pager_state.incidents.get('global', {}).get(
+            'paged_total')
+        notices.append(PageNotice(event, None, _GLOBAL_PAGE_TEXT[event] % dict(
+            total=total, paged_total=paged_total, minutes=minutes)))
+
+    if message_rate.kind_rate is None:
+        return notices
+    alerts = dict((alert.kind, alert) for alert in
+                  message_rate.add_and_check_kinds(
+                      _counts_by_kind_source(message_buffer)))
+    # Kinds that are over their limit, or were and may have recovered.
+    kinds = set(alerts)
+    kinds.update(key[len('kind:'):] for key in pager_state.keys('kind:'))
+    for kind in sorted(kinds):
+        key = u'kind:%s' % kind
+        alert = alerts.get(kind)
+        event = pager_state.update(key, alert is not None,
+                                   alert.total if alert else 0)
+        if event is None:
+            continue
+        params = dict(kind=kind, minutes=minutes,
+                      paged_total=pager_state.incidents.get(key, {}).get(
+                          'paged_total'))
+        if alert is not None:
+            params.update(alert._asdict())
+        notices.append(PageNotice(event, kind,
+                                  _KIND_PAGE_TEXT[event] % params))
+    return notices
+
+
+def _counts_by_kind_source(message_buffer):
+    """
+    Returns the buffer's non-monitoring message counts by (kind, source).
+    Shed and overflow messages count against their kind, from an unknown
+    source.
+    """
+    counts = defaultdict(int)
+    for unique_message, message_counts in \
+            message_buffer.counts_by_unique.items():
+        if is_not_just_monitoring_error(unique_message):
+            kind = getattr(unique_message, 'kind', None)
+            for source, count in iteritems(message_counts.sources):
+                counts[(kind, source)] += count
+    accounting = message_buffer.accounting
+    for kind, count in iteritems(accounting.shed_by_kind):
+        counts[(kind, None)] += count
+    for kind, count in iteritems(accounting.overflow_by_kind):
+        counts[(kind, None)] += count
+    return counts
+
+
+def relay_flusher(message_buffer):
+    """
+    Flushes the message buffer by forwarding its pre-aggregated counts to the
+    upstream failnozzle at RELAY_TO, rather than emailing a report. Paging is
+    left to the upstream, which sees the combined rate.
+    """
+    started = time.time()
+    _log_accounting(message_buffer)
+    counts_by_unique, shed_by_kind, dropped = message_buffer.drain()
+    batches = relay.encode_batches(counts_by_unique, shed_by_kind,
+                                   setting('SERVER_NAME'),
+                                   setting('RELAY_MAX_BATCH_SIZE'), dropped)
+    failed = 0
+    if batches:
+        relay_socket = gevent.socket.socket(family=gevent.socket.AF_INET,
+                                            type=gevent.socket.SOCK_DGRAM)
+        try:
+            for batch in batches:
+                # One batch failing doesn't keep the rest from being sent.
+                try:
+                    relay_socket.sendto(batch, setting('RELAY_TO'))
+                # Too general an exception but we want to make sure we
+                # recover/log cleanly.
+                # pylint: disable=W0703
+                except Exception as exc:
+                    failed += 1
+                    logging.exception('Error relaying a %d byte batch to '
+                                      '%r: %s', len(batch),
+                                      setting('RELAY_TO'), exc)
+        finally:
+            relay_socket.close()
+
+    logging.info('Relayed %d unique messages in %d batches (%d failed) to '
+                 '%r, took %.3f seconds', len(counts_by_unique), len(batches),
+                 failed, setting('RELAY_TO'), time.time() - started)
+
+
+def _merge_relay_batch(message_buffer, data):
+    """
+    Merges a batch relayed from a downstream failnozzle into the buffer, as if
+    its messages had arrived here. Raises ValueError unless RELAY_ACCEPT is
+    on.
+    """
+    if not setting('RELAY_ACCEPT', False):
+        raise ValueError('Got a relay batch, but RELAY_ACCEPT is off')
+    relay_name, entries, shed_by_kind, dropped = relay.decode_batch(data)
+    logging.debug('Merging %d unique messages relayed from %s',
+                  len(entries), relay_name)
+    config = current_config()
+    fields = config.unique_fields
+    for unique_fields, sources, first_seen, last_seen in entries:
+        unique = _package_unique_message(
+            dict((field, value) for field, value in iteritems(unique_fields)
+                 if field in fields), config)
+        message_buffer.add_counts(unique, sources, first_seen, last_seen)
+    for kind, count in iteritems(shed_by_kind):
+        message_buffer.add_shed(kind, count)
+    if dropped:
+        message_buffer.add_dropped(dropped)
@@ -0,0 +1,177 @@
+"""
+A local SQLite history of flushed error counts.
+
+Each flush records, in one transaction, the total and per-source counts of
+every unique message (by fingerprint), plus a representative copy of the
+unique message itself. Rows older than the retention period are deleted as
+new flushes are recorded. The history answers questions like "how often has
+this error fired in the last day?", which digests use to show trends.
+"""
+import json
+import sqlite3
+import time
+
+from failnozzle.clock import to_epoch
+from failnozzle.compat import iteritems
+from failnozzle.fingerprint import fingerprint
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS flushes (
+    id INTEGER PRIMARY KEY,
+    flushed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS flushes_flushed_at ON flushes (flushed_at);
+
+CREATE TABLE IF NOT EXISTS occurrences (
+    flush_id INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    kind TEXT,
+    flushed_at REAL NOT NULL,
+    total INTEGER NOT NULL,
+    first_seen REAL,
+    last_seen REAL
+);
+CREATE INDEX IF NOT EXISTS occurrences_fingerprint
+    ON occurrences (fingerprint, flushed_at);
+CREATE INDEX IF NOT EXISTS occurrences_kind ON occurrences (kind, flushed_at);
+CREATE INDEX IF NOT EXISTS occurrences_flushed_at ON occurrences (flushed_at);
+
+CREATE TABLE IF NOT EXISTS source_counts (
+    flush_id INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    source TEXT,
+    count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS source_counts_fingerprint
+    ON source_counts (fingerprint);
+CREATE INDEX IF NOT EXISTS source_counts_flush_id ON source_counts (flush_id);
+
+CREATE TABLE IF NOT EXISTS messages (
+    fingerprint TEXT PRIMARY KEY,
+    kind TEXT,
+    fields TEXT NOT NULL,
+    first_recorded REAL NOT NULL,
+    last_recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_kind ON messages (kind);
+CREATE INDEX IF NOT EXISTS messages_last_recorded
+    ON messages (last_recorded);
+"""
+
+# SQLite limits the number of parameters in one statement (999 by default).
+_QUERY_CHUNK = 500
+
+
+def _chunks(items, size):
+    "Split a list into lists of at most `size` items"
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class History(object):
+    """
+    The history database at `path`, keeping `retention_seconds` of flushes.
+    """
+    def __init__(self, path, retention_seconds):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        # Used from the hub's thread pool, one call at a time.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        self.conn.close()
+
+    def record(self, counts_by_unique, flushed_at=None):
+        """
+        Records a flush (a dict of unique message to MessageCounts) and
+        deletes anything older than the retention period, in one
+        transaction.
+        """
+        flushed_at = time.time() if flushed_at is None else flushed_at
+        occurrences = []
+        source_counts = []
+        messages = []
+        for unique_message, counts in iteritems(counts_by_unique):
+            fprint = fingerprint(unique_message)
+            kind = getattr(unique_message, 'kind', None)
+            occurrences.append((fprint, kind, flushed_at, counts.total,
+                                to_epoch(counts.first_seen),
+                                to_epoch(counts.last_seen)))
+            source_counts.extend((fprint, source, count)
+                                 for source, count
+                                 in iteritems(counts.sources))
+            # pylint: disable=W0212
+            messages.append((fprint, kind,
+                             json.dumps(unique_message._asdict()),
+                             flushed_at, flushed_at))
+
+        with self.conn:
+            flush_id = self.conn.execute(
+                'INSERT INTO flushes (flushed_at) VALUES (?)',
+                (flushed_at,)).lastrowid
+            self.conn.executemany(
+                'INSERT INTO occurrences VALUES (%d, ?, ?, ?, ?, ?, ?)'
+                % flush_id, occurrences)
+            self.conn.executemany(
+                'INSERT INTO source_counts VALUES (%d, ?, ?, ?)' % flush_id,
+                source_counts)
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)',
+                messages)
+            self.conn.executemany(
+                'UPDATE messages SET last_recorded = ? WHERE fingerprint = ?',
+                [(flushed_at, message[0]) for message in messages])
+            self._compact(flushed_at - self.retention_seconds)
+
+    def _compact(self, cutoff):
+        """
+        Deletes flushes recorded before `cutoff`, and messages not recorded
+        since then.
+        """
+        self.conn.execute(
+            'DELETE FROM source_counts WHERE flush_id IN '
+            '(SELECT id FROM flushes WHERE flushed_at < ?)', (cutoff,))
+        self.conn.execute('DELETE FROM occurrences WHERE flushed_at < ?',
+                          (cutoff,))
+        self.conn.execute('DELETE FROM flushes WHERE flushed_at < ?',
+                          (cutoff,))
+        self.conn.execute('DELETE FROM messages WHERE last_recorded < ?',
+                          (cutoff,))
+
+    def totals_since(self, fingerprints, since):
+        """
+        Returns a dict of fingerprint to the total count recorded since
+        `since` (seconds since the epoch), for those of `fingerprints` that
+        have any.
+        """
+        totals = {}
+        for chunk in _chunks(list(fingerprints), _QUERY_CHUNK):
+            rows = self.conn.execute(
+                'SELECT fingerprint, SUM(total) FROM occurrences '
+                'WHERE flushed_at >= ? AND fingerprint IN (%s) '
+                'GROUP BY fingerprint' % ','.join('?' * len(chunk)),
+                [since] + chunk)
+            totals.update(rows)
+        return totals
+
+    def kind_totals_since(self, since):
+        """
+        Returns a dict of kind to the total count recorded since `since`.
+        """
+        return dict(self.conn.execute(
+            'SELECT kind, SUM(total) FROM occurrences WHERE flushed_at >= ? '
+            'GROUP BY kind', (since,)))
+
+    def source_totals(self, fprint):
+        """
+        Returns a dict of source to the total count recorded for one
+        fingerprint over the whole history.
+        """
+        return dict(self.conn.execute(
+            'SELECT source, SUM(count) FROM source_counts '
+            'WHERE fingerprint = ? GROUP BY source', (fprint,)))
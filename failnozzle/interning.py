@@ -0,0 +1,43 @@
+"""
+Sharing one copy of the strings repeated across buffered messages.
+"""
+
+
+class StringInterner(object):
+    """
+    A flush-scoped interning table: maps each string value to the first equal
+    value seen, so that equal strings decoded from different packets share
+    one copy. (The builtin intern() doesn't accept the unicode strings that
+    json produces.)
+    """
+    # Fields of a unique message that tend to repeat across unique messages.
+    FIELDS = ('exc_text', 'pathname', 'kind')
+
+    def __init__(self):
+        self.table = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    def intern(self, value):
+        """
+        Returns the interned copy of `value`.
+        """
+        if value is None:
+            return None
+        return self.table.setdefault(value, value)
+
+    def intern_fields(self, unique_message):
+        """
+        Returns `unique_message` with its FIELDS interned.
+        """
+        # pylint: disable=W0212
+        return unique_message._replace(**dict(
+            (field, self.intern(getattr(unique_message, field)))
+            for field in self.FIELDS if field in unique_message._fields))
+
+    def clear(self):
+        """
+        Forgets every interned value.
+        """
+        self.table.clear()
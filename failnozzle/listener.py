@@ -0,0 +1,149 @@
+"""
+Reading packets from the UDP socket.
+"""
+import errno
+import json
+import logging
+
+import gevent
+import gevent.socket
+
+from failnozzle import relay
+from failnozzle.clock import monotonic
+from failnozzle.config import current_config
+from failnozzle.context import _spawn
+from failnozzle.flushing import _merge_relay_batch
+from failnozzle.processing import _make_fake_record
+
+# Pylint doesn't grasp gevent and socket.
+# pylint: disable=E1101
+
+
+class Listener(object):
+    """
+    Reads packets from the UDP socket `sock`, putting the records they hold
+    on `message_queue`, or merging relayed batches into `message_buffer`.
+
+    With a `spool` (a spool.Spool), packets arriving while `high_water` or
+    more records are queued are spooled undecoded instead, along with every
+    packet after them until the spool empties, and a second greenlet moves
+    them onto the queue in order as it drains to half of `high_water`.
+    """
+    def __init__(self, sock, message_queue, message_buffer, spool=None,
+                 high_water=0):
+        self.socket = sock
+        self.message_queue = message_queue
+        self.message_buffer = message_buffer
+        self.spool = spool
+        self.high_water = high_water
+        self.errors = 0
+        self.greenlet = None
+        self.spool_greenlet = None
+
+    def run(self):
+        """
+        Reads packets forever.
+        """
+        while True:
+            self.receive()
+
+    def start(self):
+        """
+        Reads packets in a background greenlet, and unspools them in another.
+        """
+        self.greenlet = _spawn(self.run)
+        if self.spool is not None:
+            self.spool_greenlet = _spawn(self.unspool)
+
+    def receive(self):
+        """
+        Reads and handles one packet.
+        """
+        try:
+            data = self.socket.recv(current_config().incoming_message_max_size)
+            if relay.is_batch(data):
+                _merge_relay_batch(self.message_buffer, data)
+                return
+            if self.spool is not None and \
+                    (len(self.spool) or
+                     self.message_queue.qsize() >= self.high_water) and \
+                    self.spool.append(data):
+                return
+        # Too general an exception but we want to make sure we recover
+        # cleanly.
+        # pylint: disable=W0703
+        except Exception as exc:
+            if getattr(exc, 'errno', None) in (errno.EAGAIN,
+                                               errno.EWOULDBLOCK):
+                raise
+            self._record_error(exc)
+            return
+        self.handle(data)
+
+    def unspool(self):
+        """
+        Moves spooled packets onto the queue whenever it has drained to half
+        of `high_water`, forever.
+        """
+        low_water = self.high_water // 2
+        while True:
+            while len(self.spool) and \
+                    self.message_queue.qsize() <= low_water:
+                self.handle(self.spool.pop())
+            gevent.sleep(0.01)
+
+    def close_spool(self):
+        """
+        Stops unspooling and closes the spool. Returns the number of packets
+        left in it, which are unspooled at the next start.
+        """
+        if self.spool is None:
+            return 0
+        if self.spool_greenlet is not None:
+            self.spool_greenlet.kill()
+        left = len(self.spool)
+        self.spool.close()
+        return left
+
+    def handle(self, data):
+        """
+        Decodes a packet and queues the record it holds.
+        """
+        try:
+            obj = json.loads(data)
+            record = logging.makeLogRecord(obj)
+            self.message_queue.put(vars(record))
+
+        # Too general an exception but we want to make sure we recover
+        # cleanly.
+        # pylint: disable=W0703
+        except Exception as exc:
+            self._record_error(exc)
+
+    def _record_error(self, exc):
+        """
+        Logs a bad packet and queues a record about it.
+        """
+        self.errors += 1
+        logging.exception('Error on incoming packet: %s', exc)
+        self.message_queue.put(_make_fake_record(self.errors, exc))
+
+    def stop(self, deadline):
+        """
+        Stops listening, then handles the packets already waiting in the
+        socket, until there are none left or the monotonic clock reaches
+        `deadline`, and closes the socket. Returns the number of packets
+        handled.
+        """
+        if self.greenlet is not None:
+            self.greenlet.kill()
+        self.socket.settimeout(0.0)
+        drained = 0
+        try:
+            while monotonic() < deadline:
+                self.receive()
+                drained += 1
+        except gevent.socket.error:
+            pass
+        self.socket.close()
+        return drained
@@ -3,55 +3,120 @@ A wrapper for DatagramHandler that adds information about the source of the log
 message, and the service that generated it.  Also, encodes the messages as JSON
 instead of python's pickle format.
 """
+from json.encoder import encode_basestring_ascii
 import json
 import logging.handlers
+import socket
+
+from failnozzle.compat import PY3, text_type
+
+
+# The record fields failnozzle dedupes on by default (see UniqueMessage),
+# besides `message`, which is always sent.
+DEFAULT_FIELDS = ('funcName', 'lineno', 'exc_text')
+
+# Fields that only depend on the record's pathname.
+_PATH_FIELDS = ('pathname', 'filename', 'module')
+# Fields that are always sent.
+_FIXED_FIELDS = _PATH_FIELDS + ('message', 'created', 'source', 'kind')
+
+
+def _encode(value):
+    """
+    Encodes a field value as JSON, quickly for the usual strings and ints.
+    """
+    if isinstance(value, (str, text_type)):
+        return encode_basestring_ascii(value)
+    if value is None:
+        return 'null'
+    if type(value) is int:
+        return str(value)
+    # Anything else the record holds goes as its repr if it has to.
+    return json.dumps(value, default=repr)
 
 
 class AggregatorHandler(logging.handlers.DatagramHandler):
     """
     Wraps DatagramHandler with some additional information about the source
     and kind of each log message.
+
+    Only the fields failnozzle uses are sent: `message` (the formatted
+    message), `created` (which replays go by), the pathname, filename and
+    module of the code that logged, source, kind, and `fields` (by default
+    DEFAULT_FIELDS; add any fields of a custom UNIQUE_MSG_TUPLE). The parts
+    that don't change from record to record are encoded once: source and kind
+    per handler, and the path fields per pathname.
     """
 
-    def __init__(self, host, port, source, kind):
+    def __init__(self, host, port, source, kind, fields=DEFAULT_FIELDS):
         """
         `host`: the host of the log aggregator service
         `port`: the port number of the log aggregator service
         `source`: the hostname of the machine that generated the log message
         `kind`: the kind of service that generated the message (app, imap, ...)
+        `fields`: the other record fields to send
         """
         self.source = source
         self.kind = kind
+        self.fields = tuple(field for field in fields
+                            if field not in _FIXED_FIELDS)
+        self.static = '"source":%s,"kind":%s' % (_encode(source),
+                                                 _encode(kind))
+        # Pathname to its encoded path fields.
+        self.path_parts = {}
+        # (ip, port), looked up at the first send.
+        self.destination = None
         super(AggregatorHandler, self).__init__(host, port)
 
     # We're overriding a method, so we can't change the name
     # pylint: disable=C0103
     def makePickle(self, record):
         """
-        Marshalls the record, in this case to JSON rather than a pickle string
-        and converts the record to binary format with a length prefix, and
-        returns it ready for transmission across the socket.
+        Marshalls the record, in this case to JSON rather than a pickle string,
+        and returns it ready for transmission across the socket.
 
-        See logging.handlersSocketHandler.makePickle, we follow the same
-        conventions and logic only w/ JSON rather than pickle.
+        See logging.handlers.SocketHandler.makePickle; unlike it, only the
+        fields failnozzle uses are sent, so extras that can't be serialized
+        don't break anything.
         """
-        exc_info = record.exc_info
-        if exc_info:
-            # call format to get traceback text into record.exc_text
-            _ = self.format(record)
-            # to avoid json error
-            record.exc_info = None
-        str_ = json.dumps(record.__dict__)
-        # for next handler
-        if exc_info:
-            record.exc_info = exc_info
-        return str_
-    # pylint: enable=C0103
+        if record.exc_info and not record.exc_text:
+            # Cached on the record, as Formatter.format does, for the next
+            # handler.
+            # pylint: disable=W0212
+            formatter = self.formatter or logging._defaultFormatter
+            record.exc_text = formatter.formatException(record.exc_info)
 
-    def emit(self, record):
+        path_part = self.path_parts.get(record.pathname)
+        if path_part is None:
+            path_part = self.path_parts[record.pathname] = ','.join(
+                '"%s":%s' % (field, _encode(getattr(record, field, None)))
+                for field in _PATH_FIELDS)
+
+        parts = ['{', self.static, ',', path_part, ',"message":',
+                 _encode(record.getMessage()), ',"created":',
+                 repr(record.created)]
+        for field in self.fields:
+            parts.append(',"%s":%s' % (field,
+                                       _encode(getattr(record, field, None))))
+        parts.append('}')
+        packet = ''.join(parts)
+        if PY3:
+            # Everything is ASCII, from encode_basestring_ascii.
+            packet = packet.encode('ascii')
+        return packet
+
+    def send(self, s):
         """
-        Emits the record, adding `source` and `kind` fields.
+        Sends a packet to the aggregator, whose address is looked up at the
+        first send (and again after an error) rather than at every send.
         """
-        record.source = self.source
-        record.kind = self.kind
-        return super(AggregatorHandler, self).emit(record)
+        if self.sock is None:
+            self.createSocket()
+        if self.destination is None:
+            self.destination = (socket.gethostbyname(self.host), self.port)
+        try:
+            self.sock.sendto(s, self.destination)
+        except socket.error:
+            self.destination = None
+            raise
+    # pylint: enable=C0103
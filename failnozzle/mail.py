@@ -0,0 +1,192 @@
+"""
+Who gets emailed about what, and sending the email.
+"""
+from email.mime.text import MIMEText
+import logging
+import smtplib
+import time
+
+from failnozzle.compat import text_type
+from failnozzle.config import current_config
+from failnozzle.context import _spawn, setting
+from failnozzle.paging import RECOVERED
+
+
+def is_just_monitoring_error(unique_message):
+    """
+    Return True if the unique_message is an intentional error just for
+    monitoring (meaning that it contains the one of the
+    JUST_MONITORING_ERROR_MARKERS somewhere in the exc_text)
+    """
+    marker_re = current_config().monitoring_marker_re
+    if marker_re is None:
+        return False
+    return bool(marker_re.search(text_type(unique_message.exc_text)) or
+                marker_re.search(text_type(unique_message.message)))
+
+
+def is_not_just_monitoring_error(unique_message):
+    """
+    Return True if unique_message does not appear to be an intentional
+    error.
+    """
+    return not is_just_monitoring_error(unique_message)
+
+
+def deferred_setting(name, default):
+    """
+    Returns a function that calls settings with (name, default)
+    """
+    return lambda: setting(name, default)
+
+# patterns for figuring out which recipients should be added to an
+# error summary.  Note that we're not attempting to split out
+# different errors into different emails--if a recipient matches *any*
+# error in a flushed batch, the recipient is added to the email, and
+# will see all the errors.  The form of the list is:
+# [(email_recipient_addr, callable_with_unique_message), ...]  where
+# the callable_with_unique_message takes a UniqueMessage and returns
+# True if the presence of the message should be alerted to the
+# corresponding recipient.
+RECIP_MATCHERS = [
+    (deferred_setting('JUST_MONITORING_REPORT_TO', ''),
+        is_just_monitoring_error),
+    (deferred_setting('REPORT_TO', ''),
+        is_not_just_monitoring_error)
+]
+
+
+def _get_recip_matchers():
+    """
+    Return an iterator over recipient matchers, handling any deferred
+    settings
+    """
+    for recip, matcher in RECIP_MATCHERS:
+        if callable(recip):
+            recip_value = recip()
+        else:
+            recip_value = recip
+
+        yield recip_value, matcher
+
+
+def calc_recips(unique_messages):
+    """
+    Calculate all recipients for the error summary, based on the kinds
+    of errors that are batched up to go out, and return them as a
+    list.
+
+    Note that based on the configuration of we *shouldn't* ever return
+    an empty list, but this is not promised, so callers should take
+    steps to make sure there is a default recipient if one is not
+    found here.
+    """
+    recips = set()
+    for unique_message in unique_messages:
+        for recip, recip_matcher in _get_recip_matchers():
+            if recip_matcher(unique_message):
+                logging.debug("Matched against %s adding recip %s",
+                              recip_matcher,
+                              recip)
+                recips.add(recip)
+    return list(recips)
+
+
+def mailer(recips, subject, report):
+    """
+    Sends an email containing a report from a flushed MessageBuffer.
+    """
+    if not recips:
+        logging.error("Recips was empty, adding error recip")
+        recips.append(setting('REPORT_TO', ''))
+    logging.info('Mailer is emailing, subject = %r, recipients=%r',
+                 subject, recips)
+    send_email(setting('REPORT_FROM', ''), ', '.join(recips),
+               subject, report, reply_to=setting('REPLY_TO', ''))
+
+
+def pager(notices):
+    """
+    Sends one email to the pager with every PageNotice from a flush, alerting
+    us of error rates over their limits (or back under them).
+    """
+    logging.info('Pager is emailing: %s',
+                 ', '.join('%s %s' % (notice.event, notice.kind or 'global')
+                           for notice in notices))
+    if all(notice.event == RECOVERED for notice in notices):
+        subject = u'%s error rate recovered' % setting('SERVER_NAME')
+    else:
+        subject = u'%s error rate exceeded' % setting('SERVER_NAME')
+    kinds = [text_type(notice.kind) for notice in notices
+             if notice.kind is not None]
+    if kinds:
+        subject += u' for %s' % ', '.join(kinds)
+    report = u'\n'.join(notice.text for notice in notices)
+    send_email(setting('PAGER_FROM'), setting('PAGER_TO'), subject, report,
+               reply_to=setting('PAGER_REPLY_TO', ''))
+
+
+class NewErrorNotifier(object):
+    """
+    A MessageBuffer new-listener that emails each never before seen error
+    right away rather than waiting for the digest, sending at most `limit`
+    emails per FLUSH_SECONDS so that a bad deploy doesn't send a flood.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.sent_times = []
+
+    def __call__(self, unique_message):
+        now = time.time()
+        self.sent_times = [sent for sent in self.sent_times
+                           if sent > now - setting('FLUSH_SECONDS')]
+        if len(self.sent_times) >= self.limit:
+            logging.debug('Not notifying of new error, limit reached')
+            return
+        self.sent_times.append(now)
+        _spawn(new_error_mailer, unique_message)
+
+
+def new_error_mailer(unique_message):
+    """
+    Sends an email about a single never before seen error.
+    """
+    subject = u'%s new error: %s' % (setting('SERVER_NAME'),
+                                     getattr(unique_message, 'message', ''))
+    # pylint: disable=W0212
+    report = u'\n'.join(u'%s: %s' % (field, value)
+                        for field, value in unique_message._asdict().items()
+                        if field != 'exc_text')
+    report += u'\n\n%s' % (getattr(unique_message, 'exc_text', '') or '')
+    mailer(calc_recips([unique_message]), subject, report)
+
+
+def send_email(from_addr, to_addr, subject, body, reply_to=None):
+    """
+    Sends a text/plain email from `from_addr` to the address `to_addr`, with
+    subject `subject` and body `body`, using the host, port, user, and password
+    from settings.
+    """
+    try:
+        msg = MIMEText(body, 'plain')
+        msg['From'] = from_addr
+        msg['To'] = to_addr
+        msg['Subject'] = subject
+        if reply_to is not None:
+            msg['Reply-To'] = reply_to
+
+        if setting('SMTP_USE_SSL', True):
+            smtp_class = smtplib.SMTP_SSL
+        else:
+            smtp_class = smtplib.SMTP
+        smtp = smtp_class(setting('SMTP_HOST'), setting('SMTP_PORT'))
+        if setting('SMTP_USER', ''):
+            smtp.login(setting('SMTP_USER'), setting('SMTP_PASSWORD'))
+        smtp.sendmail(from_addr, [to_addr], msg.as_string())
+        smtp.close()
+
+    # Too general an exception but we want to make sure we recover/log
+    # cleanly.
+    # pylint: disable=W0703
+    except Exception as exc:
+        logging.exception('Error sending email "%s": %s', subject, exc)
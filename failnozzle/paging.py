@@ -0,0 +1,122 @@
+"""
+Deciding when to page.
+
+Each rate that can page (the global rate, and each kind's) has its own
+incident, tracked through three states:
+
+* resolved: all quiet. Going over the limit sends a page and starts firing.
+* firing: over the limit. Repeat pages are suppressed until `cooldown`
+  seconds after the last one, except for a single escalation if the rate
+  climbs to `escalation_factor` times what it was when paged. Going under
+  the limit starts cooling down.
+* cooldown: back under the limit. Going over again resumes firing (without
+  a page unless the cooldown since the last one has passed); staying under
+  for `recovery` seconds sends one recovered notice and resolves.
+
+Incidents are saved to a JSON file, if given, so a restart in the middle of
+one doesn't page again.
+"""
+import json
+import logging
+import os
+import time
+
+
+FIRING = 'firing'
+COOLDOWN = 'cooldown'
+RESOLVED = 'resolved'
+
+# What to tell the pager.
+PAGE = 'page'
+ESCALATE = 'escalate'
+RECOVERED = 'recovered'
+
+
+class PagerState(object):
+    """
+    The incidents for every rate, by key, saved to `path` unless it is None.
+    """
+    def __init__(self, path=None, cooldown=1800, escalation_factor=2,
+                 recovery=600):
+        self.path = path
+        self.cooldown = cooldown
+        self.escalation_factor = escalation_factor
+        self.recovery = recovery
+        self.incidents = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as handle:
+                    self.incidents = json.load(handle)
+            # A corrupt file just means forgetting the incidents.
+            # pylint: disable=W0703
+            except Exception as exc:
+                logging.warn('Could not read pager state from %s: %s',
+                             path, exc)
+
+    def state(self, key):
+        """
+        Returns the state of the incident for `key`.
+        """
+        return self.incidents.get(key, {}).get('state', RESOLVED)
+
+    def keys(self, prefix=''):
+        """
+        Returns the keys of unresolved incidents starting with `prefix`.
+        """
+        return [key for key in self.incidents if key.startswith(prefix)]
+
+    def update(self, key, exceeded, total, now=None):
+        """
+        Records whether the rate for `key` is over its limit, with its
+        `total`, and returns PAGE, ESCALATE, RECOVERED, or None.
+        """
+        if now is None:
+            now = time.time()
+        incident = self.incidents.get(key)
+        event = None
+
+        if exceeded:
+            if incident is None:
+                incident = self.incidents[key] = {}
+                event = PAGE
+            elif now >= incident['paged_at'] + self.cooldown:
+                event = PAGE
+            elif not incident['escalated'] and self.escalation_factor and \
+                    total >= incident['paged_total'] * self.escalation_factor:
+                event = ESCALATE
+                incident['escalated'] = True
+            if event == PAGE:
+                incident.update(paged_at=now, paged_total=total,
+                                escalated=False)
+            changed = event is not None or incident['state'] != FIRING
+            incident.update(state=FIRING, below_since=None)
+        elif incident is None:
+            return None
+        elif incident['state'] == FIRING:
+            incident.update(state=COOLDOWN, below_since=now)
+            changed = True
+        elif now >= incident['below_since'] + self.recovery:
+            del self.incidents[key]
+            event = RECOVERED
+            changed = True
+        else:
+            changed = False
+
+        if changed:
+            self.save()
+        return event
+
+    def save(self):
+        """
+        Writes the incidents to the state file, if there is one.
+        """
+        if self.path is None:
+            return
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as handle:
+                json.dump(self.incidents, handle)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as exc:
+            logging.warn('Could not save pager state to %s: %s',
+                         self.path, exc)
@@ -0,0 +1,377 @@
+"""
+The daemon's pipelines: each builds its own queue, rate and buffer from the
+settings and runs its processors and flush scheduler, and the listeners hand
+them what arrives on their sockets.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import os
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+import gevent
+import gevent.socket
+
+from failnozzle import sinks, udpstats
+from failnozzle.buffer import MessageBuffer
+from failnozzle.clock import monotonic
+from failnozzle.config import OVERFLOW_DROP_NEWEST, _build_config, \
+    _check_settings
+from failnozzle.context import _spawn, setting
+from failnozzle.flushing import drop_sampler
+from failnozzle.history import History
+from failnozzle.listener import Listener
+from failnozzle.mail import NewErrorNotifier
+from failnozzle.paging import PagerState
+from failnozzle.processing import MessageQueue, processor
+from failnozzle.rates import KindRate, MessageRate
+from failnozzle.render import RenderPool
+from failnozzle.scheduler import FlushScheduler
+from failnozzle.seen import SeenSet
+from failnozzle.sharding import ShardedMessageBuffer, ShardedMessageQueue, \
+    _partitions
+from failnozzle.spool import Spool
+
+# Pylint doesn't grasp gevent and socket.
+# pylint: disable=E1101
+
+
+def _create_queue_rate_buffer():
+    """
+    Setup our MessageQueue, MessageRate, and MessageBuffer.
+
+    returns (message_queue, message_rate, message_buffer)
+    """
+    subject_template, body_template = _load_templates()
+
+    history = None
+    if setting('HISTORY_DB', None):
+        history = History(setting('HISTORY_DB'),
+                          setting('HISTORY_RETENTION_DAYS') * 86400)
+
+    seen = None
+    if setting('SEEN_SET_FILE', None):
+        seen = SeenSet(setting('SEEN_SET_FILE'), setting('SEEN_SET_BITS'),
+                       setting('SEEN_SET_HASHES'))
+
+    shards = setting('MESSAGE_BUFFER_SHARDS', 1)
+    if shards > 1:
+        message_buffer = ShardedMessageBuffer(subject_template, body_template,
+                                              shards, history=history,
+                                              seen=seen)
+        queue_class = ShardedMessageQueue
+    else:
+        message_buffer = MessageBuffer(subject_template, body_template,
+                                       history=history, seen=seen)
+        queue_class = MessageQueue
+    if setting('RENDER_POOL_SIZE', 0) > 0:
+        message_buffer.render_pool = RenderPool(setting('RENDER_POOL_SIZE'))
+    message_buffer.sinks = _create_sinks()
+    if seen is not None and setting('NOTIFY_NEW_ERRORS', False):
+        message_buffer.new_listeners.append(
+            NewErrorNotifier(setting('NOTIFY_NEW_ERRORS_LIMIT')))
+    kind_rate = None
+    if setting('PAGER_KIND_LIMITS', {}) or \
+            setting('PAGER_DEFAULT_KIND_LIMIT', None) is not None:
+        kind_rate = KindRate(setting('PAGER_WINDOW_SIZE'),
+                             setting('PAGER_KIND_LIMITS', {}),
+                             setting('PAGER_DEFAULT_KIND_LIMIT', None),
+                             setting('PAGER_SKETCH_WIDTH'),
+                             setting('PAGER_SKETCH_DEPTH'),
+                             setting('FLUSH_SECONDS'))
+    pager_state = PagerState(setting('PAGER_STATE_FILE', None),
+                             setting('PAGER_COOLDOWN_SECONDS'),
+                             setting('PAGER_ESCALATION_FACTOR'),
+                             setting('PAGER_RECOVERY_SECONDS'))
+    message_rate = MessageRate(setting('PAGER_WINDOW_SIZE'),
+                               setting('PAGER_LIMIT'), kind_rate, pager_state,
+                               setting('FLUSH_SECONDS'))
+
+    message_queue = queue_class(
+        message_buffer,
+        maxsize=setting('MESSAGE_QUEUE_MAX_SIZE', 0),
+        policy=setting('MESSAGE_QUEUE_OVERFLOW_POLICY', OVERFLOW_DROP_NEWEST))
+    return (message_queue, message_rate, message_buffer)
+
+
+def _create_sinks():
+    """
+    Builds the digest sinks named by the settings, followed by any in
+    DIGEST_SINKS.
+    """
+    digest_sinks = []
+    if setting('JSON_DIGEST_FILE', None):
+        digest_sinks.append(sinks.JsonFileSink(setting('JSON_DIGEST_FILE')))
+    if setting('WEBHOOK_URL', None):
+        digest_sinks.append(sinks.WebhookSink(
+            setting('WEBHOOK_URL'),
+            timeout=setting('WEBHOOK_TIMEOUT_SECONDS'),
+            retries=setting('WEBHOOK_RETRIES'),
+            max_batch=setting('WEBHOOK_MAX_BATCH'),
+            max_queued=setting('WEBHOOK_MAX_QUEUED'),
+            workers=setting('WEBHOOK_CONNECTIONS')))
+    digest_sinks.extend(setting('DIGEST_SINKS', []))
+    return digest_sinks
+
+
+def _load_templates():
+    """
+    Compiles the email templates named by the settings in a fresh
+    environment, so edited template files are picked up. Compiled templates
+    are cached in TEMPLATE_CACHE_DIR, if set, and only recompiled when they
+    change.
+
+    returns (subject_template, body_template)
+    """
+    # Find the template directory, either our directory or user specified
+    default_template_dir = os.path.dirname(__file__)
+    template_dir = setting('EMAIL_TEMPLATE_DIR', default_template_dir)
+
+    bytecode_cache = None
+    cache_dir = setting('TEMPLATE_CACHE_DIR', None)
+    if cache_dir:
+        # Never the shared temporary directory, where others could plant
+        # compiled templates.
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    env = Environment(loader=FileSystemLoader(template_dir),
+                      bytecode_cache=bytecode_cache)
+
+    subject_template = env.get_template(setting('EMAIL_SUBJECT_TEMPLATE'))
+    body_template = env.get_template(setting('EMAIL_BODY_TEMPLATE'))
+    return subject_template, body_template
+
+
+class Pipeline(object):
+    """
+    One of the independent pipelines (see PIPELINES) sharing the daemon: its
+    own queue, rate, buffer, processors, and flush scheduler, working with
+    the settings in `overrides` (a dict of setting name to value) in place of
+    the global ones. The default pipeline, named None, has no overrides.
+
+    Code run while the pipeline is active (see `active`), including any
+    greenlet it spawns with _spawn, sees its settings through setting and
+    current_config.
+    """
+    def __init__(self, name, overrides):
+        self.name = name
+        self.overrides = dict(overrides)
+        # The kinds of error this pipeline takes from its UDP_BIND, or empty
+        # for every kind no other pipeline there takes.
+        self.kinds = frozenset(self.overrides.get('KINDS') or ())
+        # Its own settings snapshot; None for the default pipeline, which
+        # uses the global one.
+        self.config = None
+        self.message_queue = None
+        self.message_rate = None
+        self.message_buffer = None
+        self.processors = []
+        self.scheduler = None
+
+    def __repr__(self):
+        return '<Pipeline %s>' % (self.name or 'default')
+
+    @contextmanager
+    def active(self):
+        """
+        A context manager for running code on behalf of this pipeline.
+        """
+        current = gevent.getcurrent()
+        previous = getattr(current, 'failnozzle_pipeline', None)
+        current.failnozzle_pipeline = self
+        try:
+            yield
+        finally:
+            current.failnozzle_pipeline = previous
+
+    def start(self):
+        """
+        Takes a snapshot of the pipeline's settings, builds its queue, rate
+        and buffer, and starts its processors (one per shard) and the loop
+        that triggers flushing.
+        """
+        with self.active():
+            if self.name is not None:
+                self.config = _check_settings(_build_config(self.overrides))
+            self.message_queue, self.message_rate, self.message_buffer = \
+                _create_queue_rate_buffer()
+            self.processors = [_spawn(processor, shard_queue, shard_buffer)
+                               for shard_queue, shard_buffer
+                               in _partitions(self.message_queue,
+                                              self.message_buffer)]
+            self.scheduler = FlushScheduler(self.message_buffer,
+                                            self.message_rate)
+            self.scheduler.start()
+
+    def finish(self, timeout):
+        """
+        Flushes one last time, then closes the digest sinks, giving each up
+        to `timeout` seconds, and stops the render pool's workers. Returns
+        True if the final flush finished.
+        """
+        with self.active():
+            flushed = self.scheduler.stop(timeout)
+            if not flushed:
+                logging.warn('Gave up waiting for the final flush of %r '
+                             'after %d seconds', self, timeout)
+            for sink in self.message_buffer.sinks:
+                if not sink.close(timeout):
+                    logging.warn('Gave up on undelivered digests for %r',
+                                 sink)
+            if self.message_buffer.render_pool is not None:
+                self.message_buffer.render_pool.close()
+        return flushed
+
+
+class PipelineRouter(object):
+    """
+    Stands in for the message queue of a Listener whose UDP_BIND is shared by
+    `pipelines`, or that feeds a pipeline with KINDS: puts each record on
+    the queue of the pipeline whose KINDS include the record's kind, or else
+    of the one without KINDS. Records no pipeline takes are dropped and
+    counted in `unrouted`.
+    """
+    def __init__(self, pipelines):
+        self.pipelines = pipelines
+        self.by_kind = {}
+        self.catch_all = None
+        for pipeline in pipelines:
+            if pipeline.kinds:
+                self.by_kind.update((kind, pipeline)
+                                    for kind in pipeline.kinds)
+            else:
+                self.catch_all = pipeline
+        self.unrouted = 0
+
+    def put(self, record):
+        """
+        Queues `record` on its pipeline's queue. Never blocks.
+        """
+        pipeline = self.by_kind.get(record.get('kind'), self.catch_all)
+        if pipeline is None:
+            self.unrouted += 1
+            logging.debug('No pipeline takes kind %r, dropping',
+                          record.get('kind'))
+            return
+        with pipeline.active():
+            pipeline.message_queue.put(record)
+
+    def qsize(self):
+        """
+        Returns the number of records queued across the pipelines.
+        """
+        return sum(pipeline.message_queue.qsize()
+                   for pipeline in self.pipelines)
+
+
+def _create_pipelines():
+    """
+    Builds a Pipeline for each entry in PIPELINES, in order of name, or just
+    the default pipeline if there are none.
+    """
+    named = setting('PIPELINES', {})
+    if not named:
+        return [Pipeline(None, {})]
+    return [Pipeline(name, overrides)
+            for name, overrides in sorted(named.items())]
+
+
+def _group_by_bind(pipelines):
+    """
+    Returns lists of the pipelines sharing each distinct UDP_BIND.
+    """
+    groups = OrderedDict()
+    for pipeline in pipelines:
+        with pipeline.active():
+            bind = tuple(setting('UDP_BIND'))
+        groups.setdefault(bind, []).append(pipeline)
+    return list(groups.values())
+
+
+def _listen(pipelines):
+    """
+    Binds a socket to the UDP_BIND of `pipelines` and starts a Listener on
+    it. The socket and spool are set up with the settings of the first
+    pipeline, whose buffer also merges relayed batches and notes the
+    socket's drops. Returns the Listener.
+    """
+    with pipelines[0].active():
+        # Create a socket to listen to incoming messages.
+        socket = gevent.socket.socket(family=gevent.socket.AF_INET,
+                                      type=gevent.socket.SOCK_DGRAM)
+        if setting('UDP_RECEIVE_BUFFER_BYTES', None):
+            granted = udpstats.set_receive_buffer(
+                socket, setting('UDP_RECEIVE_BUFFER_BYTES'))
+            if granted < setting('UDP_RECEIVE_BUFFER_BYTES'):
+                logging.warn('Asked for a %d byte receive buffer but got %d; '
+                             'raise net.core.rmem_max',
+                             setting('UDP_RECEIVE_BUFFER_BYTES'), granted)
+        logging.info('Receive buffer is %d bytes',
+                     udpstats.receive_buffer(socket))
+        socket.bind(setting('UDP_BIND'))
+        logging.info('Listening on %r for %r', setting('UDP_BIND'),
+                     pipelines)
+        message_buffer = pipelines[0].message_buffer
+        _spawn(drop_sampler, udpstats.DropCounter(socket), message_buffer)
+
+        # As messages arrive, unpack them and put them into the queue,
+        # spooling them to disk first if the processors fall behind.
+        spool = None
+        if setting('SPOOL_FILE', None):
+            spool = Spool(setting('SPOOL_FILE'), setting('SPOOL_BYTES'))
+        if len(pipelines) == 1 and not pipelines[0].kinds:
+            message_queue = pipelines[0].message_queue
+        else:
+            message_queue = PipelineRouter(pipelines)
+        listener = Listener(socket, message_queue, message_buffer, spool,
+                            setting('SPOOL_HIGH_WATER'))
+        listener.start()
+    return listener
+
+
+def shutdown_pipelines(listeners, pipelines):
+    """
+    Stops without losing messages that were accepted: stops listening,
+    handles the packets already waiting in the sockets, lets the processors
+    empty the queues (and the spools, if any; what's left of them is kept
+    for the next start), then flushes each pipeline one last time. Reading
+    and processing get SHUTDOWN_DRAIN_SECONDS, and the final flushes (with
+    their email) SHUTDOWN_FLUSH_SECONDS, as do the digest sinks to deliver
+    what they have.
+
+    Returns True if everything finished in time.
+    """
+    logging.info('Shutting down')
+    deadline = monotonic() + setting('SHUTDOWN_DRAIN_SECONDS')
+    for listener in listeners:
+        drained = listener.stop(deadline)
+        logging.info('Read %d waiting packets', drained)
+
+    def waiting():
+        "Returns True while there are records left to process"
+        return any(pipeline.message_queue.qsize() for pipeline in pipelines) \
+            or any(listener.spool is not None and len(listener.spool)
+                   for listener in listeners)
+
+    while waiting() and monotonic() < deadline:
+        gevent.sleep(0.01)
+    unprocessed = sum(pipeline.message_queue.qsize()
+                      for pipeline in pipelines)
+    for pipeline in pipelines:
+        gevent.killall(pipeline.processors)
+    if unprocessed:
+        logging.warn('Gave up on %d unprocessed messages', unprocessed)
+    for listener in listeners:
+        spooled = listener.close_spool()
+        if spooled:
+            logging.warn('Left %d packets in the spool for the next start',
+                         spooled)
+
+    finishing = [gevent.spawn(pipeline.finish,
+                              setting('SHUTDOWN_FLUSH_SECONDS'))
+                 for pipeline in pipelines]
+    gevent.joinall(finishing)
+    flushed = all(greenlet.value for greenlet in finishing)
+    logging.info('Shut down')
+    return flushed and not unprocessed
@@ -0,0 +1,253 @@
+"""
+Queueing incoming records and turning them into unique messages.
+"""
+import hashlib
+import logging
+
+import gevent
+import gevent.queue
+
+from failnozzle.compat import iteritems, text_type
+from failnozzle.config import OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, \
+    OVERFLOW_POLICIES, OVERFLOW_SHED_DUPLICATES, current_config
+
+# Pylint doesn't grasp gevent and socket.
+# pylint: disable=E1101
+
+
+class MessageQueue(object):
+    """
+    A queue of incoming records between the listener and the processor,
+    bounded to `maxsize` records (or unbounded if `maxsize` is 0).
+
+    When the queue is full an incoming record is handled according to
+    `policy`:
+
+    * OVERFLOW_DROP_NEWEST: the incoming record is shed.
+    * OVERFLOW_DROP_OLDEST: the oldest queued record is shed to make room.
+    * OVERFLOW_SHED_DUPLICATES: the incoming record is shed only if its unique
+      message is already in `message_buffer`; new unique messages are always
+      admitted, even past `maxsize`.
+
+    Every shed record is counted by kind in `message_buffer`, so the next
+    report says what was lost.
+    """
+    def __init__(self, message_buffer, maxsize=0,
+                 policy=OVERFLOW_DROP_NEWEST):
+        assert policy in OVERFLOW_POLICIES, \
+            'Unknown overflow policy %r' % policy
+        self.queue = gevent.queue.Queue()
+        self.message_buffer = message_buffer
+        self.maxsize = maxsize
+        self.policy = policy
+
+    def full(self):
+        """
+        Returns True if the queue is at (or past) its bound.
+        """
+        return bool(self.maxsize) and self.queue.qsize() >= self.maxsize
+
+    def qsize(self):
+        """
+        Returns the number of queued records.
+        """
+        return self.queue.qsize()
+
+    def put(self, record):
+        """
+        Queues `record`, applying the overflow policy if the queue is full.
+        Never blocks.
+        """
+        if self.full():
+            if self.policy == OVERFLOW_DROP_OLDEST:
+                self._shed(self.queue.get_nowait())
+            elif self.policy == OVERFLOW_SHED_DUPLICATES:
+                unique, _ = _record_to_unique(record, current_config())
+                if self.message_buffer.contains(unique):
+                    self._shed(record)
+                    return
+            else:
+                self._shed(record)
+                return
+        self.queue.put_nowait(record)
+
+    def get(self):
+        """
+        Removes and returns the oldest record, blocking until there is one.
+        """
+        return self.queue.get()
+
+    def _shed(self, record):
+        """
+        Counts a shed record against its kind.
+        """
+        self.message_buffer.add_shed(record.get('kind'))
+
+
+def processor(message_queue, message_buffer):
+    """
+    Processes incoming messages from a queue, adding them to a MessageBuffer
+    and tracking their rate with a MessageRate.
+    """
+    while True:
+        try:
+            _process_one_message(message_queue, message_buffer,
+                                 current_config())
+
+        # Except being killed at shutdown.
+        except gevent.GreenletExit:
+            raise
+
+        # We want to catch everything.
+        except:  # pylint: disable=W0702
+            logging.error(
+                "Unhandled exception while processing message, "
+                "will attempt to log")
+            try:
+                # in case something is being pickled / unpickled even
+                # at this level, protect against error while logging
+                # the exception.
+                logging.exception("Unhandled exception details")
+
+            # Again, want to catch everything.
+            # pylint: disable=W0702
+            except:
+                # ok, we give.
+                logging.error(
+                    "Could not log unhandled exception safely, sorry.")
+
+
+def _process_one_message(message_queue, message_buffer, config=None):
+    """
+    Try to pull / process a single message from the queue.
+    """
+    # Get the next message from the queue.
+    next_message = message_queue.get()
+    logging.debug('Processing incoming message')
+
+    unique, source = _record_to_unique(next_message, config)
+
+    message_buffer.add(unique, source)
+    logging.debug('Done processing incoming message')
+
+
+def _record_to_unique(next_message, config=None):
+    """
+    Extract the fields to dedupe over from an incoming record into a
+    UniqueMessage, using the settings snapshot `config` (by default, the
+    current one).
+
+    returns (unique_message, source)
+    """
+    config = config or current_config()
+    source = next_message.get(config.source_field_name, None)
+
+    # We want to extract only fields that exist in UniqueMessage.
+    fields = config.unique_fields
+    message_params = {k: v for k, v in iteritems(next_message)
+                      if k in fields}
+
+    # If the message for this log entry spans multiple lines clip it at the
+    # first.
+    msg_str = message_params.get('message')
+    if msg_str and '\n' in msg_str:
+        if not message_params.get('exc_text'):
+            message_params['exc_text'] = msg_str
+        msg_str = msg_str[:msg_str.index('\n')]
+        message_params['message'] = msg_str
+
+    exc_text = message_params.get('exc_text')
+    if exc_text and config.exc_text_keep is not None:
+        message_params['exc_text'] = _truncate_exc_text(exc_text,
+                                                        *config.exc_text_keep)
+
+    return _package_unique_message(message_params, config), source
+
+
+# What replaces the middle of a traceback cut by _truncate_exc_text.
+_ELIDED_MARKER = u'\n[... %d characters elided, sha1 %s ...]\n'
+
+
+def _truncate_exc_text(exc_text, keep_lines, keep_bytes):
+    """
+    Returns `exc_text` cut to its first and last `keep_lines` lines, with at
+    most `keep_bytes` characters at either end (None for no limit). The
+    middle is replaced by a marker with its length and a hash of it, so
+    tracebacks that differ only there stay different. Text that wouldn't get
+    shorter is returned as it is.
+    """
+    length = len(exc_text)
+    if (keep_bytes is None or length <= 2 * keep_bytes) and \
+            (keep_lines is None or
+             exc_text.count('\n') <= 2 * keep_lines):
+        return exc_text
+
+    head_end, tail_start = length, 0
+    if keep_lines is not None:
+        newline = -1
+        for _ in range(keep_lines):
+            newline = exc_text.find('\n', newline + 1)
+            if newline == -1:
+                break
+        if newline != -1:
+            head_end = newline
+        newline = length
+        for _ in range(keep_lines):
+            newline = exc_text.rfind('\n', 0, newline)
+            if newline == -1:
+                break
+        if newline != -1:
+            tail_start = newline + 1
+    if keep_bytes is not None:
+        head_end = min(head_end, keep_bytes)
+        tail_start = max(tail_start, length - keep_bytes)
+
+    middle = exc_text[head_end:tail_start]
+    digest = hashlib.sha1(middle.encode('utf-8') if
+                          isinstance(middle, text_type) else middle)
+    marker = _ELIDED_MARKER % (len(middle), digest.hexdigest()[:12])
+    if len(marker) >= len(middle):
+        return exc_text
+    return exc_text[:head_end] + marker + exc_text[tail_start:]
+
+
+def _package_unique_message(message_params, config=None):
+    """
+    Safely package message_params as a UniqueMessage, ensuring that
+    all fields are present and accounted for.
+    """
+    config = config or current_config()
+    return config.unique_msg_tuple(**_ensure_message_params(message_params,
+                                                            config))
+
+
+def _ensure_message_params(message_params, config=None):
+    """
+    Ensure that the message parameters we are given are a super set of the
+    supported message parameters. If any parameters are missing, fill in None
+    for that key.
+    """
+    config = config or current_config()
+    all_params = dict(message_params)
+
+    # We want to make sure we got all fields, or fill in with None.
+    # pylint: disable=W0212
+    for field in config.unique_msg_tuple._fields:
+        if field not in all_params:
+            logging.warn(
+                "No specified field for %s, using None", field)
+            all_params[field] = None
+
+    return all_params
+
+
+def _make_fake_record(count, exception):
+    """
+    Make a fake record, making sure that all UniqueMessage fields are
+    filled in, so we don't get any untoward exceptions that break
+    everything.
+    """
+    # Get the overridden function for creating a fake record or our default.
+    config = current_config()
+    return _ensure_message_params(
+        config.INTERNAL_ERROR_FUNC(count, exception), config)
@@ -0,0 +1,139 @@
+"""
+Tracking error rates over a window of flushes, for paging.
+"""
+from collections import defaultdict, namedtuple
+
+from failnozzle.clock import monotonic
+from failnozzle.compat import iteritems
+from failnozzle.paging import PagerState
+from failnozzle.sketch import WindowedSketch
+
+
+class MessageRate(object):
+    """
+    Tracks the rate of incoming messages, determining whether the number of
+    messages received within a window exceeds a threshold.
+
+    The window is the last `window` flushes, or, given the seconds of a
+    `period` (normally FLUSH_SECONDS), the flushes of the last `window`
+    periods, however far apart the flushes actually were.
+
+    If given a KindRate, `kind_rate`, it tracks rates by kind and source too.
+    `pager_state` (by default, kept in memory only) decides when going over
+    the limits pages.
+    """
+    def __init__(self, window, limit, kind_rate=None, pager_state=None,
+                 period=None):
+        self.window = window
+        self.limit = limit
+        self.period = period
+        self.counts = []
+        # When each of the counts was added, with a period.
+        self.times = []
+        self.kind_rate = kind_rate
+        if pager_state is None:
+            pager_state = PagerState()
+        self.pager_state = pager_state
+
+    def add_and_check(self, count, now=None):
+        """
+        Adds a message count, sliding the window if necessary.
+        """
+        if self.period is None:
+            if len(self.counts) >= self.window:
+                self.counts.pop(0)
+        else:
+            now = monotonic() if now is None else now
+            start = now - self.window * self.period
+            while self.times and self.times[0] <= start:
+                self.times.pop(0)
+                self.counts.pop(0)
+            self.times.append(now)
+        self.counts.append(count)
+        total = sum(self.counts)
+        if total >= self.limit:
+            return True, total
+        else:
+            return False, total
+
+    def reset(self):
+        """
+        Resets the recorded counts.
+        """
+        self.counts = []
+        self.times = []
+
+    def add_and_check_kinds(self, counts_by_kind_source, now=None):
+        """
+        Adds a flush's counts by (kind, source), returning a KindAlert for
+        each kind over its limit (none if rates aren't tracked by kind).
+        """
+        if self.kind_rate is None:
+            return []
+        return self.kind_rate.add_and_check(counts_by_kind_source, now)
+
+
+# A kind over its rate limit, with the source sending the most of it.
+# pylint: disable=C0103
+KindAlert = namedtuple('KindAlert', ['kind', 'total', 'limit', 'source',
+                                     'source_total'])
+# pylint: enable=C0103
+
+
+class KindRate(object):
+    """
+    Tracks the rate of incoming messages by kind and by (kind, source) over a
+    window of `window` flushes, in constant memory: counts are kept in a
+    WindowedSketch, so they are estimates that may run slightly high. Given
+    the seconds of a `period` (normally FLUSH_SECONDS), the window is the
+    last `window` periods instead, the flushes within a period sharing its
+    slot of the sketch.
+
+    A kind is over its limit if it sent at least `limits[kind]` (or
+    `default_limit`, if the kind isn't listed and it isn't None) messages
+    within the window.
+    """
+    def __init__(self, window, limits, default_limit=None, width=4096,
+                 depth=4, period=None):
+        self.window = window
+        self.limits = limits
+        self.default_limit = default_limit
+        self.period = period
+        self.sketch = WindowedSketch(window, width, depth)
+
+    def limit(self, kind):
+        """
+        Returns the limit for `kind`, or None if it has none.
+        """
+        return self.limits.get(kind, self.default_limit)
+
+    def add_and_check(self, counts_by_kind_source, now=None):
+        """
+        Starts a new flush in the window, adds its counts by (kind, source),
+        and returns a KindAlert for each kind over its limit.
+        """
+        if self.period is None:
+            self.sketch.advance()
+        else:
+            now = monotonic() if now is None else now
+            self.sketch.advance_to(int(now // self.period))
+        sources_by_kind = defaultdict(list)
+        for (kind, source), count in iteritems(counts_by_kind_source):
+            self.sketch.add(('kind', kind), count)
+            self.sketch.add(('source', kind, source), count)
+            sources_by_kind[kind].append(source)
+
+        alerts = []
+        for kind, sources in sorted(sources_by_kind.items()):
+            limit = self.limit(kind)
+            if limit is None:
+                continue
+            total = self.sketch.estimate(('kind', kind))
+            if total < limit:
+                continue
+            source_total, source = max(
+                (self.sketch.estimate(('source', kind, source)), source)
+                for source in sources)
+            alerts.append(KindAlert(kind, total, limit, source,
+                                    source_total))
+        return alerts
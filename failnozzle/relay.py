@@ -0,0 +1,154 @@
+"""
+Serialization for relay mode, where a failnozzle forwards each flush's
+pre-aggregated counts to an upstream failnozzle instead of emailing them.
+
+A flush becomes one or more batches, each small enough for one UDP packet.
+A batch is RELAY_MAGIC followed by zlib-compressed JSON:
+
+    {"relay": <server name>,
+     "entries": [[{<unique message fields>}, {<source>: <count>, ...},
+                  <first seen>, <last seen>], ...],
+     "shed": {<kind>: <count>, ...},
+     "dropped": <count>}
+
+Shed counts and the datagrams the relay's kernel dropped are sent in the last
+batch of a flush, and are zero or empty in the others. Seen times are
+seconds since the epoch. A unique message with too many sources for one
+batch is sent as several entries, each with some of its sources. The
+upstream recognizes batches by their prefix (log records are plain JSON, so
+they start with "{") and merges them into its own buffer.
+"""
+import json
+import logging
+import zlib
+
+from failnozzle.clock import from_epoch, to_epoch
+from failnozzle.compat import iteritems
+
+
+RELAY_MAGIC = b'FNR1'
+
+# How much of a batch to leave for the envelope around the entries.
+_ENVELOPE_ALLOWANCE = 1024
+
+# The most a received batch may decompress to. Batches are sent at most
+# RELAY_MAX_BATCH_SIZE bytes before compression, which can't be more than a
+# UDP packet.
+MAX_BATCH_BODY = 1024 * 1024
+
+_TRUNCATED_MARKER = u'\n[... truncated by failnozzle relay ...]'
+
+
+def is_batch(data):
+    """
+    Returns True if the packet `data` is a relay batch.
+    """
+    return data.startswith(RELAY_MAGIC)
+
+
+def _encode_entry(unique_message, sources, counts):
+    "JSON-encode one unique message, its counts by source and seen times"
+    # pylint: disable=W0212
+    return json.dumps([unique_message._asdict(), sources,
+                       to_epoch(counts.first_seen),
+                       to_epoch(counts.last_seen)],
+                      separators=(',', ':'))
+
+
+def _fit_entry(unique_message, counts, max_size):
+    """
+    JSON-encode an entry as a list of entries of at most `max_size` bytes
+    each: its exc_text is truncated if that leaves less than half a batch for
+    its sources, and its sources are split across entries if there are too
+    many for one.
+    """
+    encoded = _encode_entry(unique_message, counts.sources, counts)
+    if len(encoded) <= max_size:
+        return [encoded]
+
+    room = max_size // 2
+    bare = _encode_entry(unique_message, {}, counts)
+    exc_text = getattr(unique_message, 'exc_text', None)
+    if len(bare) > room and exc_text:
+        keep = max(0, len(exc_text) - (len(bare) - room) -
+                   len(_TRUNCATED_MARKER) * 2)
+        unique_message = unique_message._replace(
+            exc_text=exc_text[:keep] + _TRUNCATED_MARKER)
+        bare = _encode_entry(unique_message, {}, counts)
+    room = max_size - len(bare)
+
+    entries = []
+    sources = {}
+    size = 0
+    for source, count in iteritems(counts.sources):
+        # "<source>":<count>, as the entry encodes it.
+        item_size = len(json.dumps(source)) + len(json.dumps(count)) + 2
+        if sources and size + item_size > room:
+            entries.append(_encode_entry(unique_message, sources, counts))
+            sources = {}
+            size = 0
+        sources[source] = count
+        size += item_size
+    entries.append(_encode_entry(unique_message, sources, counts))
+    return entries
+
+
+def _finish_batch(server_name, entries, shed, dropped):
+    "Wrap encoded entries in a compressed batch"
+    body = '{"relay":%s,"entries":[%s],"shed":%s,"dropped":%d}' % (
+        json.dumps(server_name), ','.join(entries),
+        json.dumps(shed, separators=(',', ':')), dropped)
+    return RELAY_MAGIC + zlib.compress(body.encode('utf-8'))
+
+
+def encode_batches(counts_by_unique, shed_by_kind, server_name, max_size,
+                   dropped=0):
+    """
+    Encodes a flushed buffer (a dict of unique message to MessageCounts, a
+    dict of kind to shed count, and the number of datagrams the kernel
+    dropped) as a list of batches of at most `max_size` bytes each. A batch
+    that still comes out bigger, which takes an entry bigger than any batch
+    even when split up, is logged and left out.
+    """
+    limit = max_size - _ENVELOPE_ALLOWANCE
+    batches = []
+    entries = []
+    size = 0
+    for unique_message, counts in iteritems(counts_by_unique):
+        for encoded in _fit_entry(unique_message, counts, limit):
+            if entries and size + len(encoded) + 1 > limit:
+                batches.append(_finish_batch(server_name, entries, {}, 0))
+                entries = []
+                size = 0
+            entries.append(encoded)
+            size += len(encoded) + 1
+    if entries or shed_by_kind or dropped:
+        batches.append(_finish_batch(server_name, entries, shed_by_kind,
+                                     dropped))
+
+    fitting = [batch for batch in batches if len(batch) <= max_size]
+    if len(fitting) < len(batches):
+        logging.error('Left out %d relay batches bigger than %d bytes',
+                      len(batches) - len(fitting), max_size)
+    return fitting
+
+
+def decode_batch(data, max_body=MAX_BATCH_BODY):
+    """
+    Decodes a batch, returning (server name, entries, shed by kind, dropped
+    datagrams). Each entry is (unique message fields, counts by source, first
+    seen, last seen), with the seen times as datetimes. Raises ValueError for
+    a batch that decompresses to more than `max_body` bytes.
+    """
+    decompressor = zlib.decompressobj()
+    body = decompressor.decompress(data[len(RELAY_MAGIC):], max_body)
+    if decompressor.unconsumed_tail:
+        raise ValueError('Relay batch decompresses to more than %d bytes' %
+                         max_body)
+    batch = json.loads(body.decode('utf-8'))
+    entries = [(fields, sources, from_epoch(first_seen),
+                from_epoch(last_seen))
+               for fields, sources, first_seen, last_seen
+               in batch['entries']]
+    # Relays from before drops were forwarded don't send them.
+    return batch['relay'], entries, batch['shed'], batch.get('dropped', 0)
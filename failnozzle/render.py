@@ -0,0 +1,249 @@
+"""
+Rendering digests in worker processes.
+
+Rendering is pure CPU, and a digest of thousands of unique errors can hold
+the gevent hub for seconds, during which nothing reads the UDP socket. A
+RenderPool hands big renders to long-lived worker processes (this module run
+with `python -m failnozzle.render`) over pipes, so the flusher greenlet waits
+for the result without blocking anything else.
+
+A digest's template parameters are sent as a compact snapshot: the unique
+messages as plain tuples plus their field names, and each message's counts
+reduced to what templates use (total, first and last seen, and sources),
+all pickled and compressed.
+"""
+from collections import namedtuple
+import logging
+import os
+import struct
+import sys
+import traceback
+import zlib
+
+from failnozzle.compat import pickle
+
+
+_LENGTH = struct.Struct('>I')
+
+
+class CountsSnapshot(object):
+    """
+    The parts of a MessageCounts that templates use.
+    """
+    def __init__(self, total, sources_sorted, first_seen, last_seen,
+                 distinct_sources, sources_approximate):
+        self.total = total
+        self.sources_sorted = sources_sorted
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.distinct_sources = distinct_sources
+        self.sources_approximate = sources_approximate
+
+    @property
+    def sources(self):
+        "Counts by source, as sources_sorted has them"
+        return dict(self.sources_sorted)
+
+
+def encode_params(params):
+    """
+    Serializes a digest's template parameters (see MessageBuffer.flush).
+    """
+    params = dict(params)
+    sorted_counts = params.pop('sorted_counts')
+    new_messages = params.pop('new_messages')
+    trends = params.pop('trends')
+
+    uniques = [unique for unique, _ in sorted_counts]
+    # pylint: disable=W0212
+    fields = type(uniques[0])._fields if uniques else ()
+    snapshot = dict(
+        params=params,
+        unique_type=type(uniques[0]).__name__ if uniques else None,
+        fields=fields,
+        uniques=[tuple(unique) for unique in uniques],
+        counts=[(counts.total, counts.sources_sorted, counts.first_seen,
+                 counts.last_seen, counts.distinct_sources,
+                 counts.sources_approximate)
+                for _, counts in sorted_counts],
+        new=[i for i, unique in enumerate(uniques) if unique in new_messages],
+        trends=None if trends is None else
+        [trends.get(unique, 0) for unique in uniques])
+    return zlib.compress(pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+
+
+def decode_params(data):
+    """
+    Rebuilds template parameters from encode_params. Unique messages become
+    namedtuples with the same name and fields as the originals.
+    """
+    snapshot = pickle.loads(zlib.decompress(data))
+    params = snapshot['params']
+    if snapshot['fields']:
+        unique_type = namedtuple(snapshot['unique_type'], snapshot['fields'])
+        uniques = [unique_type(*values) for values in snapshot['uniques']]
+    else:
+        uniques = []
+    params['sorted_counts'] = [
+        (unique, CountsSnapshot(*counts))
+        for unique, counts in zip(uniques, snapshot['counts'])]
+    params['new_messages'] = set(uniques[i] for i in snapshot['new'])
+    if snapshot['trends'] is None:
+        params['trends'] = None
+    else:
+        params['trends'] = dict(zip(uniques, snapshot['trends']))
+    return params
+
+
+def _write_frame(handle, payload):
+    "Writes a length-prefixed payload"
+    handle.write(_LENGTH.pack(len(payload)) + payload)
+    handle.flush()
+
+
+def _read_frame(handle):
+    "Reads a length-prefixed payload, or returns None at end of file"
+    header = handle.read(_LENGTH.size)
+    if len(header) < _LENGTH.size:
+        return None
+    length, = _LENGTH.unpack(header)
+    payload = handle.read(length)
+    if len(payload) < length:
+        return None
+    return payload
+
+
+class RenderError(Exception):
+    """
+    A worker failed to render a digest.
+    """
+    pass
+
+
+class RenderPool(object):
+    """
+    Up to `size` worker processes for rendering digests, started as needed.
+    """
+    def __init__(self, size):
+        # Imported here so that workers don't need gevent.
+        import gevent.queue
+        self.size = size
+        self.started = 0
+        self.idle = gevent.queue.Queue()
+
+    def _start_worker(self):
+        """
+        Starts a worker process.
+        """
+        import gevent.subprocess
+        package_dir = os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [package_dir] + [path for path in
+                             env.get('PYTHONPATH', '').split(os.pathsep)
+                             if path])
+        return gevent.subprocess.Popen(
+            [sys.executable, '-m', 'failnozzle.render'],
+            stdin=gevent.subprocess.PIPE, stdout=gevent.subprocess.PIPE,
+            env=env, close_fds=True)
+
+    def _get_worker(self):
+        """
+        Returns an idle worker, starting one if there are fewer than `size`,
+        or else waiting for one to finish.
+        """
+        if self.idle.empty() and self.started < self.size:
+            self.started += 1
+            try:
+                return self._start_worker()
+            except Exception as exc:
+                self.started -= 1
+                logging.exception('Could not start a render worker: %s', exc)
+                raise
+        return self.idle.get()
+
+    def render(self, subject_template, body_template, params):
+        """
+        Renders compiled Jinja templates with `params` in a worker, returning
+        (subject, body). Blocks only the calling greenlet.
+        """
+        request = pickle.dumps(
+            (subject_template.environment.loader.searchpath,
+             subject_template.name, body_template.name,
+             encode_params(params)), pickle.HIGHEST_PROTOCOL)
+        worker = self._get_worker()
+        try:
+            _write_frame(worker.stdin, request)
+            reply = _read_frame(worker.stdout)
+        except Exception as exc:
+            logging.exception('Lost a render worker: %s', exc)
+            self._discard(worker)
+            raise
+        if reply is None:
+            self._discard(worker)
+            raise RenderError('Render worker exited')
+        self.idle.put(worker)
+        status, result = pickle.loads(reply)
+        if status != 'ok':
+            raise RenderError(result)
+        return result
+
+    def _discard(self, worker):
+        """
+        Stops a worker that can't be trusted any more.
+        """
+        self.started -= 1
+        try:
+            worker.kill()
+            worker.wait()
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Stops the idle workers.
+        """
+        while not self.idle.empty():
+            worker = self.idle.get()
+            worker.stdin.close()
+            worker.wait()
+            self.started -= 1
+
+
+def worker_main(stdin=None, stdout=None):
+    """
+    Renders requests from `stdin` (by default, the standard input) until it
+    closes, replying on `stdout` (the standard output).
+    """
+    # The binary streams under the text ones, on Python 3.
+    if stdin is None:
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    if stdout is None:
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    # Imported here so the parent doesn't need jinja2 to import this module.
+    from jinja2 import Environment, FileSystemLoader
+    environments = {}
+    while True:
+        request = _read_frame(stdin)
+        if request is None:
+            return
+        try:
+            searchpath, subject_name, body_name, data = pickle.loads(request)
+            key = tuple(searchpath)
+            if key not in environments:
+                environments[key] = Environment(
+                    loader=FileSystemLoader(searchpath))
+            env = environments[key]
+            params = decode_params(data)
+            reply = ('ok', (env.get_template(subject_name).render(params),
+                            env.get_template(body_name).render(params)))
+        # Any failure goes back to the parent rather than killing the worker.
+        # pylint: disable=W0703
+        except Exception:
+            reply = ('error', traceback.format_exc())
+        _write_frame(stdout, pickle.dumps(reply, pickle.HIGHEST_PROTOCOL))
+
+
+if __name__ == '__main__':
+    worker_main()
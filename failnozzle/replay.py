@@ -0,0 +1,291 @@
+"""
+Replays archived log records through failnozzle's dedupe and digests, offline.
+
+    python -m failnozzle.replay [--config FILE] [--output-dir DIR] \\
+        [--flush-seconds N] records.jsonl[.gz] ...
+
+Each line of the input is one JSON log record, as AggregatorHandler sends
+them. Records go through the same decoding, UNIQUE_MSG_TUPLE extraction and
+MessageBuffer as in the server, but nothing touches the network: time is
+the records' own `created` timestamps, and a digest is written (to stdout, or
+a file per digest in the output directory) for each FLUSH_SECONDS window of
+them that had any records. A record without a `created` time is taken to
+have arrived with the record before it (or, before any record has one, with
+the first that does). Useful for postmortems and for trying out settings
+against real traffic.
+
+Input is read in large chunks and decoded a chunk at a time, and each chunk's
+records are counted up before being added to the buffer.
+"""
+from datetime import datetime
+from optparse import OptionParser
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+from failnozzle import settings
+from failnozzle.buffer import MessageBuffer
+from failnozzle.compat import PY3, iteritems, text_type
+from failnozzle.config import _validate_settings, current_config
+from failnozzle.context import setting
+from failnozzle.pipeline import _load_templates
+from failnozzle.processing import _record_to_unique
+
+
+_CHUNK_BYTES = 4 * 1024 * 1024
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+def open_records(path):
+    """
+    Opens a JSONL file for reading, decompressing it if it is gzipped.
+    """
+    with open(path, 'rb') as handle:
+        compressed = handle.read(len(_GZIP_MAGIC)) == _GZIP_MAGIC
+    if compressed:
+        return gzip.open(path, 'rb')
+    return io.open(path, 'rb', buffering=_CHUNK_BYTES)
+
+
+def read_chunks(handle, chunk_bytes=_CHUNK_BYTES):
+    """
+    Yields lists of the non-blank lines in `handle`, about `chunk_bytes` at a
+    time.
+    """
+    leftover = b''
+    while True:
+        data = handle.read(chunk_bytes)
+        if not data:
+            break
+        lines = (leftover + data).split(b'\n')
+        leftover = lines.pop()
+        lines = [line for line in lines if line.strip()]
+        if lines:
+            yield lines
+    if leftover.strip():
+        yield [leftover]
+
+
+def decode_chunk(lines):
+    """
+    Decodes a list of JSON lines, in one call to json.loads unless one of them
+    is bad. Returns (records, number of bad lines).
+    """
+    try:
+        return json.loads(b'[' + b','.join(lines) + b']'), 0
+    except ValueError:
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+        return records, len(lines) - len(records)
+
+
+class Replay(object):
+    """
+    Feeds decoded records into `message_buffer`, flushing it through
+    `emit(subject, report, window_start)` at the end of each window of
+    `flush_seconds`, as measured by the records' `created` times.
+    """
+    def __init__(self, message_buffer, flush_seconds, emit):
+        self.message_buffer = message_buffer
+        self.flush_seconds = flush_seconds
+        self.emit = emit
+        self.window_start = None
+        self.now = None
+        self.records = 0
+        self.digests = 0
+        # Records without a created time, and records that weren't records
+        # at all.
+        self.undated = 0
+        self.skipped = 0
+        # Undated records seen before any dated one.
+        self.held = []
+        # Counts for the current chunk: unique message to
+        # [counts by source, first seen, last seen].
+        self.pending = {}
+        self.config = current_config()
+        self.defaults = vars(logging.makeLogRecord({}))
+
+    def add(self, records):
+        """
+        Adds a chunk of decoded records, flushing whenever one falls past the
+        end of the current window.
+        """
+        for obj in records:
+            if not isinstance(obj, dict):
+                self.skipped += 1
+                continue
+            created = obj.get('created')
+            if isinstance(created, (int, float)):
+                self.now = created
+                self._add_held()
+            else:
+                self.undated += 1
+                if self.now is None:
+                    self.held.append(obj)
+                    continue
+            self._add_one(obj)
+        self._add_pending()
+
+    def _add_one(self, obj):
+        "Adds a record at the current time"
+        if self.window_start is None:
+            self.window_start = self.now
+        elif self.now >= self.window_start + self.flush_seconds:
+            self.flush()
+            skipped = (self.now - self.window_start) // self.flush_seconds
+            self.window_start += skipped * self.flush_seconds
+        # The same as logging.makeLogRecord(obj), without building a
+        # LogRecord each time.
+        record = dict(self.defaults)
+        record.update(obj)
+        unique, source = _record_to_unique(record, self.config)
+        entry = self.pending.get(unique)
+        if entry is None:
+            self.pending[unique] = [{source: 1}, self.now, self.now]
+        else:
+            entry[0][source] = entry[0].get(source, 0) + 1
+            entry[2] = self.now
+        self.records += 1
+
+    def _add_held(self):
+        "Adds the undated records held until there was a time for them"
+        held, self.held = self.held, []
+        for obj in held:
+            self._add_one(obj)
+
+    def _add_pending(self):
+        "Adds the current chunk's counts to the buffer"
+        for unique, (sources, first_seen, last_seen) in \
+                iteritems(self.pending):
+            self.message_buffer.add_counts(
+                unique, sources, datetime.fromtimestamp(first_seen),
+                datetime.fromtimestamp(last_seen))
+        self.pending.clear()
+
+    def flush(self):
+        """
+        Ends the current window, emitting its digest if it had any records.
+        """
+        if self.held:
+            # None of the records had a time, so they arrived now.
+            self.now = time.time()
+            self._add_held()
+        self._add_pending()
+        subject, report, _ = self.message_buffer.flush()
+        if report:
+            self.digests += 1
+            self.emit(subject, report, self.window_start)
+
+
+def _window_name(window_start):
+    "Formats the start of a window for file names and headers"
+    return datetime.fromtimestamp(window_start).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def _decode(text):
+    "Decodes rendered text that came back as bytes"
+    if isinstance(text, text_type):
+        return text
+    return text.decode('utf-8', 'replace')
+
+
+def stdout_emitter(stream=sys.stdout):
+    """
+    Returns an emit function that writes digests to `stream`, one after
+    another.
+    """
+    def emit(subject, report, window_start):
+        "Writes a digest"
+        text = u'Window: %s\nSubject: %s\n\n%s\n\n' % (
+            _window_name(window_start), _decode(subject), _decode(report))
+        stream.write(text if PY3 else text.encode('utf-8'))
+    return emit
+
+
+def file_emitter(output_dir):
+    """
+    Returns an emit function that writes each digest to its own file in
+    `output_dir`, named for the start of its window.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    def emit(subject, report, window_start):
+        "Writes a digest"
+        path = os.path.join(output_dir,
+                            'digest-%s.txt' % _window_name(window_start))
+        with open(path, 'wb') as handle:
+            handle.write((u'Subject: %s\n\n%s\n' % (
+                _decode(subject), _decode(report))).encode('utf-8'))
+    return emit
+
+
+def replay(paths, flush_seconds, emit):
+    """
+    Replays the JSONL files at `paths`, in order, emitting a digest per
+    window. Returns the Replay.
+    """
+    subject_template, body_template = _load_templates()
+    message_buffer = MessageBuffer(subject_template, body_template)
+    run = Replay(message_buffer, flush_seconds, emit)
+    bad = 0
+    for path in paths:
+        handle = open_records(path)
+        try:
+            for lines in read_chunks(handle):
+                records, chunk_bad = decode_chunk(lines)
+                bad += chunk_bad
+                run.add(records)
+        finally:
+            handle.close()
+    run.flush()
+    if bad:
+        logging.warn('Skipped %d lines that were not JSON', bad)
+    if run.skipped:
+        logging.warn('Skipped %d lines that were not log records',
+                     run.skipped)
+    if run.undated:
+        logging.warn('Timed %d records without a created time by the '
+                     'records before them', run.undated)
+    return run
+
+
+def main(argv=None):
+    """
+    Parses the command line and replays the files it names.
+    """
+    parser = OptionParser(usage='%prog [options] FILE.jsonl[.gz] ...')
+    parser.add_option('--config', help='a failnozzle config file to use')
+    parser.add_option('--output-dir',
+                      help='write each digest to a file in this directory '
+                           'instead of stdout')
+    parser.add_option('--flush-seconds', type='float',
+                      help='window length (default FLUSH_SECONDS)')
+    options, paths = parser.parse_args(argv)
+    if not paths:
+        parser.error('Give at least one file to replay')
+
+    logging.basicConfig(level=logging.INFO, format=setting('LOG_FORMAT'))
+    settings.load(options.config)
+    _validate_settings()
+
+    if options.output_dir:
+        emit = file_emitter(options.output_dir)
+    else:
+        emit = stdout_emitter()
+    run = replay(paths, options.flush_seconds or setting('FLUSH_SECONDS'),
+                 emit)
+    logging.info('Replayed %d records into %d digests', run.records,
+                 run.digests)
+
+
+if __name__ == '__main__':
+    main()
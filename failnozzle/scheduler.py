@@ -0,0 +1,162 @@
+"""
+Deciding when to flush.
+"""
+import logging
+
+import gevent
+import gevent.event
+
+from failnozzle.clock import monotonic
+from failnozzle.context import _spawn, setting
+from failnozzle.flushing import check_rates, flusher
+from failnozzle.mail import pager
+
+# Pylint doesn't grasp gevent and socket.
+# pylint: disable=E1101
+
+
+class FlushScheduler(object):
+    """
+    Decides when to flush, replacing a fixed FLUSH_SECONDS sleep:
+
+    * Flushes are scheduled FLUSH_SECONDS apart on the monotonic clock,
+      measured from the start of the previous flush, so slow flushes don't
+      make the schedule drift. A flush never starts while the previous one is
+      still running.
+    * A never before seen error, or more than PAGER_LIMIT messages arriving
+      since the last flush (a spike), triggers an early flush, though never
+      sooner than FLUSH_MIN_SECONDS after the previous one.
+    * While a flood lasts (a spike, or at least FLUSH_FLOOD_MESSAGES in a
+      flush), the interval doubles at each flush, up to FLUSH_MAX_SECONDS,
+      and early flushes are suppressed, giving fewer, bigger digests. It
+      drops back to FLUSH_SECONDS once the flood is over.
+    * Ticks with nothing to report don't flush at all, though they still
+      count toward the pager window.
+    """
+    def __init__(self, message_buffer, message_rate):
+        self.message_buffer = message_buffer
+        self.message_rate = message_rate
+        self.interval = setting('FLUSH_SECONDS')
+        self.last_flush = monotonic()
+        self.flusher_greenlet = None
+        self.urgent_reason = None
+        self.wakeup = gevent.event.Event()
+        self.greenlet = None
+
+    @property
+    def flooding(self):
+        """
+        True if the interval has been stretched by a flood.
+        """
+        return self.interval > setting('FLUSH_SECONDS')
+
+    def new_error(self, unique_message):
+        """
+        A MessageBuffer new-listener: asks for an early flush.
+        """
+        logging.debug('New error %r, asking for an early flush',
+                      getattr(unique_message, 'message', None))
+        self.urgent('new error')
+
+    def urgent(self, reason):
+        """
+        Asks for an early flush.
+        """
+        if self.urgent_reason is None:
+            self.urgent_reason = reason
+        self.wakeup.set()
+
+    def _reason_to_flush(self, now):
+        """
+        Returns why we should flush now, or None if we shouldn't yet.
+        """
+        if now >= self.last_flush + self.interval:
+            return 'scheduled'
+        if self.flooding or \
+                now < self.last_flush + setting('FLUSH_MIN_SECONDS'):
+            return None
+        if self.urgent_reason is None and \
+                self.message_buffer.accounting.added >= setting('PAGER_LIMIT'):
+            self.urgent_reason = 'spike'
+        return self.urgent_reason
+
+    def wait(self):
+        """
+        Waits until it's time to flush, returning the reason.
+        """
+        while True:
+            now = monotonic()
+            reason = self._reason_to_flush(now)
+            if reason is not None:
+                return reason
+            # Wake up for the schedule, to check for spikes, or when a new
+            # error asks for an early flush.
+            timeout = min(self.last_flush + self.interval,
+                          now + setting('FLUSH_POLL_SECONDS')) - now
+            self.wakeup.wait(max(timeout, 0))
+            self.wakeup.clear()
+
+    def flush(self, reason):
+        """
+        Flushes (unless there's nothing to report), then adjusts the interval.
+        """
+        if self.flusher_greenlet is not None:
+            self.flusher_greenlet.join()
+        self.last_flush = monotonic()
+        self.urgent_reason = None
+        accounting = self.message_buffer.accounting
+        added = accounting.added
+
+        if added == 0 and not accounting.total_shed and \
+                not accounting.dropped:
+            logging.debug('Nothing to flush, skipping')
+            # The rates still need to know, so incidents can recover.
+            notices = check_rates(self.message_buffer, self.message_rate)
+            if notices:
+                _spawn(pager, notices)
+        else:
+            logging.debug('Triggering %s flush', reason)
+            self.flusher_greenlet = _spawn(flusher, self.message_buffer,
+                                           self.message_rate)
+
+        # A spike gets one early flush; after that it's treated as a flood.
+        if added >= setting('FLUSH_FLOOD_MESSAGES') or reason == 'spike':
+            self.interval = min(self.interval * 2,
+                                setting('FLUSH_MAX_SECONDS'))
+        else:
+            self.interval = setting('FLUSH_SECONDS')
+
+    def run(self):
+        """
+        Flushes forever.
+        """
+        while True:
+            self.flush(self.wait())
+
+    def start(self):
+        """
+        Runs the scheduler in a background greenlet, with early flushes for
+        new errors.
+        """
+        self.message_buffer.new_listeners.append(self.new_error)
+        self.greenlet = _spawn(self.run)
+
+    def stop(self, timeout):
+        """
+        Stops scheduling flushes and flushes one last time, waiting up to
+        `timeout` seconds for that flush (and any flush already running) to
+        finish. Returns True if they finished.
+        """
+        if self.greenlet is not None:
+            self.greenlet.kill()
+        final_greenlet = _spawn(self._final_flush)
+        final_greenlet.join(timeout)
+        return final_greenlet.ready()
+
+    def _final_flush(self):
+        """
+        Waits for any running flush, then flushes.
+        """
+        if self.flusher_greenlet is not None:
+            self.flusher_greenlet.join()
+        flusher(self.message_buffer, self.message_rate)
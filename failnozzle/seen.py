@@ -0,0 +1,106 @@
+"""
+A persistent, fixed-size set of every unique message failnozzle has seen, so
+that brand new errors can be told apart from recurring ones.
+
+The set is a Bloom filter over message fingerprints kept in a memory-mapped
+file: membership checks and inserts are O(1), the file survives restarts, and
+its size is fixed no matter how long the history gets. The price is a small
+false positive rate (a new error occasionally looks recurring), which grows
+as the filter fills: with the default 8M bits and 7 hashes it stays under 1%
+up to roughly 800,000 distinct errors.
+"""
+import logging
+import mmap
+import os
+import struct
+
+from failnozzle.compat import PY3, xrange
+
+
+_MAGIC = b'FNSEEN1\0'
+_HEADER = struct.Struct('<8sQI')
+_HEADER_SIZE = 32
+
+# Indexing an mmap gives a one byte string on Python 2, and an int on
+# Python 3.
+if PY3:
+    _ord = _chr = int
+else:
+    _ord, _chr = ord, chr
+
+
+class SeenSet(object):
+    """
+    A Bloom filter of `bits` bits using `hashes` hash functions, stored in the
+    file at `path`. A file created with different parameters is replaced.
+    """
+    def __init__(self, path, bits, hashes):
+        self.path = path
+        self.bits = bits
+        self.hashes = hashes
+        size = _HEADER_SIZE + (bits + 7) // 8
+        header = _HEADER.pack(_MAGIC, bits, hashes)
+
+        if not self._has_header(header, size):
+            if os.path.exists(path):
+                logging.warn('Replacing seen-set %s, its size or format '
+                             'changed', path)
+            with open(path, 'wb') as handle:
+                handle.write(header.ljust(_HEADER_SIZE, b'\0'))
+                handle.truncate(size)
+
+        self.handle = open(path, 'r+b')
+        self.map = mmap.mmap(self.handle.fileno(), size)
+
+    def _has_header(self, header, size):
+        "Return True if the file exists with the expected header and size"
+        if not os.path.exists(self.path) or \
+                os.path.getsize(self.path) != size:
+            return False
+        with open(self.path, 'rb') as handle:
+            return handle.read(len(header)) == header
+
+    def _positions(self, fingerprint):
+        """
+        Yields the bit positions for a hex fingerprint (at least 128 bits),
+        using double hashing.
+        """
+        first = int(fingerprint[:16], 16)
+        step = int(fingerprint[16:32], 16) | 1
+        for i in xrange(self.hashes):
+            yield (first + i * step) % self.bits
+
+    def __contains__(self, fingerprint):
+        for position in self._positions(fingerprint):
+            byte = self.map[_HEADER_SIZE + (position >> 3)]
+            if not _ord(byte) & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, fingerprint):
+        """
+        Adds a fingerprint, returning True if it was not already in the set.
+        """
+        new = False
+        for position in self._positions(fingerprint):
+            offset = _HEADER_SIZE + (position >> 3)
+            byte = _ord(self.map[offset])
+            mask = 1 << (position & 7)
+            if not byte & mask:
+                new = True
+                self.map[offset] = _chr(byte | mask)
+        return new
+
+    def sync(self):
+        """
+        Writes changes through to the file.
+        """
+        self.map.flush()
+
+    def close(self):
+        """
+        Writes changes through and closes the file.
+        """
+        self.map.flush()
+        self.map.close()
+        self.handle.close()
@@ -1,10 +1,12 @@
 """
 Settings for failnozzle.
 """
-import imp
 import logging
 import os
 import re
+import sys
+
+from failnozzle.compat import exec_file, load_source
 
 
 ###############################################################################
@@ -18,6 +20,16 @@ import re
 # REPLY_TO = 'error.reporter@yourcompany.com'
 # How often to send aggregated exception emails.
 FLUSH_SECONDS = 60
+# A never before seen error (see SEEN_SET_FILE) or more than PAGER_LIMIT
+# errors since the last email trigger an early email, but no sooner than this
+# after the previous one.
+FLUSH_MIN_SECONDS = 10
+# While errors are flooding in (at least FLUSH_FLOOD_MESSAGES between emails),
+# the time between emails doubles each time, up to FLUSH_MAX_SECONDS.
+FLUSH_FLOOD_MESSAGES = 10000
+FLUSH_MAX_SECONDS = 600
+# How often to check whether an early email is needed.
+FLUSH_POLL_SECONDS = 1
 
 
 ###############################################################################
@@ -27,6 +39,10 @@ FLUSH_SECONDS = 60
 # SMTP_PORT = 465
 # SMTP_USER = 'error.reporter@yourcompany.com'
 # SMTP_PASSWORD = 'drink canada pony solvent'
+# Connect with SMTP over SSL. Set to False for a plain SMTP server (e.g. a
+# local relay or the benchmark suite's sink). Login is skipped when SMTP_USER
+# is empty.
+SMTP_USE_SSL = True
 
 
 ###############################################################################
@@ -47,6 +63,30 @@ FLUSH_SECONDS = 60
 PAGER_WINDOW_SIZE = 5
 PAGER_LIMIT = 100
 
+# Once a rate has paged, don't page about it again for PAGER_COOLDOWN_SECONDS
+# unless it climbs to PAGER_ESCALATION_FACTOR times what it was when paged
+# (once; None to never escalate). A rate that stays under its limit for
+# PAGER_RECOVERY_SECONDS sends one "recovered" page. Ongoing incidents are
+# saved to PAGER_STATE_FILE, if set, so restarting doesn't page again.
+PAGER_COOLDOWN_SECONDS = 1800
+PAGER_ESCALATION_FACTOR = 2
+PAGER_RECOVERY_SECONDS = 600
+PAGER_STATE_FILE = None
+
+# Per-kind paging: a kind listed in PAGER_KIND_LIMITS (kind: limit) pages on
+# its own when it sends that many errors in the same window, and doesn't count
+# towards PAGER_LIMIT. PAGER_DEFAULT_KIND_LIMIT, unless None, applies to every
+# other kind, in addition to PAGER_LIMIT. Pages name the source that sent the
+# most errors of the kind.
+PAGER_KIND_LIMITS = {}
+PAGER_DEFAULT_KIND_LIMIT = None
+# Per-kind and per-source counts are kept in count-min sketches of this many
+# counters per row and rows, so memory is fixed however many sources there
+# are. Counts may run high by about 2 / PAGER_SKETCH_WIDTH of all errors in
+# the window.
+PAGER_SKETCH_WIDTH = 4096
+PAGER_SKETCH_DEPTH = 4
+
 
 ###############################################################################
 # Monitoring Configuration                                                    #
@@ -85,22 +125,136 @@ SOURCE_FIELD_NAME = 'source'
 EMAIL_BODY_TEMPLATE = 'body-template.txt'
 EMAIL_SUBJECT_TEMPLATE = 'subject-template.txt'
 
+# Compiled templates are cached in this directory, so restarts and SIGHUP
+# reloads skip compiling templates that haven't changed. It is created
+# readable by failnozzle's user only if it doesn't exist; don't point it at a
+# directory others can write to. None compiles them every time.
+TEMPLATE_CACHE_DIR = None
+
 # When an internal error occurs we will attempt to communicate using
 # failnozzle. This function will take the parameters count and exception
 # and generate a dict that will eventually be converted to the class set
 # to UNIQUE_MSG_IMPL.
 # INTERNAL_ERROR_FUNC = <internal error func>
 
+###############################################################################
+# History Config                                                              #
+###############################################################################
+# If configured, failnozzle records each flush's counts by unique message and #
+# source in a local SQLite database, and digests show how often each error    #
+# has fired recently.                                                         #
+###############################################################################
+# Path of the SQLite database. None disables the history.
+HISTORY_DB = None
+
+# How long to keep flushes in the history.
+HISTORY_RETENTION_DAYS = 30
+
+# Digests show each error's total over this many previous hours.
+HISTORY_TREND_HOURS = 24
+
+
+###############################################################################
+# New Error Config                                                            #
+###############################################################################
+# If configured, failnozzle remembers every error it has ever seen (in a      #
+# fixed-size file that survives restarts), and digests flag never before     #
+# seen errors and list them first.                                            #
+###############################################################################
+# Path of the seen-set file. None disables new error detection.
+SEEN_SET_FILE = None
+
+# Size of the seen-set (a Bloom filter) in bits, and the number of hashes per
+# error. The defaults take 1MB and keep the chance of mistaking a new error
+# for a recurring one under 1% for up to about 800,000 distinct errors.
+SEEN_SET_BITS = 1 << 23
+SEEN_SET_HASHES = 7
+
+# Also email each new error as soon as it arrives, at most
+# NOTIFY_NEW_ERRORS_LIMIT times per FLUSH_SECONDS.
+NOTIFY_NEW_ERRORS = False
+NOTIFY_NEW_ERRORS_LIMIT = 5
+
+
+###############################################################################
+# Digest Sink Config                                                          #
+###############################################################################
+# Besides being emailed, each digest can be sent as a JSON document (its      #
+# counts, sources, first and last seen times and tracebacks by unique         #
+# message; see sinks.py) to a file or an HTTP endpoint.                       #
+###############################################################################
+# A file to append each digest to, one JSON object per line.
+JSON_DIGEST_FILE = None
+
+# A URL to POST digests to, as gzipped JSON, over up to WEBHOOK_CONNECTIONS
+# keep-alive connections. While the endpoint is slow, digests queue up (at
+# most WEBHOOK_MAX_QUEUED, dropping the oldest) and are sent up to
+# WEBHOOK_MAX_BATCH per request. Failed requests are retried
+# WEBHOOK_RETRIES times, backing off exponentially.
+WEBHOOK_URL = None
+WEBHOOK_TIMEOUT_SECONDS = 10
+WEBHOOK_RETRIES = 3
+WEBHOOK_MAX_BATCH = 10
+WEBHOOK_MAX_QUEUED = 100
+WEBHOOK_CONNECTIONS = 1
+
+# Any other sinks: objects with send(document) and close(timeout) methods.
+DIGEST_SINKS = []
+
+
+###############################################################################
+# Relay Config                                                                #
+###############################################################################
+# In relay mode, instead of emailing digests (or paging), failnozzle sends    #
+# each flush's counts by unique message and source to an upstream failnozzle #
+# that merges them into its own digests, if it accepts relayed batches on    #
+# its UDP port.                                                               #
+###############################################################################
+# Address/port of the upstream failnozzle, e.g. ('failnozzle.example.com',
+# 1549). None disables relay mode.
+RELAY_TO = None
+
+# Largest relayed packet to send. The upstream's INCOMING_MESSAGE_MAX_SIZE
+# must be at least this big.
+RELAY_MAX_BATCH_SIZE = 65000
+
+# Whether to merge batches relayed to this failnozzle. Batches aren't
+# authenticated, so only turn this on where just the relaying failnozzles can
+# reach the UDP port.
+RELAY_ACCEPT = False
+
+
+###############################################################################
+# Pipeline Config                                                             #
+###############################################################################
+# One failnozzle can run several independent pipelines, e.g. one per team,    #
+# each with its own buffer, rate limits, flush schedule, templates and        #
+# recipients, sharing the process and its logs.                               #
+###############################################################################
+# Pipeline name: a dict of the settings that differ for that pipeline, e.g.
+#
+# PIPELINES = {
+#     'payments': {'KINDS': ['billing', 'checkout'],
+#                  'REPORT_TO': 'payments@yourcompany.com',
+#                  'PAGER_LIMIT': 50},
+#     'everything-else': {'FLUSH_SECONDS': 300},
+# }
+#
+# A pipeline gets the errors of the KINDS it lists from its UDP_BIND, or, if
+# it lists none, every kind that no other pipeline on the same UDP_BIND takes.
+# Pipelines sharing a UDP_BIND share its socket and spool, set up with the
+# settings of the first of them by name. Each pipeline needs its own
+# HISTORY_DB, SEEN_SET_FILE and PAGER_STATE_FILE, if it uses them. Empty to
+# run just one pipeline with the settings above.
+PIPELINES = {}
+
+
 ###############################################################################
 # Internal Config                                                             #
 ###############################################################################
-# The name of this server
-if hasattr(os, 'uname'):
-    SERVER_NAME = os.uname()[1]
-else:
-    # In case of Windows
-    import socket
-    SERVER_NAME = socket.gethostname()
+# The name of this server, used in email subjects. None (the default) means
+# this host's name, looked up by load().
+SERVER_NAME = None
 
 # Log configuration of this service.
 LOG_LEVEL = logging.DEBUG
@@ -108,21 +262,137 @@ LOG_FORMAT = '%(asctime)-15s %(levelname)-8s %(message)s'
 
 INCOMING_MESSAGE_MAX_SIZE = 65536
 
+# Tracebacks (exc_text) are cut as they arrive to their first and last
+# EXC_TEXT_KEEP_LINES lines, and to at most EXC_TEXT_KEEP_BYTES characters at
+# either end, bounding what each unique message holds and renders. What was
+# cut is replaced by a line giving its length and hash, so tracebacks that
+# differ only in the middle are still different unique messages. None for
+# either means no such limit.
+EXC_TEXT_KEEP_LINES = 100
+EXC_TEXT_KEEP_BYTES = 16384
+
+# What runs failnozzle: 'gevent', or 'asyncio' (Python 3 only; see aio.py),
+# which doesn't monkey patch and sends email from a pool of
+# ASYNCIO_SEND_THREADS threads. Relay mode, pipelines, the render pool, the
+# spool, webhooks and new error emails need gevent.
+ENGINE = 'gevent'
+ASYNCIO_SEND_THREADS = 4
+
+# Maximum number of decoded messages waiting to be processed (0 for no
+# limit), and what to do with incoming messages when that many are waiting:
+# 'drop_newest' sheds the incoming message, 'drop_oldest' sheds the oldest
+# waiting message, and 'shed_duplicates' sheds the incoming message only if
+# its unique message is already in the buffer (new errors are always
+# admitted). Shed messages are counted by kind in the next digest.
+MESSAGE_QUEUE_MAX_SIZE = 100000
+MESSAGE_QUEUE_OVERFLOW_POLICY = 'drop_newest'
+
+# Number of shards to partition the message buffer into, by unique message.
+# Each shard has its own lock, queue, and processor; flushes combine them into
+# one digest. The queue size limit above is split evenly across the shards.
+MESSAGE_BUFFER_SHARDS = 1
+
+# Approximate bytes the message buffer may hold between digests for each kind
+# listed in BUFFER_KIND_QUOTAS (kind: bytes), and for every other kind
+# (BUFFER_DEFAULT_KIND_QUOTA; None for no limit). Once a kind holds more, its
+# new unique messages are only counted, as overflow, until the next digest;
+# messages already in the buffer keep counting. With shards, each shard gets
+# an even share. The bytes held by kind are logged at each flush and shown in
+# the digest.
+BUFFER_KIND_QUOTAS = {}
+BUFFER_DEFAULT_KIND_QUOTA = None
+
+# Keep a single copy of each exc_text, pathname, kind, and source string held
+# by the message buffer, rather than one per unique message. The table is
+# cleared at each flush.
+INTERN_STRINGS = True
+
+# Keep counts for at most this many sources per unique message (None keeps
+# them all). Past that, digests show an estimate of how many sources there
+# were and the busiest ones, instead of listing every source. Estimates come
+# from a HyperLogLog of 2^SOURCES_HLL_PRECISION bytes, accurate to about
+# 1.04 / sqrt(2^SOURCES_HLL_PRECISION).
+SOURCES_TOP_K = None
+SOURCES_HLL_PRECISION = 10
+
+# Number of worker processes for rendering big digests (0 renders every digest
+# in the server process), and how many unique messages make a digest big.
+# Rendering in the server blocks reading the socket until it's done.
+RENDER_POOL_SIZE = 0
+RENDER_POOL_THRESHOLD = 2000
+
+# A file to spool raw packets to, instead of decoding them, while
+# SPOOL_HIGH_WATER or more messages are waiting to be processed (None to never
+# spool). The spool is a ring of SPOOL_BYTES, and packets are decoded and
+# queued again, in order, as the processors catch up. Packets that don't fit
+# go through the overflow policy above. A spool left behind by a crash or
+# shutdown is replayed at startup.
+SPOOL_FILE = None
+SPOOL_BYTES = 64 * 1024 * 1024
+SPOOL_HIGH_WATER = 10000
+
+# On SIGTERM, how long to spend reading packets already received and
+# processing queued messages, then how long to wait for the final email.
+SHUTDOWN_DRAIN_SECONDS = 10
+SHUTDOWN_FLUSH_SECONDS = 30
+
 # Address/port to listen for messages on.
 UDP_BIND = ('0.0.0.0', 1549)
 
-# Load override files so users only have to specify the necessary parameters.
-base_dir = os.path.dirname(__file__)
+# Size of the kernel's receive buffer for the UDP socket, which absorbs
+# bursts while failnozzle is busy; None keeps the OS default. Linux grants
+# at most net.core.rmem_max, and failnozzle logs what it actually got.
+UDP_RECEIVE_BUFFER_BYTES = None
+# How often to check for datagrams the kernel dropped because the receive
+# buffer was full (Linux only). Drops are logged and noted in the next email.
+UDP_DROP_SAMPLE_SECONDS = 10
+
+# The settings above, before any overrides, for reload_settings_file.
+_DEFAULTS = dict((_name, _value) for _name, _value in list(globals().items())
+                 if _name.isupper() and not _name.startswith('_'))
+
+
+def load(config_file=None):
+    """
+    Loads the settings that depend on where failnozzle runs: the override
+    files next to this module (deploy_settings.py, then local_settings.py,
+    which shouldn't be checked in), then `config_file`, if given, so users
+    only have to specify the necessary parameters. Finally looks up
+    SERVER_NAME if none was set.
+
+    Called from main rather than on import, so that importing failnozzle
+    doesn't run any of these files.
+    """
+    global SERVER_NAME  # pylint: disable=W0603
+    base_dir = os.path.dirname(__file__)
+    for name in ('deploy_settings.py', 'local_settings.py'):
+        override_file = os.path.join(base_dir, name)
+        if os.path.exists(override_file):
+            exec_file(override_file, globals())
+
+    if config_file:
+        import_config_file(config_file)
 
-# Deploy settings
-deploy_file = os.path.join(base_dir, 'deploy_settings.py')
-if os.path.exists(deploy_file):
-    execfile(deploy_file)
+    if SERVER_NAME is None:
+        if hasattr(os, 'uname'):
+            SERVER_NAME = os.uname()[1]
+        else:
+            # In case of Windows
+            import socket
+            SERVER_NAME = socket.gethostname()
 
-# Local dev settings, shouldn't be checked in.
-local_file = os.path.join(base_dir, 'local_settings.py')
-if os.path.exists(local_file):
-    execfile(local_file)
+
+def reload_settings_file(config_file=None):
+    """
+    Loads the settings again, as load does, starting over from the defaults so
+    that settings since removed from the files go back to them.
+    """
+    for name in [name for name in globals()
+                 if name.isupper() and not name.startswith('_')]:
+        if name not in _DEFAULTS:
+            del globals()[name]
+    globals().update(_DEFAULTS)
+    load(config_file)
 
 
 def import_config_file(config_file):
@@ -132,7 +402,9 @@ def import_config_file(config_file):
     """
     if os.path.exists(config_file):
         setting_re = re.compile("^[_A-Z]+$")
-        module = imp.load_source('failnozzle.config_file', config_file)
+        # Load afresh on a reload, rather than into the previous module.
+        sys.modules.pop('failnozzle.config_file', None)
+        module = load_source('failnozzle.config_file', config_file)
 
         # Add all the GLOBAL_SETTINGS in the config_file to this module
         overwrite_count = 0
@@ -141,7 +413,7 @@ def import_config_file(config_file):
                 globals()[name] = getattr(module, name)
                 overwrite_count += 1
 
-        print "Overwrote %s settings" % overwrite_count
+        print("Overwrote %s settings" % overwrite_count)
     else:
-        print "Config file %s not found" % config_file
+        print("Config file %s not found" % config_file)
         exit(1)
@@ -0,0 +1,213 @@
+"""
+Splitting the buffer and queue into shards, each with its own lock and
+processor, that report as one.
+"""
+from contextlib import contextmanager
+
+from failnozzle.buffer import BufferAccounting, MessageBuffer
+from failnozzle.config import OVERFLOW_DROP_NEWEST, Config, current_config
+from failnozzle.context import setting
+from failnozzle.interning import StringInterner
+from failnozzle.processing import MessageQueue
+
+
+_UNSHARDABLE_FIELDS = Config.UNSHARDABLE_FIELDS
+
+
+def _shard_index(values, shards):
+    """
+    Picks a shard for a unique message from the values of its shardable
+    fields (see _shard_values and _record_shard_values).
+    """
+    return hash(values) % shards
+
+
+def _shard_values(unique_message):
+    """
+    Returns the shardable field values of a unique message.
+    """
+    # pylint: disable=W0212
+    return tuple(getattr(unique_message, field)
+                 for field in unique_message._fields
+                 if field not in _UNSHARDABLE_FIELDS)
+
+
+def _record_shard_values(record, config=None):
+    """
+    Returns the shardable field values of a raw incoming record. These match
+    _shard_values of the unique message the record will become, so a record
+    can be routed to its shard without being processed first.
+    """
+    config = config or current_config()
+    return tuple(record.get(field) for field in config.shard_fields)
+
+
+class ShardedMessageBuffer(MessageBuffer):
+    """
+    A MessageBuffer partitioned by unique message into `shards` independent
+    MessageBuffers, each with its own lock, so that several processors can
+    add messages without contending on one lock. Flushing locks every shard
+    and produces one combined report.
+    """
+    # The shards replace the base class's state, so don't call its __init__.
+    # pylint: disable=W0231
+    def __init__(self, subject_template, body_template, shards,
+                 history=None, seen=None):
+        self.subject_template = subject_template
+        self.body_template = body_template
+        self.history = history
+        # The shards share one interner, so a string is held once overall.
+        if setting('INTERN_STRINGS', True):
+            self.interner = StringInterner()
+        else:
+            self.interner = None
+        self.seen = seen
+        self.render_pool = None
+        self.sinks = []
+        self.new_listeners = []
+        self.shards = [MessageBuffer(subject_template, body_template,
+                                     self.interner, seen=seen)
+                       for _ in range(shards)]
+        for shard in self.shards:
+            shard.new_listeners = self.new_listeners
+            shard.accounting.quota_shards = shards
+
+    def shard_for(self, unique_message):
+        """
+        Returns the shard that holds `unique_message`.
+        """
+        return self.shards[_shard_index(_shard_values(unique_message),
+                                        len(self.shards))]
+
+    @contextmanager
+    def locked(self):
+        """
+        Locks every shard, always in the same order.
+        """
+        acquired = []
+        try:
+            for shard in self.shards:
+                shard.lock.acquire()
+                acquired.append(shard)
+            yield
+        finally:
+            for shard in reversed(acquired):
+                shard.lock.release()
+
+    def set_templates(self, subject_template, body_template):
+        """
+        Replaces the templates used by the next flush, keeping the buffered
+        messages.
+        """
+        with self.locked():
+            self.subject_template = subject_template
+            self.body_template = body_template
+            for shard in self.shards:
+                shard.subject_template = subject_template
+                shard.body_template = body_template
+
+    def add(self, unique_message, source):
+        """
+        Adds an occurrance of a unique message from `source` to its shard.
+        """
+        self.shard_for(unique_message).add(unique_message, source)
+
+    def add_counts(self, unique_message, sources, first_seen, last_seen):
+        """
+        Adds pre-aggregated occurrances of a unique message to its shard.
+        """
+        self.shard_for(unique_message).add_counts(unique_message, sources,
+                                                  first_seen, last_seen)
+
+    def add_shed(self, kind, count=1):
+        """
+        Records that `count` messages of `kind` were shed before they could be
+        added.
+        """
+        self.shards[hash(kind) % len(self.shards)].add_shed(kind, count)
+
+    def add_dropped(self, count):
+        """
+        Records that the kernel dropped `count` datagrams before they could be
+        read.
+        """
+        self.shards[0].add_dropped(count)
+
+    def contains(self, unique_message):
+        """
+        Returns True if the buffer already holds `unique_message`.
+        """
+        return self.shard_for(unique_message).contains(unique_message)
+
+    @property
+    def counts_by_unique(self):
+        """
+        The shards' counts combined. Shards never share a unique message, so
+        this is a plain union.
+        """
+        combined = {}
+        for shard in self.shards:
+            combined.update(shard.counts_by_unique)
+        return combined
+
+    @property
+    def new_uniques(self):
+        """
+        The shards' never before seen unique messages combined.
+        """
+        combined = set()
+        for shard in self.shards:
+            combined.update(shard.new_uniques)
+        return combined
+
+    @property
+    def accounting(self):
+        """
+        The shards' accounting combined, as a new BufferAccounting.
+        """
+        combined = BufferAccounting(len(self.shards))
+        for shard in self.shards:
+            combined.merge(shard.accounting)
+        return combined
+
+    def _clear(self):
+        """
+        Forgets all messages in every shard. Callers must hold the lock.
+        """
+        for shard in self.shards:
+            shard._clear()  # pylint: disable=W0212
+
+
+class ShardedMessageQueue(object):
+    """
+    One MessageQueue per shard of a ShardedMessageBuffer. Incoming records are
+    routed to their shard's queue, so each shard can have its own processor.
+    The bound is split evenly across the shards.
+    """
+    def __init__(self, message_buffer, maxsize=0,
+                 policy=OVERFLOW_DROP_NEWEST):
+        shard_maxsize = -(-maxsize // len(message_buffer.shards))
+        self.queues = [MessageQueue(shard, shard_maxsize, policy)
+                       for shard in message_buffer.shards]
+
+    def qsize(self):
+        """
+        Returns the number of queued records across all shards.
+        """
+        return sum(queue.qsize() for queue in self.queues)
+
+    def put(self, record):
+        """
+        Queues `record` on its shard's queue.
+        """
+        values = _record_shard_values(record, current_config())
+        self.queues[_shard_index(values, len(self.queues))].put(record)
+
+
+def _partitions(message_queue, message_buffer):
+    """
+    Returns a list of (queue, buffer) pairs that each need a processor.
+    """
+    if isinstance(message_queue, ShardedMessageQueue):
+        return list(zip(message_queue.queues, message_buffer.shards))
+    return [(message_queue, message_buffer)]
@@ -0,0 +1,270 @@
+"""
+Sinks: where digests go besides email.
+
+At each flush with anything to report, every sink's `send` is called with a
+JSON-able digest document (see digest_document):
+
+    {"server": <server name>, "flushed_at": <ISO 8601>,
+     "total": <n>, "total_unique": <n>, "total_new": <n>,
+     "total_shed": <n>, "shed_by_kind": {<kind>: <n>, ...},
+     "total_dropped": <n>,
+     "total_overflow": <n>, "overflow_by_kind": {<kind>: <n>, ...},
+     "bytes_by_kind": {<kind>: <approximate bytes buffered>, ...},
+     "messages": [{"fingerprint": <hex>, "fields": {<unique message>},
+                   "new": <bool>, "total": <n>,
+                   "sources": {<source>: <n>, ...},
+                   "distinct_sources": <n>, "sources_approximate": <bool>,
+                   "first_seen": <ISO 8601>, "last_seen": <ISO 8601>}, ...]}
+
+A sink is any object with `send(document)` and `close(timeout)`.
+JsonFileSink appends documents to a file, and WebhookSink POSTs them to an
+HTTP endpoint.
+"""
+from datetime import datetime
+import gzip
+import json
+import logging
+
+import gevent
+import gevent.queue
+
+from failnozzle.compat import BytesIO, httplib, urlparse
+from failnozzle.fingerprint import fingerprint
+
+
+def _isoformat(when):
+    "Format a datetime, or None"
+    return when.isoformat() if when is not None else None
+
+
+def digest_document(params, flushed_at=None):
+    """
+    Builds the digest document for a flush from its template parameters (see
+    MessageBuffer.flush).
+    """
+    new_messages = params['new_messages']
+    messages = []
+    for unique, counts in params['sorted_counts']:
+        # pylint: disable=W0212
+        messages.append({
+            'fingerprint': fingerprint(unique),
+            'fields': unique._asdict(),
+            'new': unique in new_messages,
+            'total': counts.total,
+            'sources': dict(counts.sources),
+            'distinct_sources': counts.distinct_sources,
+            'sources_approximate': counts.sources_approximate,
+            'first_seen': _isoformat(counts.first_seen),
+            'last_seen': _isoformat(counts.last_seen)})
+    return {'server': params['server_name'],
+            'flushed_at': _isoformat(flushed_at or datetime.now()),
+            'total': params['total'],
+            'total_unique': params['total_unique'],
+            'total_new': params['total_new'],
+            'total_shed': params['total_shed'],
+            'shed_by_kind': dict(params['shed_by_kind']),
+            'total_dropped': params['total_dropped'],
+            'total_overflow': params['total_overflow'],
+            'overflow_by_kind': dict(params['overflow_by_kind']),
+            'bytes_by_kind': dict(params['bytes_by_kind']),
+            'messages': messages}
+
+
+class JsonFileSink(object):
+    """
+    Appends each digest document to the file at `path`, one JSON object per
+    line.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, document):
+        """
+        Writes a document.
+        """
+        try:
+            with open(self.path, 'a') as handle:
+                handle.write(json.dumps(document, separators=(',', ':')) +
+                             '\n')
+        except (IOError, OSError) as exc:
+            logging.error('Could not write digest to %s: %s', self.path, exc)
+
+    def close(self, _timeout=None):
+        """
+        Nothing to finish: documents are written as they're sent, so the
+        timeout the other sinks take is ignored.
+        """
+        return True
+
+
+class ConnectionPool(object):
+    """
+    Up to `size` idle keep-alive HTTP(S) connections to the host of `url`.
+    """
+    def __init__(self, url, size, timeout):
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.timeout = timeout
+        self.size = size
+        self.idle = []
+
+    def get(self):
+        """
+        Returns an idle connection, or a new one.
+        """
+        if self.idle:
+            return self.idle.pop()
+        return self.connection_class(self.host, self.port,
+                                     timeout=self.timeout)
+
+    def put(self, connection):
+        """
+        Returns a connection that can be reused to the pool.
+        """
+        if len(self.idle) < self.size:
+            self.idle.append(connection)
+        else:
+            connection.close()
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        while self.idle:
+            self.idle.pop().close()
+
+
+class WebhookError(Exception):
+    """
+    A webhook request failed.
+    """
+    def __init__(self, message, retry=True):
+        super(WebhookError, self).__init__(message)
+        self.retry = retry
+
+
+def _gzip(data):
+    "Gzip a string"
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as handle:
+        handle.write(data)
+    return buf.getvalue()
+
+
+class WebhookSink(object):
+    """
+    POSTs digest documents to `url` as gzipped JSON,
+
+        {"digests": [<document>, ...]}
+
+    from `workers` background greenlets sharing a pool of keep-alive
+    connections. Documents queue up while the endpoint is slow and go out
+    together, up to `max_batch` per request; at most `max_queued` wait, and
+    the oldest are dropped past that. A failed request (a connection error,
+    a timeout, or a 5xx or 429 response) is retried up to `retries` times,
+    backing off from `backoff` seconds.
+    """
+    def __init__(self, url, timeout=10, retries=3, max_batch=10,
+                 max_queued=100, workers=1, backoff=1.0):
+        self.url = url
+        parsed = urlparse.urlsplit(url)
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+        self.retries = retries
+        self.max_batch = max_batch
+        self.backoff = backoff
+        self.queue = gevent.queue.Queue(max_queued)
+        self.pool = ConnectionPool(url, workers, timeout)
+        self.busy = 0
+        self.workers = [gevent.spawn(self._work) for _ in range(workers)]
+
+    def send(self, document):
+        """
+        Queues a document for delivery. Never blocks.
+        """
+        if self.queue.full():
+            self.queue.get_nowait()
+            logging.warn('Webhook %s is behind; dropped the oldest digest',
+                         self.url)
+        self.queue.put_nowait(document)
+
+    def _work(self):
+        """
+        Delivers batches of queued documents, forever.
+        """
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self.busy += 1
+            try:
+                self.deliver(batch)
+            finally:
+                self.busy -= 1
+
+    def deliver(self, documents):
+        """
+        POSTs `documents` in one request, retrying failures. Returns True if
+        they were delivered.
+        """
+        body = _gzip(json.dumps({'digests': documents},
+                                separators=(',', ':')).encode('utf-8'))
+        for attempt in range(self.retries + 1):
+            if attempt:
+                gevent.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                self._post(body)
+                return True
+            except WebhookError as exc:
+                logging.warn('Webhook %s failed (attempt %d): %s', self.url,
+                             attempt + 1, exc)
+                if not exc.retry:
+                    break
+        logging.error('Gave up delivering %d digests to webhook %s',
+                      len(documents), self.url)
+        return False
+
+    def _post(self, body):
+        """
+        Makes one request, raising WebhookError if it fails.
+        """
+        connection = self.pool.get()
+        try:
+            connection.request('POST', self.path, body, {
+                'Content-Type': 'application/json',
+                'Content-Encoding': 'gzip',
+                'Connection': 'keep-alive'})
+            response = connection.getresponse()
+            response.read()
+        # Anything from the connection means a broken connection.
+        # pylint: disable=W0703
+        except Exception as exc:
+            connection.close()
+            raise WebhookError('%s: %s' % (type(exc).__name__, exc))
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(connection)
+        if response.status >= 500 or response.status == 429:
+            raise WebhookError('HTTP %d' % response.status)
+        if response.status >= 300:
+            raise WebhookError('HTTP %d' % response.status, retry=False)
+
+    def close(self, timeout):
+        """
+        Waits up to `timeout` seconds for queued documents to be delivered,
+        then stops. Returns True if everything was delivered.
+        """
+        with gevent.Timeout(timeout, False):
+            while not self.queue.empty() or self.busy:
+                gevent.sleep(0.05)
+        delivered = self.queue.empty() and not self.busy
+        gevent.killall(self.workers)
+        self.pool.close()
+        return delivered
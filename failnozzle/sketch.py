@@ -0,0 +1,151 @@
+"""
+Approximate counting in constant memory.
+
+A count-min sketch counts occurrences of any number of keys in a fixed
+`depth` x `width` table: each key increments one counter per row, picked by
+a per-row hash, and its estimate is the smallest of its counters. Estimates
+never undercount, and overcount by at most 2N/width (for N counted in all)
+with probability 1 - 2^-depth.
+
+A HyperLogLog estimates how many distinct keys it has seen, to within about
+1.04 / sqrt(2^precision), in 2^precision bytes.
+"""
+from array import array
+import math
+
+from failnozzle.compat import xrange
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix(key):
+    """
+    Returns a 64 bit hash of `key`, mixed (with MurmurHash3's finalizer) so
+    that every bit of it depends on all of hash(key). Python's own hashes of
+    similar keys differ in few bits.
+    """
+    mixed = hash(key) & _MASK64
+    mixed = ((mixed ^ (mixed >> 33)) * 0xff51afd7ed558ccd) & _MASK64
+    mixed = ((mixed ^ (mixed >> 33)) * 0xc4ceb9fe1a85ec53) & _MASK64
+    return mixed ^ (mixed >> 33)
+
+
+class CountMinSketch(object):
+    """
+    A count-min sketch of `depth` rows of `width` counters.
+    """
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('l', [0]) * width for _ in xrange(depth)]
+
+    def _columns(self, key):
+        """
+        Yields (row, column) for `key` in each row, using double hashing.
+        """
+        mixed = _mix(key)
+        first = mixed & 0xffffffff
+        step = (mixed >> 32) | 1
+        for row in xrange(self.depth):
+            yield self.rows[row], (first + row * step) % self.width
+
+    def add(self, key, count=1):
+        """
+        Counts `count` more occurrences of `key`.
+        """
+        for row, column in self._columns(key):
+            row[column] += count
+
+    def estimate(self, key):
+        """
+        Returns the estimated count of `key`.
+        """
+        return min(row[column] for row, column in self._columns(key))
+
+    def clear(self):
+        """
+        Forgets all counts.
+        """
+        for row in self.rows:
+            row[:] = array('l', [0]) * self.width
+
+
+class WindowedSketch(object):
+    """
+    Counts of keys over a sliding window of `window` periods: a ring of
+    count-min sketches, one per period. Memory is fixed no matter how many
+    keys are counted.
+    """
+    def __init__(self, window, width, depth):
+        self.slots = [CountMinSketch(width, depth) for _ in xrange(window)]
+        self.current = 0
+        # The number of the current period, if advanced to by number.
+        self.period = None
+
+    def advance(self):
+        """
+        Starts a new period, forgetting the oldest one.
+        """
+        self.current = (self.current + 1) % len(self.slots)
+        self.slots[self.current].clear()
+
+    def advance_to(self, period):
+        """
+        Makes period number `period` the current one, forgetting the periods
+        that fall out of the window on the way; does nothing if it already
+        is.
+        """
+        if self.period is not None:
+            for _ in xrange(min(period - self.period, len(self.slots))):
+                self.advance()
+        if self.period is None or period > self.period:
+            self.period = period
+
+    def add(self, key, count=1):
+        """
+        Counts `count` more occurrences of `key` in the current period.
+        """
+        self.slots[self.current].add(key, count)
+
+    def estimate(self, key):
+        """
+        Returns the estimated count of `key` over the window.
+        """
+        return sum(slot.estimate(key) for slot in self.slots)
+
+
+class HyperLogLog(object):
+    """
+    A HyperLogLog of 2^`precision` registers.
+    """
+    def __init__(self, precision):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, key):
+        """
+        Counts `key` as seen.
+        """
+        mixed = _mix(key)
+        # The top bits pick a register, which keeps the longest run of
+        # leading zeros seen in the rest.
+        bits = 64 - self.precision
+        index = mixed >> bits
+        rank = bits - (mixed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self):
+        """
+        Returns the estimated number of distinct keys seen.
+        """
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -register
+                                             for register in self.registers)
+        zeros = self.registers.count(b'\0')
+        # Small counts are better estimated from the empty registers.
+        if estimate <= 2.5 * size and zeros:
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
@@ -0,0 +1,128 @@
+"""
+A memory-mapped ring of raw packets, for when the processors fall behind.
+
+Packets are appended to a fixed-size file as they arrive and popped in the
+same order. The file starts with a header (magic, size, head and tail
+offsets, and count) followed by length-prefixed packets; a packet that
+doesn't fit before the end of the file wraps around to the start, leaving a
+wrap marker behind. Because the head, tail and count live in the file, a
+spool left behind by a crash is picked up where it left off when reopened.
+
+Only the page cache backs the file, so memory use stays bounded: pages the
+kernel needs back are written out rather than swapped.
+"""
+import logging
+import mmap
+import os
+import struct
+
+
+_MAGIC = b'FNSPOOL1'
+_HEADER = struct.Struct('>8sQQQQ')
+_LENGTH = struct.Struct('>I')
+_WRAP = 0xffffffff
+
+
+class Spool(object):
+    """
+    A ring of packets in the file at `path`, of `size` bytes (including the
+    header). An existing spool with packets in it is reopened as it is, at
+    its own size.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.start = _HEADER.size
+        resumed = self._open(path, size)
+        if not resumed:
+            self.size = size
+            self.head = self.tail = self.start
+            self.count = 0
+            self._save_header()
+
+    def _open(self, path, size):
+        """
+        Maps the file, returning True if it held a spool with packets in it.
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.read(fd, _HEADER.size)
+            resumed = False
+            if len(header) == _HEADER.size:
+                magic, old_size, head, tail, count = _HEADER.unpack(header)
+                if magic == _MAGIC and count and \
+                        os.fstat(fd).st_size == old_size:
+                    size, resumed = old_size, True
+                    self.size, self.head, self.tail, self.count = \
+                        old_size, head, tail, count
+                    logging.info('Replaying %d spooled packets from %s',
+                                 count, path)
+            if not resumed:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        return resumed
+
+    def __len__(self):
+        return self.count
+
+    def _save_header(self):
+        "Writes the offsets and count to the file"
+        self.map[:_HEADER.size] = _HEADER.pack(_MAGIC, self.size, self.head,
+                                               self.tail, self.count)
+
+    def append(self, data):
+        """
+        Adds a packet to the end of the spool. Returns False, without adding
+        it, if the spool is full.
+        """
+        needed = _LENGTH.size + len(data)
+        wrapped = self.count and self.tail <= self.head
+        if wrapped:
+            if self.head - self.tail < needed:
+                return False
+        elif self.size - self.tail < needed:
+            # Wrap around, if there's room before the head.
+            if self.head - self.start < needed:
+                return False
+            if self.size - self.tail >= _LENGTH.size:
+                self.map[self.tail:self.tail + _LENGTH.size] = \
+                    _LENGTH.pack(_WRAP)
+            self.tail = self.start
+        end = self.tail + needed
+        self.map[self.tail:end] = _LENGTH.pack(len(data)) + data
+        self.tail = end
+        self.count += 1
+        self._save_header()
+        return True
+
+    def pop(self):
+        """
+        Removes and returns the oldest packet, or None if the spool is empty.
+        """
+        if not self.count:
+            return None
+        if self.size - self.head < _LENGTH.size:
+            self.head = self.start
+        length, = _LENGTH.unpack(
+            self.map[self.head:self.head + _LENGTH.size])
+        if length == _WRAP:
+            self.head = self.start
+            length, = _LENGTH.unpack(
+                self.map[self.head:self.head + _LENGTH.size])
+        begin = self.head + _LENGTH.size
+        data = self.map[begin:begin + length]
+        self.count -= 1
+        if self.count:
+            self.head = begin + length
+        else:
+            self.head = self.tail = self.start
+        self._save_header()
+        return data
+
+    def close(self):
+        """
+        Writes the spool out to disk and unmaps it.
+        """
+        self.map.flush()
+        self.map.close()
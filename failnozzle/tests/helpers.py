@@ -0,0 +1,53 @@
+"""
+Fixtures and builders shared by the tests
+"""
+from datetime import datetime
+import json
+import shutil
+import tempfile
+
+from failnozzle.config import UniqueMessage
+from failnozzle.counts import MessageCounts
+
+
+# Scratch directories made for the running test, the newest last.
+TEMP_DIRS = []
+
+
+def make_temp_dir():
+    "Create a scratch directory for a test"
+    TEMP_DIRS.append(tempfile.mkdtemp(prefix='failnozzle-test-'))
+
+
+def remove_temp_dirs():
+    "Remove the scratch directories"
+    while TEMP_DIRS:
+        shutil.rmtree(TEMP_DIRS.pop())
+
+
+def unique_message(i=1, kind='app', exc_text='exception text', message=None):
+    "Build a UniqueMessage, with the message 'message `i`' unless given one"
+    if message is None:
+        message = 'message %d' % i
+    return UniqueMessage('module', 'funcName', 'filename', message,
+                         'pathname', i, exc_text, kind)
+
+
+def message_counts(sources, first_seen=None, last_seen=None):
+    "Build a MessageCounts with the given counts by source, seen now"
+    now = datetime.now()
+    counts = MessageCounts()
+    counts.merge(sources, first_seen or now, last_seen or now)
+    return counts
+
+
+def record(i=0, kind='app', source='host'):
+    "Build a decoded log record, as the handler sends it, of 'message `i`'"
+    return dict(module='module', funcName='funcName', filename='filename',
+                message='message %d' % i, pathname='pathname', lineno=i,
+                exc_text='exception text', kind=kind, source=source)
+
+
+def packet(i=0, kind='app', source='host'):
+    "Build a log record encoded as it arrives over UDP"
+    return json.dumps(record(i, kind, source)).encode('utf-8')
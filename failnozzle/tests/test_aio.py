@@ -0,0 +1,70 @@
+"""
+Tests for the asyncio engine
+"""
+import socket
+
+from mock import Mock, patch
+from nose import SkipTest
+from nose.tools import eq_, ok_
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from failnozzle.buffer import MessageBuffer
+from failnozzle.processing import MessageQueue
+from failnozzle.rates import MessageRate
+from failnozzle.tests.helpers import packet, record
+
+
+AIO_SETTINGS = dict(SHUTDOWN_DRAIN_SECONDS=5, SHUTDOWN_FLUSH_SECONDS=5,
+                    FLUSH_SECONDS=60, INCOMING_MESSAGE_MAX_SIZE=65536,
+                    SOURCE_FIELD_NAME='source', ASYNCIO_SEND_THREADS=2)
+
+
+@patch.multiple('failnozzle.settings', create=True, **AIO_SETTINGS)
+def test_stop_loses_nothing():
+    """
+    Make sure every packet received before a stop makes the final flush,
+    including those still in the socket and the queue.
+    """
+    if asyncio is None:
+        raise SkipTest('The asyncio engine needs Python 3')
+    from failnozzle.aio import DatagramListener, Engine
+
+    loop = asyncio.new_event_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.setblocking(False)
+    message_buffer = MessageBuffer(Mock(), Mock())
+    message_queue = MessageQueue(message_buffer)
+    engine = Engine(loop, message_queue, MessageRate(5, 100), message_buffer)
+    transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: DatagramListener(engine, sock), sock=sock))
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = sock.getsockname()
+    # Some packets are read and processed...
+    for i in range(50):
+        sender.sendto(packet(i % 7, source='host%d' % (i % 3)), address)
+    loop.run_until_complete(asyncio.sleep(0.1))
+    eq_(50, message_buffer.total)
+    # ...some only queued...
+    for i in range(50, 100):
+        message_queue.put(record(i % 7, source='host%d' % (i % 3)))
+    # ...and some still waiting in the socket.
+    for i in range(100, 150):
+        sender.sendto(packet(i % 7, source='host%d' % (i % 3)), address)
+
+    flushed = []
+
+    def flush_sends(buf, _):
+        "Note how many messages the final flush has"
+        flushed.append(buf.total)
+        return []
+    with patch('failnozzle.aio._flush_sends', flush_sends):
+        ok_(engine.stop(sock, transport))
+    loop.close()
+    sender.close()
+    eq_([150], flushed)
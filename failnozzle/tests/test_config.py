@@ -0,0 +1,234 @@
+"""
+Tests for the settings snapshot and reloading it
+"""
+from collections import namedtuple
+import os
+
+import gevent
+from jinja2 import Environment
+from mock import Mock, patch
+from nose.tools import assert_raises, eq_, ok_, with_setup
+
+from failnozzle import server, settings
+from failnozzle.buffer import MessageBuffer
+from failnozzle.config import Config, _validate_settings, current_config, \
+    install_config
+from failnozzle.mail import is_just_monitoring_error
+from failnozzle.paging import PagerState
+from failnozzle.pipeline import _load_templates
+from failnozzle.rates import MessageRate
+from failnozzle.server import reload_settings
+from failnozzle.sinks import JsonFileSink
+from failnozzle.tests.helpers import TEMP_DIRS, make_temp_dir, \
+    remove_temp_dirs, unique_message
+
+
+# pylint: disable=C0103
+Custom = namedtuple('Custom', ['module', 'message', 'exc_text', 'y'])
+# pylint: enable=C0103
+
+
+class FakeSettings(object):
+    "A stand-in settings module"
+    SOURCE_FIELD_NAME = 'src'
+    INCOMING_MESSAGE_MAX_SIZE = 1024
+    MONITORING_ERROR_MARKERS = ['a.b', 'xyz']
+    lowercase = 'ignored'
+
+
+def test_snapshot():
+    "A Config reads through to settings, with overrides, and derives the rest"
+    config = Config(FakeSettings, {'UNIQUE_MSG_TUPLE': Custom,
+                                   'SOURCE_FIELD_NAME': 'source'})
+    eq_('src', config.SOURCE_FIELD_NAME)
+    eq_('src', config.source_field_name)
+    eq_(1024, config.incoming_message_max_size)
+    eq_(Custom, config.unique_msg_tuple)
+    eq_(frozenset(['module', 'message', 'exc_text', 'y']),
+        config.unique_fields)
+    eq_(('module', 'y'), config.shard_fields)
+    ok_('SOURCE_FIELD_NAME' in config)
+    ok_('lowercase' not in config)
+    eq_(None, config.get('MISSING'))
+    assert_raises(AttributeError, getattr, config, 'MISSING')
+
+    # It is immutable, and doesn't see later changes to the settings.
+    assert_raises(AttributeError, setattr, config, 'SOURCE_FIELD_NAME', 'x')
+    with patch.object(FakeSettings, 'SOURCE_FIELD_NAME', 'other'):
+        eq_('src', config.source_field_name)
+
+
+def test_monitoring_markers():
+    "Monitoring markers are matched literally, and are optional"
+    config = Config(FakeSettings, {})
+    ok_(config.monitoring_marker_re.search(u'has xyz in it'))
+    # Markers are matched literally.
+    ok_(not config.monitoring_marker_re.search(u'aXb'))
+    eq_(None, Config(object, {}).monitoring_marker_re)
+
+
+@patch.multiple('failnozzle.settings', MONITORING_ERROR_MARKERS=['MARK'],
+                create=True)
+def test_is_just_monitoring_error():
+    "A marker in the message or traceback marks a monitoring error"
+    ok_(is_just_monitoring_error(unique_message(exc_text='trace MARK')))
+    ok_(is_just_monitoring_error(unique_message(message='MARK message',
+                                                exc_text=None)))
+    ok_(not is_just_monitoring_error(unique_message(exc_text='trace')))
+
+
+def test_validate_installs_snapshot():
+    "Validating installs a snapshot later edits to settings don't change"
+    try:
+        config = _validate_settings()
+        ok_(current_config() is config)
+        with patch('failnozzle.settings.SOURCE_FIELD_NAME', 'changed'):
+            ok_(current_config().source_field_name != 'changed')
+    finally:
+        install_config(None)
+
+
+def _remove_temp_dirs():
+    "Remove the scratch directories and any installed snapshot"
+    install_config(None)
+    remove_temp_dirs()
+
+
+def _write(name, text):
+    "Write a file in the scratch directory, returning its path"
+    path = os.path.join(TEMP_DIRS[-1], name)
+    with open(path, 'w') as handle:
+        handle.write(text)
+    return path
+
+
+@with_setup(make_temp_dir, _remove_temp_dirs)
+@patch.multiple('failnozzle.settings', SOURCE_FIELD_NAME='source',
+                EMAIL_TEMPLATE_DIR=os.path.dirname(server.__file__),
+                EMAIL_SUBJECT_TEMPLATE='subject-template.txt',
+                EMAIL_BODY_TEMPLATE='body-template.txt', create=True)
+def test_reload():
+    "A reload installs the new settings and templates"
+    _validate_settings()
+    message_buffer = MessageBuffer(Mock(), Mock())
+    message_buffer.add(unique_message(exc_text=None), 'host1')
+    _write('subject.txt', 'new subject')
+    _write('body.txt', 'new body')
+    config_file = _write('config.py',
+                         'SOURCE_FIELD_NAME = "host"\n'
+                         'EMAIL_TEMPLATE_DIR = %r\n'
+                         'EMAIL_SUBJECT_TEMPLATE = "subject.txt"\n'
+                         'EMAIL_BODY_TEMPLATE = "body.txt"\n'
+                         % TEMP_DIRS[-1])
+    ok_(reload_settings(config_file, message_buffer))
+    eq_('host', current_config().source_field_name)
+
+    # The buffered messages are kept and flushed with the new templates.
+    eq_(1, message_buffer.total)
+    subject, report, _ = message_buffer.flush()
+    eq_(('new subject', 'new body'), (subject, report))
+
+
+@with_setup(make_temp_dir, _remove_temp_dirs)
+@patch.dict(settings.__dict__)
+def test_reload_applies_live_settings():
+    """
+    A reload updates the pager and the sinks, puts removed settings back to
+    their defaults, and logs changes that need a restart.
+    """
+    _validate_settings()
+    message_buffer = MessageBuffer(Mock(), Mock())
+    old_sink = Mock()
+    message_buffer.sinks = [old_sink]
+    message_rate = MessageRate(5, 100, pager_state=PagerState())
+    templates = 'EMAIL_TEMPLATE_DIR = %r\n' % os.path.dirname(server.__file__)
+    config_file = _write('config.py', templates +
+                         'PAGER_LIMIT = 7\n'
+                         'PAGER_COOLDOWN_SECONDS = 60\n'
+                         'JSON_DIGEST_FILE = %r\n'
+                         'SOURCES_TOP_K = 50\n'
+                         % os.path.join(TEMP_DIRS[-1], 'digests.jsonl'))
+    with patch('failnozzle.server.logging') as fake_logging:
+        ok_(reload_settings(config_file, message_buffer, (), message_rate))
+    eq_((7, 60), (message_rate.limit, message_rate.pager_state.cooldown))
+    eq_([JsonFileSink], [type(sink) for sink in message_buffer.sinks])
+    gevent.sleep(0)
+    eq_(1, old_sink.close.call_count)
+    fake_logging.warn.assert_called_once_with(
+        'Changes to %s only take effect after a restart', 'SOURCES_TOP_K')
+
+    # Unchanged sink settings keep the same sinks.
+    sinks = message_buffer.sinks
+    ok_(reload_settings(config_file, message_buffer, (), message_rate))
+    ok_(message_buffer.sinks is sinks)
+
+    _write('config.py', templates)
+    ok_(reload_settings(config_file, message_buffer, (), message_rate))
+    eq_(settings._DEFAULTS['PAGER_LIMIT'], message_rate.limit)
+    eq_(None, settings.JSON_DIGEST_FILE)
+    eq_([], message_buffer.sinks)
+
+
+@with_setup(make_temp_dir, _remove_temp_dirs)
+@patch.multiple('failnozzle.settings', SOURCE_FIELD_NAME='source')
+def test_failed_reload_keeps_settings():
+    "A reload that fails leaves the old settings in place"
+    config = _validate_settings()
+    message_buffer = Mock()
+    config_file = _write('config.py',
+                         'SOURCE_FIELD_NAME = "host"\n'
+                         'NEW_SETTING = 1\n'
+                         'UNIQUE_MSG_TUPLE = None\n')
+    ok_(not reload_settings(config_file, message_buffer))
+    ok_(current_config() is config)
+    eq_('source', settings.SOURCE_FIELD_NAME)
+    ok_(not hasattr(settings, 'NEW_SETTING'))
+    ok_(not hasattr(settings, 'UNIQUE_MSG_TUPLE'))
+    eq_(0, message_buffer.set_templates.call_count)
+
+    # A missing config file is a failure too.
+    ok_(not reload_settings(config_file + '.missing', message_buffer))
+    ok_(current_config() is config)
+
+
+@with_setup(make_temp_dir, _remove_temp_dirs)
+@patch.multiple('failnozzle.settings', SERVER_NAME=None)
+def test_load():
+    "Settings are only looked up once loaded, from a config file if given"
+    # Nothing is looked up until the settings are loaded.
+    eq_(None, settings.SERVER_NAME)
+    settings.load()
+    ok_(settings.SERVER_NAME)
+
+    settings.SERVER_NAME = None
+    settings.load(_write('config.py', 'SERVER_NAME = "configured"\n'))
+    eq_('configured', settings.SERVER_NAME)
+
+
+@with_setup(make_temp_dir, _remove_temp_dirs)
+@patch.multiple('failnozzle.settings',
+                EMAIL_TEMPLATE_DIR=os.path.dirname(server.__file__),
+                EMAIL_SUBJECT_TEMPLATE='subject-template.txt',
+                EMAIL_BODY_TEMPLATE='body-template.txt', create=True)
+def test_template_cache():
+    "Compiled templates are cached only in a configured, private directory"
+    with patch('failnozzle.settings.TEMPLATE_CACHE_DIR', TEMP_DIRS[-1]):
+        compiled = _load_templates()
+        eq_(2, len(os.listdir(TEMP_DIRS[-1])))
+        # Loading them again doesn't compile anything.
+        with patch.object(Environment, 'compile',
+                          side_effect=AssertionError):
+            cached = _load_templates()
+    eq_([template.render(server_name='x') for template in compiled],
+        [template.render(server_name='x') for template in cached])
+
+    # A missing directory is created private to the daemon's user.
+    cache_dir = os.path.join(TEMP_DIRS[-1], 'cache')
+    with patch('failnozzle.settings.TEMPLATE_CACHE_DIR', cache_dir):
+        _load_templates()
+    eq_(0o700, os.stat(cache_dir).st_mode & 0o777)
+
+    # By default nothing is cached.
+    with patch('failnozzle.settings.TEMPLATE_CACHE_DIR', None):
+        subject_template, _ = _load_templates()
+    eq_(None, subject_template.environment.bytecode_cache)
@@ -7,8 +7,9 @@ from nose.tools import assert_raises, ok_
 import os
 import sys
 
-from failnozzle.server import _create_queue_rate_buffer, _make_fake_record, \
-    _process_one_message, _validate_settings
+from failnozzle.config import _validate_settings
+from failnozzle.pipeline import _create_queue_rate_buffer
+from failnozzle.processing import _make_fake_record, _process_one_message
 
 
 # Fix path to import failnozzle
@@ -51,12 +52,12 @@ def test_customization_msg_impl():
                                                'src')
 
 
-# Have to patch failnozzle.server rather than jinja2 since these are copied
+# Have to patch failnozzle.pipeline rather than jinja2 since these are copied
 # into the namespace using from/import.
 # jinja2.loaders.FileSystemLoader
-@patch('failnozzle.server.FileSystemLoader')
+@patch('failnozzle.pipeline.FileSystemLoader')
 # jinja2.environement.Environment
-@patch('failnozzle.server.Environment')
+@patch('failnozzle.pipeline.Environment')
 @patch.multiple('failnozzle.settings',
                 EMAIL_TEMPLATE_DIR=CUSTOM_TEMP_DIR,
                 EMAIL_SUBJECT_TEMPLATE=CUSTOM_SUBJECT_TEMP,
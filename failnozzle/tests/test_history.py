@@ -0,0 +1,127 @@
+"""
+Tests for the SQLite history of flushed counts
+"""
+import os
+import threading
+import time
+
+import gevent
+from jinja2.environment import Environment
+from jinja2.loaders import FileSystemLoader
+from nose.tools import eq_, ok_
+
+from failnozzle.buffer import MessageBuffer
+from failnozzle.config import UniqueMessage
+from failnozzle.fingerprint import fingerprint
+from failnozzle.history import History
+from failnozzle.tests.helpers import message_counts, unique_message
+
+
+def test_fingerprint_stable():
+    "Fingerprints depend on the message, not on how its strings are typed"
+    eq_(fingerprint(unique_message(1, 'kind1')),
+        fingerprint(UniqueMessage(u'module', u'funcName', u'filename',
+                                  u'message 1', u'pathname', 1,
+                                  u'exception text', u'kind1')))
+    ok_(fingerprint(unique_message(1, 'kind1')) !=
+        fingerprint(unique_message(2, 'kind0')))
+
+
+def test_history_record_and_query():
+    "Recorded counts are totalled by message, kind and source"
+    history = History(':memory:', 3600)
+    first, second = unique_message(1, 'kind1'), unique_message(2, 'kind0')
+    history.record({first: message_counts({'host1': 2, 'host2': 1}),
+                    second: message_counts({'host1': 4})}, flushed_at=1000)
+    history.record({first: message_counts({'host1': 5})}, flushed_at=2000)
+
+    fp1, fp2 = fingerprint(first), fingerprint(second)
+    eq_({fp1: 8, fp2: 4}, history.totals_since([fp1, fp2], 0))
+    eq_({fp1: 5}, history.totals_since([fp1, fp2], 1500))
+    eq_({'kind1': 8, 'kind0': 4}, history.kind_totals_since(0))
+    eq_({'host1': 7, 'host2': 1}, history.source_totals(fp1))
+
+
+def test_history_compaction():
+    "Flushes older than the retention are dropped, with their messages"
+    history = History(':memory:', 3600)
+    first, second = unique_message(1, 'kind1'), unique_message(2, 'kind0')
+    history.record({first: message_counts({'host1': 1})}, flushed_at=1000)
+    history.record({second: message_counts({'host1': 1})}, flushed_at=2000)
+    history.record({second: message_counts({'host1': 1})}, flushed_at=6000)
+
+    fp1, fp2 = fingerprint(first), fingerprint(second)
+    eq_({fp2: 1}, history.totals_since([fp1, fp2], 0))
+    eq_({}, history.source_totals(fp1))
+    eq_([(fp2,)],
+        list(history.conn.execute('SELECT fingerprint FROM messages')))
+    eq_(1, history.conn.execute('SELECT COUNT(*) FROM flushes').fetchone()[0])
+
+
+def test_flush_shows_trends():
+    """
+    Make sure each flush is recorded and digests show the previous totals.
+    """
+    template_dir = os.path.join(os.path.dirname(__file__), '..')
+    env = Environment(loader=FileSystemLoader(template_dir))
+    history = History(':memory:', 86400)
+    message_buffer = MessageBuffer(env.get_template('subject-template.txt'),
+                                   env.get_template('body-template.txt'),
+                                   history=history)
+
+    for _ in range(3):
+        message_buffer.add(unique_message(1, 'kind1'), 'host1')
+    message_buffer.flush()
+
+    message_buffer.add(unique_message(1, 'kind1'), 'host1')
+    message_buffer.add(unique_message(2, 'kind0'), 'host1')
+    _, report, _ = message_buffer.flush()
+
+    ok_('1X message 1 (in kind1, pathname:1) [3X in previous 24h]' in report)
+    ok_('1X message 2 (in kind0, pathname:2) [0X in previous 24h]' in report)
+    eq_({fingerprint(unique_message(1, 'kind1')): 4},
+        history.totals_since([fingerprint(unique_message(1, 'kind1'))], 0))
+
+
+def test_flush_history_outside_lock():
+    """
+    Make sure the history is read and written in the hub's thread pool,
+    without the buffer locked, while other greenlets keep running.
+    """
+    calls = []
+
+    class SlowHistory(History):
+        "Notes how it's called, and takes a while"
+        def _note(self, name):
+            "Note a call"
+            calls.append((name, message_buffer.lock.locked(),
+                          threading.current_thread().name == 'MainThread'))
+            time.sleep(0.05)
+
+        def totals_since(self, fingerprints, since):
+            self._note('totals_since')
+            return super(SlowHistory, self).totals_since(fingerprints, since)
+
+        def record(self, counts_by_unique, flushed_at=None):
+            self._note('record')
+            return super(SlowHistory, self).record(counts_by_unique,
+                                                   flushed_at)
+
+    template_dir = os.path.join(os.path.dirname(__file__), '..')
+    env = Environment(loader=FileSystemLoader(template_dir))
+    history = SlowHistory(':memory:', 86400)
+    message_buffer = MessageBuffer(env.get_template('subject-template.txt'),
+                                   env.get_template('body-template.txt'),
+                                   history=history)
+    message_buffer.add(unique_message(1, 'kind1'), 'host1')
+
+    ticks = []
+    ticker = gevent.spawn(lambda: [(ticks.append(1), gevent.sleep(0.01))
+                                   for _ in range(1000)])
+    gevent.spawn(message_buffer.flush).get()
+    ticker.kill()
+
+    eq_([('totals_since', False, False), ('record', False, False)], calls)
+    ok_(len(ticks) > 2)
+    eq_({fingerprint(unique_message(1, 'kind1')): 1},
+        history.totals_since([fingerprint(unique_message(1, 'kind1'))], 0))
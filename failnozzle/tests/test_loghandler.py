@@ -0,0 +1,103 @@
+"""
+Tests for the logging handler applications send messages with
+"""
+import json
+import logging
+import os
+import socket
+
+from mock import patch
+from nose.tools import eq_, ok_, with_setup
+
+from failnozzle.config import _build_config
+from failnozzle.loghandler import AggregatorHandler
+from failnozzle.processing import _record_to_unique
+from failnozzle.replay import replay
+from failnozzle.tests.helpers import TEMP_DIRS, make_temp_dir, \
+    remove_temp_dirs
+
+
+def _logger(handler):
+    "A logger that only sends to `handler`"
+    logger = logging.getLogger('failnozzle.tests.loghandler')
+    logger.propagate = False
+    logger.handlers = [handler]
+    return logger
+
+
+def test_lean_packet():
+    "Only the fields failnozzle uses are sent, and the server can read them"
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(5)
+    handler = AggregatorHandler('localhost', receiver.getsockname()[1],
+                                u'host1', 'app')
+    logger = _logger(handler)
+    try:
+        with patch('socket.gethostbyname',
+                   side_effect=socket.gethostbyname) as gethostbyname:
+            try:
+                raise ValueError('bad value')
+            except ValueError:
+                # An extra that can't be serialized doesn't get in the way.
+                logger.exception(u'Failed on %s', u'caf\xe9',
+                                 extra={'unserializable': object()})
+            logger.error('Plain %d', 42)
+        eq_(1, gethostbyname.call_count)
+        packets = [json.loads(receiver.recv(65536).decode('utf-8'))
+                   for _ in range(2)]
+    finally:
+        handler.close()
+        receiver.close()
+
+    first, second = packets
+    eq_(set(['source', 'kind', 'pathname', 'filename', 'module', 'message',
+             'created', 'funcName', 'lineno', 'exc_text']), set(first))
+    eq_((u'host1', u'app', u'Failed on caf\xe9', u'test_lean_packet'),
+        (first['source'], first['kind'], first['message'],
+         first['funcName']))
+    ok_(first['exc_text'].endswith('ValueError: bad value'),
+        first['exc_text'])
+    eq_((u'Plain 42', None), (second['message'], second['exc_text']))
+    eq_(first['pathname'], second['pathname'])
+
+    # The server turns it into a unique message as it would a full record.
+    unique, source = _record_to_unique(
+        vars(logging.makeLogRecord(second)), _build_config())
+    eq_(u'host1', source)
+    eq_((u'Plain 42', u'app', u'test_loghandler'),
+        (unique.message, unique.kind, unique.module))
+
+
+def test_custom_fields():
+    "Extra fields can be sent, and the fixed ones aren't sent twice"
+    handler = AggregatorHandler('localhost', 1549, 'host1', 'app',
+                                fields=('funcName', 'lineno', 'exc_text',
+                                        'customer', 'kind'))
+    record = logging.makeLogRecord({'msg': 'message', 'customer': 7})
+    packet = json.loads(handler.makePickle(record).decode('ascii'))
+    eq_(7, packet['customer'])
+    eq_('app', packet['kind'])
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+@patch.multiple('failnozzle.settings', create=True, SERVER_NAME='replay')
+def test_replay_handler_output():
+    "What the handler sends can be archived and replayed"
+    handler = AggregatorHandler('localhost', 1549, 'host1', 'app')
+    packets = []
+    logger = _logger(handler)
+    with patch.object(handler, 'send', packets.append):
+        for i in range(3):
+            logger.error('Failed %d', i % 2)
+    path = os.path.join(TEMP_DIRS[-1], 'records.jsonl')
+    with open(path, 'wb') as handle:
+        handle.write(b'\n'.join(packets))
+    digests = []
+    run = replay([path], 60, lambda subject, report, start:
+                 digests.append((subject, start)))
+    eq_((3, 0), (run.records, run.undated))
+    eq_(1, len(digests))
+    subject, start = digests[0]
+    ok_(subject.startswith('replay errors: 3 total, 2 unique'), subject)
+    eq_(json.loads(packets[0].decode('ascii'))['created'], start)
@@ -0,0 +1,112 @@
+"""
+Tests for deciding when to page
+"""
+import os
+
+from mock import Mock, patch
+from nose.tools import eq_, with_setup
+
+from failnozzle.buffer import MessageBuffer
+from failnozzle.flushing import PageNotice, check_rates
+from failnozzle.mail import pager
+from failnozzle.paging import COOLDOWN, ESCALATE, FIRING, PAGE, RECOVERED, \
+    RESOLVED, PagerState
+from failnozzle.rates import MessageRate
+from failnozzle.tests.helpers import TEMP_DIRS, make_temp_dir, \
+    remove_temp_dirs, unique_message
+
+
+def test_incident():
+    "An incident pages once, escalates once, and recovers after a quiet spell"
+    state = PagerState(cooldown=100, escalation_factor=2, recovery=30)
+    eq_(None, state.update('global', False, 0, now=0))
+    eq_(PAGE, state.update('global', True, 10, now=10))
+    eq_(FIRING, state.state('global'))
+
+    # Repeats are suppressed, but climbing escalates, once.
+    eq_(None, state.update('global', True, 15, now=20))
+    eq_(ESCALATE, state.update('global', True, 20, now=30))
+    eq_(None, state.update('global', True, 80, now=40))
+
+    # A dip below the limit and back doesn't page again...
+    eq_(None, state.update('global', False, 5, now=50))
+    eq_(COOLDOWN, state.state('global'))
+    eq_(None, state.update('global', True, 12, now=60))
+    eq_(FIRING, state.state('global'))
+
+    # ...unless the cooldown has passed.
+    eq_(PAGE, state.update('global', True, 12, now=110))
+
+    # Recovering takes a quiet spell.
+    eq_(None, state.update('global', False, 5, now=120))
+    eq_(None, state.update('global', False, 5, now=140))
+    eq_(RECOVERED, state.update('global', False, 0, now=150))
+    eq_(RESOLVED, state.state('global'))
+    eq_(None, state.update('global', False, 0, now=160))
+    eq_([], state.keys())
+
+
+def test_no_escalation():
+    "Without an escalation factor, climbing rates don't page again"
+    state = PagerState(cooldown=100, escalation_factor=None, recovery=30)
+    eq_(PAGE, state.update('kind:db', True, 10, now=0))
+    eq_(None, state.update('kind:db', True, 1000, now=10))
+    eq_(['kind:db'], state.keys('kind:'))
+    eq_([], state.keys('global'))
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+def test_survives_restart():
+    "Pager state is kept in its file across restarts"
+    path = os.path.join(TEMP_DIRS[-1], 'pager.json')
+    state = PagerState(path, cooldown=100, recovery=30)
+    eq_(PAGE, state.update('global', True, 10, now=0))
+
+    state = PagerState(path, cooldown=100, recovery=30)
+    eq_(None, state.update('global', True, 10, now=10))
+    eq_(None, state.update('global', False, 0, now=20))
+
+    state = PagerState(path, cooldown=100, recovery=30)
+    eq_(COOLDOWN, state.state('global'))
+    eq_(RECOVERED, state.update('global', False, 0, now=50))
+
+    # A corrupt file is ignored.
+    with open(path, 'w') as handle:
+        handle.write('{not json')
+    eq_(RESOLVED, PagerState(path).state('global'))
+
+
+def test_check_rates():
+    "Going over the limit pages, and dropping under it recovers"
+    message_rate = MessageRate(2, 3, pager_state=PagerState(
+        cooldown=1000, recovery=0))
+    message_buffer = MessageBuffer(Mock(), Mock())
+    for i in range(3):
+        message_buffer.add(unique_message(i), 'source')
+    notices = check_rates(message_buffer, message_rate)
+    eq_([(PAGE, None)], [(notice.event, notice.kind) for notice in notices])
+
+    message_buffer.flush()
+    # Still in the window...
+    eq_([], check_rates(message_buffer, message_rate))
+    # ...then under the limit, and, with no wait, recovered.
+    eq_([], check_rates(message_buffer, message_rate))
+    notices = check_rates(message_buffer, message_rate)
+    eq_([(RECOVERED, None)],
+        [(notice.event, notice.kind) for notice in notices])
+
+
+@patch('failnozzle.mail.send_email')
+@patch.multiple('failnozzle.settings', SERVER_NAME='test', PAGER_FROM='from',
+                PAGER_TO='to', create=True)
+def test_pager_one_email(send_email):
+    "Notices from one check go out in a single email"
+    pager([PageNotice(PAGE, None, u'global text'),
+           PageNotice(RECOVERED, 'db', u'db text')])
+    eq_(1, send_email.call_count)
+    _, _, subject, report = send_email.call_args[0]
+    eq_(u'test error rate exceeded for db', subject)
+    eq_(u'global text\ndb text', report)
+
+    pager([PageNotice(RECOVERED, None, u'global text')])
+    eq_(u'test error rate recovered', send_email.call_args[0][2])
@@ -0,0 +1,99 @@
+"""
+Tests for running several pipelines in one daemon
+"""
+import gevent
+from mock import patch
+from nose.tools import assert_raises, eq_, ok_
+
+from failnozzle.config import _build_config, _check_pipelines, current_config
+from failnozzle.context import _spawn, setting
+from failnozzle.flushing import flusher
+from failnozzle.pipeline import Pipeline, PipelineRouter
+from failnozzle.tests.helpers import record
+
+
+PIPELINES = {
+    'payments': {'KINDS': ['billing', 'checkout'], 'SERVER_NAME': 'pay',
+                 'REPORT_TO': 'payments@example.com', 'FLUSH_SECONDS': 10},
+    'rest': {'SERVER_NAME': 'rest'},
+}
+
+
+@patch.multiple('failnozzle.settings', create=True, SERVER_NAME='global',
+                FLUSH_SECONDS=60)
+def test_settings_follow_pipeline():
+    "Settings read in a pipeline, or greenlets it spawns, are its own"
+    pipeline = Pipeline('payments', PIPELINES['payments'])
+    pipeline.config = _build_config(pipeline.overrides)
+    eq_(60, setting('FLUSH_SECONDS'))
+    with pipeline.active():
+        eq_(10, setting('FLUSH_SECONDS'))
+        eq_('pay', current_config().SERVER_NAME)
+        # Greenlets spawned for the pipeline work for it too.
+        eq_('pay', _spawn(setting, 'SERVER_NAME').get())
+        eq_('global', gevent.spawn(setting, 'SERVER_NAME').get())
+    eq_('global', current_config().SERVER_NAME)
+
+
+@patch.multiple('failnozzle.settings', create=True, SERVER_NAME='global',
+                REPORT_TO='everyone@example.com', PIPELINES=PIPELINES)
+@patch('failnozzle.mail.send_email')
+def test_routes_by_kind(send_email):
+    "Records go to the pipeline for their kind, or the catch-all"
+    pipelines = [Pipeline(name, overrides)
+                 for name, overrides in sorted(PIPELINES.items())]
+    for pipeline in pipelines:
+        pipeline.start()
+    payments, rest = pipelines
+    try:
+        router = PipelineRouter(pipelines)
+        for i, kind in enumerate(['billing', 'web', 'checkout', 'web',
+                                  'web']):
+            router.put(record(i, kind))
+        eq_(5, router.qsize())
+        gevent.sleep(0.05)
+        eq_((2, 3), (payments.message_buffer.total,
+                     rest.message_buffer.total))
+
+        # Each digest goes out with its pipeline's settings.
+        for pipeline in pipelines:
+            with pipeline.active():
+                flusher(pipeline.message_buffer, pipeline.message_rate)
+    finally:
+        for pipeline in pipelines:
+            gevent.killall(pipeline.processors)
+            pipeline.scheduler.greenlet.kill()
+    eq_(2, send_email.call_count)
+    (_, pay_to, pay_subject, _), _ = send_email.call_args_list[0]
+    (_, rest_to, rest_subject, _), _ = send_email.call_args_list[1]
+    eq_('payments@example.com', pay_to)
+    ok_(pay_subject.startswith('pay errors: 2 total'))
+    eq_('everyone@example.com', rest_to)
+    ok_(rest_subject.startswith('rest errors: 3 total'))
+
+    # Without a catch-all, other kinds are dropped.
+    router = PipelineRouter([payments])
+    router.put(record(kind='web'))
+    eq_(1, router.unrouted)
+
+
+def test_check_pipelines():
+    "PIPELINES settings that can't work are refused"
+    class FakeSettings(object):
+        "A stand-in settings module"
+        UDP_BIND = ('0.0.0.0', 1549)
+        HISTORY_DB = None
+
+    def check(pipelines):
+        "Check a PIPELINES setting"
+        _check_pipelines(_build_config({'PIPELINES': pipelines}))
+    with patch('failnozzle.config.settings', FakeSettings):
+        check(PIPELINES)
+        # Another catch-all is fine on another port.
+        check(dict(PIPELINES, web={'UDP_BIND': ('0.0.0.0', 1550)}))
+        assert_raises(AssertionError, check, dict(PIPELINES, web={}))
+        assert_raises(AssertionError, check,
+                      dict(PIPELINES, web={'KINDS': ['billing']}))
+        assert_raises(AssertionError, check,
+                      {'a': {'HISTORY_DB': 'history.db'},
+                       'b': {'KINDS': ['x'], 'HISTORY_DB': 'history.db'}})
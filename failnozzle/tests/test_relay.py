@@ -0,0 +1,190 @@
+"""
+Tests for relaying pre-aggregated counts to an upstream failnozzle
+"""
+from datetime import datetime
+import zlib
+
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+
+from failnozzle import relay
+from failnozzle.buffer import MessageBuffer
+from failnozzle.config import UniqueMessage
+from failnozzle.flushing import _merge_relay_batch, flusher, relay_flusher
+from failnozzle.rates import MessageRate
+from failnozzle.tests.helpers import message_counts, unique_message
+
+
+def test_relay_round_trip():
+    "Counts survive being encoded into a batch and decoded"
+    first_seen = datetime(2013, 1, 9, 15, 8, 41, 781727)
+    last_seen = datetime(2013, 1, 9, 15, 8, 45, 426238)
+    counts_by_unique = {unique_message(1): message_counts(
+        {'host1': 3, 'host2': 1}, first_seen, last_seen)}
+
+    batches = relay.encode_batches(counts_by_unique, {'other': 2},
+                                   'relay1', 65000, 7)
+    eq_(1, len(batches))
+    ok_(relay.is_batch(batches[0]))
+
+    relay_name, entries, shed_by_kind, dropped = \
+        relay.decode_batch(batches[0])
+    eq_('relay1', relay_name)
+    eq_({'other': 2}, shed_by_kind)
+    eq_(7, dropped)
+    eq_(1, len(entries))
+    fields, sources, decoded_first, decoded_last = entries[0]
+    eq_(unique_message(1), UniqueMessage(**fields))
+    eq_({'host1': 3, 'host2': 1}, sources)
+    eq_(first_seen, decoded_first)
+    eq_(last_seen, decoded_last)
+
+
+def test_relay_batches_fit():
+    """
+    Make sure big flushes are split into packet-sized batches, truncating
+    tracebacks too big for any batch.
+    """
+    now = datetime.now()
+    counts_by_unique = dict((unique_message(i, exc_text='x' * 1000),
+                             message_counts({'host1': 1}, now, now))
+                            for i in range(100))
+    counts_by_unique[unique_message(100, exc_text='y' * 20000)] = \
+        message_counts({'host1': 1}, now, now)
+
+    batches = relay.encode_batches(counts_by_unique, {}, 'relay1', 8000)
+    ok_(len(batches) > 1)
+    ok_(all(len(batch) <= 8000 for batch in batches))
+
+    entries = [entry for batch in batches
+               for entry in relay.decode_batch(batch)[1]]
+    eq_(101, len(entries))
+    ok_(all(len(fields['exc_text']) < 8000 for fields, _, _, _ in entries))
+
+
+def test_relay_many_sources():
+    """
+    Make sure a unique message seen on too many sources for one batch has
+    them split across batches that each fit in a packet.
+    """
+    now = datetime.now()
+    sources = dict(('host%d.example.com' % i, i) for i in range(8000))
+    counts_by_unique = {unique_message(1, exc_text='x' * 50000):
+                        message_counts(sources, now, now)}
+
+    batches = relay.encode_batches(counts_by_unique, {'app': 1}, 'relay1',
+                                   65000)
+    ok_(len(batches) > 1)
+    ok_(all(len(batch) <= 65000 for batch in batches))
+    merged = {}
+    for batch in batches:
+        for fields, entry_sources, _, _ in relay.decode_batch(batch)[1]:
+            eq_('message 1', fields['message'])
+            merged.update(entry_sources)
+    eq_(sources, merged)
+
+
+def test_relay_decode_bounded():
+    """
+    Make sure a batch that decompresses to more than the limit is refused
+    without being decompressed.
+    """
+    bomb = relay.RELAY_MAGIC + zlib.compress(b'{' + b' ' * 10000000 + b'}')
+    try:
+        relay.decode_batch(bomb)
+    except ValueError:
+        pass
+    else:
+        ok_(False, 'Decoded a batch over the limit')
+
+
+@patch.multiple('failnozzle.settings', RELAY_ACCEPT=True)
+def test_relay_merge():
+    """
+    Make sure relayed counts merge with ones that arrived locally.
+    """
+    upstream = MessageBuffer(Mock(), Mock())
+    upstream.add(unique_message(1), 'host1')
+
+    first_seen = datetime(2013, 1, 9, 15, 8, 41)
+    last_seen = datetime(2013, 1, 9, 15, 8, 45)
+    counts_by_unique = {
+        unique_message(1): message_counts({'host1': 2, 'host2': 1},
+                                          first_seen, last_seen),
+        unique_message(2): message_counts({'host3': 4}, first_seen,
+                                          last_seen)}
+    for batch in relay.encode_batches(counts_by_unique, {'app': 5},
+                                      'relay1', 65000, 3):
+        _merge_relay_batch(upstream, batch)
+
+    eq_(8, upstream.total)
+    eq_(2, upstream.total_unique)
+    eq_(5, upstream.accounting.total_shed)
+    eq_(3, upstream.accounting.dropped)
+    counts = upstream.counts_by_unique[unique_message(1)]
+    eq_([('host1', 3), ('host2', 1)], counts.sources_sorted)
+    eq_(first_seen, counts.first_seen)
+    ok_(counts.last_seen > last_seen)
+
+
+@patch('failnozzle.flushing.mailer')
+@patch('failnozzle.flushing.pager')
+@patch('gevent.socket.socket')
+@patch.multiple('failnozzle.settings', RELAY_TO=('upstream', 1549),
+                create=True)
+def test_flusher_relay(socket, pager, mailer):
+    """
+    Make sure relay mode forwards the buffer instead of emailing it.
+    """
+    message_buffer = MessageBuffer(Mock(), Mock())
+    message_buffer.add(unique_message(1), 'host1')
+    message_buffer.add_dropped(4)
+    message_rate = MessageRate(1, 1)
+
+    flusher(message_buffer, message_rate)
+
+    eq_(0, message_buffer.total)
+    eq_(0, message_buffer.accounting.dropped)
+    eq_(0, mailer.call_count)
+    eq_(0, pager.call_count)
+    sendto = socket.return_value.sendto
+    eq_(1, sendto.call_count)
+    batch, address = sendto.call_args[0]
+    eq_(('upstream', 1549), address)
+    _, entries, _, dropped = relay.decode_batch(batch)
+    eq_(1, len(entries))
+    eq_(4, dropped)
+
+
+@patch.multiple('failnozzle.settings', RELAY_ACCEPT=False)
+def test_relay_merge_off():
+    "Relayed batches are refused unless RELAY_ACCEPT is on"
+    upstream = MessageBuffer(Mock(), Mock())
+    now = datetime.now()
+    batch, = relay.encode_batches(
+        {unique_message(1): message_counts({'host1': 1}, now, now)}, {},
+        'relay1', 65000)
+    try:
+        _merge_relay_batch(upstream, batch)
+    except ValueError:
+        pass
+    else:
+        ok_(False, 'Merged a batch with RELAY_ACCEPT off')
+    eq_(0, upstream.total)
+
+
+@patch('gevent.socket.socket')
+@patch.multiple('failnozzle.settings', RELAY_TO=('upstream', 1549),
+                RELAY_MAX_BATCH_SIZE=8000, create=True)
+def test_relay_send_errors(socket):
+    "A batch failing to send doesn't keep the others from being sent"
+    message_buffer = MessageBuffer(Mock(), Mock())
+    for i in range(100):
+        message_buffer.add(unique_message(i, exc_text='x' * 1000), 'host1')
+    sendto = socket.return_value.sendto
+    sendto.side_effect = [IOError('Message too long')] + [None] * 100
+
+    relay_flusher(message_buffer)
+
+    ok_(sendto.call_count > 2)
+    eq_(0, message_buffer.total)
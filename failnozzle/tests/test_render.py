@@ -0,0 +1,140 @@
+"""
+Tests for rendering digests in worker processes
+"""
+import os
+import time
+
+import gevent
+import gevent.socket
+from jinja2 import Environment, FileSystemLoader
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+
+from failnozzle import server
+from failnozzle.buffer import MessageBuffer
+from failnozzle.config import UniqueMessage
+from failnozzle.listener import Listener
+from failnozzle.render import RenderPool, decode_params, encode_params
+from failnozzle.tests.helpers import packet
+
+
+RENDER_SETTINGS = dict(SERVER_NAME='test', RENDER_POOL_THRESHOLD=100,
+                       INCOMING_MESSAGE_MAX_SIZE=65536)
+
+
+def _templates():
+    "Compile the default templates"
+    env = Environment(loader=FileSystemLoader(os.path.dirname(
+        server.__file__)))
+    return (env.get_template('subject-template.txt'),
+            env.get_template('body-template.txt'))
+
+
+def _fill(message_buffer, count):
+    "Add `count` unique messages, from a few sources each"
+    for i in range(count):
+        unique = UniqueMessage('module', 'funcName', 'filename',
+                               u'message %d \u2603' % i, 'pathname', i,
+                               'exception text\n' * 20, 'kind%d' % (i % 3))
+        for j in range(i % 4 + 1):
+            message_buffer.add(unique, 'host%d' % j)
+    message_buffer.new_uniques.add(unique)
+
+
+@patch.multiple('failnozzle.settings', create=True, **RENDER_SETTINGS)
+def test_pool_matches_local():
+    "Digests rendered in the pool match those rendered in process"
+    local_buffer = MessageBuffer(*_templates())
+    pooled_buffer = MessageBuffer(*_templates())
+    pooled_buffer.render_pool = RenderPool(1)
+    try:
+        with patch('failnozzle.counts.datetime') as fake_datetime:
+            fake_datetime.now.return_value = 'then'
+            _fill(local_buffer, 200)
+            _fill(pooled_buffer, 200)
+        local = local_buffer.flush()
+        pooled = pooled_buffer.flush()
+        ok_(pooled[1])
+        eq_(local, pooled)
+        eq_(1, pooled_buffer.render_pool.started)
+    finally:
+        pooled_buffer.render_pool.close()
+
+
+def test_worker_start_failure():
+    "A worker that can't start is logged and forgotten"
+    pool = RenderPool(1)
+    with patch.object(pool, '_start_worker', side_effect=OSError('no exec')):
+        with patch('failnozzle.render.logging') as fake_logging:
+            try:
+                pool._get_worker()  # pylint: disable=W0212
+            except OSError:
+                pass
+            else:
+                ok_(False, 'Got a worker that never started')
+    eq_(0, pool.started)
+    eq_(1, fake_logging.exception.call_count)
+
+
+def test_snapshot_round_trip():
+    "Render parameters survive being encoded for the pool"
+    message_buffer = MessageBuffer(Mock(), Mock())
+    _fill(message_buffer, 3)
+    sorted_counts = message_buffer.sorted_counts
+    new = set(message_buffer.new_uniques)
+    params = decode_params(encode_params(dict(
+        total=6, sorted_counts=sorted_counts, new_messages=new,
+        trends={sorted_counts[0][0]: 4})))
+    eq_(6, params['total'])
+    eq_([(unique, counts.total, counts.sources_sorted, counts.sources)
+         for unique, counts in sorted_counts],
+        [(unique, counts.total, counts.sources_sorted, counts.sources)
+         for unique, counts in params['sorted_counts']])
+    eq_(new, params['new_messages'])
+    eq_(4, params['trends'][sorted_counts[0][0]])
+    eq_(0, params['trends'][sorted_counts[1][0]])
+
+
+@patch.multiple('failnozzle.settings', create=True, **RENDER_SETTINGS)
+def test_listener_drains_during_render():
+    """
+    Make sure packets keep being read while a big digest renders.
+    """
+    sock = gevent.socket.socket(family=gevent.socket.AF_INET,
+                                type=gevent.socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    received = []
+    message_queue = Mock()
+    message_queue.put.side_effect = lambda record: received.append(
+        time.time())
+    listener = Listener(sock, message_queue, Mock())
+    listener.start()
+
+    sender = gevent.socket.socket(family=gevent.socket.AF_INET,
+                                  type=gevent.socket.SOCK_DGRAM)
+    data = packet()
+
+    def send():
+        "Send a packet every few milliseconds"
+        while True:
+            sender.sendto(data, sock.getsockname())
+            gevent.sleep(0.005)
+
+    message_buffer = MessageBuffer(*_templates())
+    message_buffer.render_pool = RenderPool(1)
+    sending = gevent.spawn(send)
+    try:
+        _fill(message_buffer, 5000)
+        started = time.time()
+        subject, report, _ = gevent.spawn(message_buffer.flush).get()
+        finished = time.time()
+    finally:
+        sending.kill()
+        listener.greenlet.kill()
+        message_buffer.render_pool.close()
+        sock.close()
+        sender.close()
+
+    ok_(u'5000 unique errors' in report)
+    ok_(subject)
+    ok_([at for at in received if started < at < finished])
@@ -0,0 +1,134 @@
+"""
+Tests for replaying archived log records offline
+"""
+from datetime import datetime
+import gzip
+import json
+import os
+
+from mock import patch
+from nose.tools import eq_, ok_, with_setup
+
+from failnozzle.replay import decode_chunk, main, read_chunks, replay, \
+    stdout_emitter
+from failnozzle.tests.helpers import TEMP_DIRS, make_temp_dir, record, \
+    remove_temp_dirs
+
+
+START = 1500000000.0
+
+
+def _line(i, offset):
+    """
+    Encode a log record created `offset` seconds after START, or without a
+    created time if `offset` is None
+    """
+    line = record(i % 2, source='host%d' % (i % 3))
+    if offset is not None:
+        line['created'] = START + offset
+    return json.dumps(line)
+
+
+def _write(path, lines, compress=False):
+    "Write lines to a file, gzipped or not"
+    opener = gzip.open if compress else open
+    handle = opener(path, 'wb')
+    handle.write('\n'.join(lines).encode('utf-8'))
+    handle.close()
+
+
+def test_read_chunks():
+    "Lines are read in chunks, whole, however the reads split them"
+    class Handle(object):
+        "Returns a few bytes at a time"
+        def __init__(self, data):
+            self.data = data
+
+        def read(self, size):
+            "Read up to size bytes"
+            data, self.data = self.data[:size], self.data[size:]
+            return data
+    eq_([[b'ab'], [b'cd'], [b'ef']],
+        list(read_chunks(Handle(b'ab\ncd\n\nef'), 4)))
+
+    records, bad = decode_chunk([b'{"a": 1}', b'not json', b'{"b": 2}'])
+    eq_([{'a': 1}, {'b': 2}], records)
+    eq_(1, bad)
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+@patch.multiple('failnozzle.settings', create=True, SERVER_NAME='replay')
+def test_replay_windows():
+    "Records are flushed in windows of their created times"
+    path = os.path.join(TEMP_DIRS[-1], 'records.jsonl.gz')
+    # Two records in the first window, then a gap of two empty windows, then
+    # three more; and a line that isn't JSON.
+    _write(path, [_line(0, 0), _line(1, 30), 'garbage',
+                  _line(2, 200), _line(3, 210), _line(4, 239)], compress=True)
+    digests = []
+    run = replay([path], 60, lambda subject, report, start:
+                 digests.append((subject, report, start)))
+    eq_(5, run.records)
+    eq_([START, START + 180], [start for _, _, start in digests])
+    ok_(digests[0][0].startswith('replay errors: 2 total, 2 unique'))
+    ok_(digests[1][0].startswith('replay errors: 3 total, 2 unique'))
+    # Seen times come from the records.
+    ok_('Seen between %s to %s' % (datetime.fromtimestamp(START + 200),
+                                   datetime.fromtimestamp(START + 239))
+        in digests[1][1])
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+@patch.multiple('failnozzle.settings', create=True, SERVER_NAME='replay')
+def test_main_output_dir():
+    "The command line writes each digest to the output directory"
+    path = os.path.join(TEMP_DIRS[-1], 'records.jsonl')
+    output_dir = os.path.join(TEMP_DIRS[-1], 'digests')
+    _write(path, [_line(i, i * 10) for i in range(12)])
+    main(['--flush-seconds', '60', '--output-dir', output_dir, path])
+    names = sorted(os.listdir(output_dir))
+    eq_(2, len(names))
+    with open(os.path.join(output_dir, names[0])) as handle:
+        ok_(handle.readline().startswith('Subject: replay errors: 6 total'))
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+@patch.multiple('failnozzle.settings', create=True, SERVER_NAME='replay')
+def test_replay_undated():
+    "Records without a created time are replayed, not dropped"
+    path = os.path.join(TEMP_DIRS[-1], 'records.jsonl')
+    # Undated records go with the dated record after them at the start, and
+    # with the one before them after that; a line that isn't a record is
+    # skipped.
+    _write(path, [_line(0, None), _line(1, None), _line(2, 0),
+                  _line(3, None), '[1]', _line(4, 100), _line(5, None)])
+    digests = []
+    run = replay([path], 60, lambda subject, report, start:
+                 digests.append((subject, report, start)))
+    eq_((6, 4, 1), (run.records, run.undated, run.skipped))
+    eq_([START, START + 60], [start for _, _, start in digests])
+    ok_(digests[0][0].startswith('replay errors: 4 total'))
+    ok_(digests[1][0].startswith('replay errors: 2 total'))
+
+    # Without any times at all, they're all replayed as arriving now.
+    _write(path, [_line(i, None) for i in range(3)])
+    digests = []
+    run = replay([path], 60, lambda subject, report, start:
+                 digests.append((subject, report, start)))
+    eq_((3, 3), (run.records, run.undated))
+    eq_(1, len(digests))
+
+
+def test_stdout_emitter():
+    "Digests are written as text, whatever the render returned"
+    written = []
+
+    class Stream(object):
+        "Collects what is written"
+        def write(self, data):
+            "Note data"
+            written.append(data)
+    emit = stdout_emitter(Stream())
+    emit(u'subject', b'report', START)
+    text = ''.join(written)
+    ok_('Subject: subject\n\nreport\n' in text, text)
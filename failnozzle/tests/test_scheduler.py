@@ -0,0 +1,98 @@
+"""
+Tests for deciding when to flush
+"""
+from mock import Mock, patch
+from nose.tools import eq_
+
+from failnozzle.buffer import MessageBuffer
+from failnozzle.rates import MessageRate
+from failnozzle.scheduler import FlushScheduler
+from failnozzle.tests.helpers import unique_message
+
+
+SCHEDULE_SETTINGS = dict(FLUSH_SECONDS=60, FLUSH_MIN_SECONDS=10,
+                         FLUSH_MAX_SECONDS=300, FLUSH_FLOOD_MESSAGES=1000,
+                         FLUSH_POLL_SECONDS=1, PAGER_LIMIT=100)
+
+
+def _scheduler(now=1000.0):
+    "Build a FlushScheduler whose last flush was at `now`"
+    with patch('failnozzle.scheduler.monotonic', return_value=now):
+        return FlushScheduler(MessageBuffer(Mock(), Mock()),
+                              MessageRate(5, 100))
+
+
+@patch.multiple('failnozzle.settings', create=True, **SCHEDULE_SETTINGS)
+def test_scheduled():
+    "A flush is due once the interval has passed"
+    scheduler = _scheduler()
+    eq_(None, scheduler._reason_to_flush(1059.0))
+    eq_('scheduled', scheduler._reason_to_flush(1060.0))
+
+
+@patch.multiple('failnozzle.settings', create=True, **SCHEDULE_SETTINGS)
+def test_early_for_new_error():
+    "A new error flushes early, but not before the minimum interval"
+    scheduler = _scheduler()
+    scheduler.new_error(unique_message(1))
+    # Not before the minimum interval...
+    eq_(None, scheduler._reason_to_flush(1005.0))
+    eq_('new error', scheduler._reason_to_flush(1010.0))
+
+
+@patch.multiple('failnozzle.settings', create=True, **SCHEDULE_SETTINGS)
+def test_early_for_spike():
+    "A spike of messages flushes early"
+    scheduler = _scheduler()
+    for _ in range(99):
+        scheduler.message_buffer.add(unique_message(1), 'host1')
+    eq_(None, scheduler._reason_to_flush(1020.0))
+    scheduler.message_buffer.add(unique_message(1), 'host1')
+    eq_('spike', scheduler._reason_to_flush(1020.0))
+
+
+@patch('gevent.spawn')
+@patch.multiple('failnozzle.settings', create=True, **SCHEDULE_SETTINGS)
+def test_skips_empty(spawn):
+    "A flush with nothing buffered sends nothing"
+    scheduler = _scheduler()
+    with patch('failnozzle.scheduler.monotonic', return_value=1060.0):
+        scheduler.flush('scheduled')
+    eq_(0, spawn.call_count)
+    eq_([0], scheduler.message_rate.counts)
+    eq_(1060.0, scheduler.last_flush)
+
+
+@patch('gevent.spawn')
+@patch.multiple('failnozzle.settings', create=True, **SCHEDULE_SETTINGS)
+def test_flood_stretches_interval(spawn):
+    "A flood stretches the interval, up to the maximum, and back"
+    scheduler = _scheduler()
+    scheduler.message_buffer.add_counts(unique_message(1), {'host1': 1000},
+                                        None, None)
+    scheduler.flush('scheduled')
+    eq_(1, spawn.call_count)
+    eq_(120, scheduler.interval)
+
+    # A flood suppresses early flushes.
+    scheduler.new_error(unique_message(2))
+    eq_(None, scheduler._reason_to_flush(scheduler.last_flush + 20))
+
+    for expected in (240, 300, 300):
+        scheduler.flush('scheduled')
+        eq_(expected, scheduler.interval)
+
+    scheduler.message_buffer.accounting.added = 10
+    scheduler.flush('scheduled')
+    eq_(60, scheduler.interval)
+
+
+@patch('gevent.spawn')
+@patch.multiple('failnozzle.settings', create=True, **SCHEDULE_SETTINGS)
+def test_no_overlapping_flushes(_spawn):
+    "A flush waits for the one before it to finish"
+    scheduler = _scheduler()
+    previous = Mock()
+    scheduler.flusher_greenlet = previous
+    scheduler.flush('scheduled')
+    previous.join.assert_called_once_with()
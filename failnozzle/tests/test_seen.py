@@ -0,0 +1,114 @@
+"""
+Tests for telling new errors from recurring ones
+"""
+import os
+
+from jinja2.environment import Environment
+from jinja2.loaders import FileSystemLoader
+from mock import Mock, patch
+from nose.tools import eq_, ok_, with_setup
+
+from failnozzle.buffer import MessageBuffer
+from failnozzle.fingerprint import fingerprint
+from failnozzle.mail import NewErrorNotifier
+from failnozzle.seen import SeenSet
+from failnozzle.sharding import ShardedMessageBuffer
+from failnozzle.tests.helpers import TEMP_DIRS, make_temp_dir, \
+    remove_temp_dirs, unique_message
+
+
+def _seen_path():
+    "Path of a seen-set file in the scratch directory"
+    return os.path.join(TEMP_DIRS[-1], 'seen')
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+def test_seen_set():
+    "The seen set remembers fingerprints across restarts, but not resizes"
+    seen = SeenSet(_seen_path(), 1 << 16, 5)
+    fprint = fingerprint(unique_message(1))
+    ok_(fprint not in seen)
+    ok_(seen.add(fprint))
+    ok_(fprint in seen)
+    ok_(not seen.add(fprint))
+    ok_(fingerprint(unique_message(2)) not in seen)
+    seen.close()
+
+    # It survives a restart...
+    seen = SeenSet(_seen_path(), 1 << 16, 5)
+    ok_(fprint in seen)
+    seen.close()
+
+    # ...but not a change of size.
+    seen = SeenSet(_seen_path(), 1 << 17, 5)
+    ok_(fprint not in seen)
+    eq_(32 + (1 << 14), os.path.getsize(_seen_path()))
+    seen.close()
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+def test_seen_set_false_positives():
+    "The seen set rarely mistakes a new fingerprint for a seen one"
+    seen = SeenSet(_seen_path(), 1 << 16, 7)
+    for i in range(5000):
+        seen.add(fingerprint(unique_message(i)))
+    false_positives = len([i for i in range(5000, 10000)
+                           if fingerprint(unique_message(i)) in seen])
+    ok_(false_positives < 100, false_positives)
+    seen.close()
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+def test_flush_flags_new():
+    """
+    Make sure new errors are flagged and listed first, and only once.
+    """
+    template_dir = os.path.join(os.path.dirname(__file__), '..')
+    env = Environment(loader=FileSystemLoader(template_dir))
+    seen = SeenSet(_seen_path(), 1 << 16, 5)
+    message_buffer = MessageBuffer(env.get_template('subject-template.txt'),
+                                   env.get_template('body-template.txt'),
+                                   seen=seen)
+    listener = Mock()
+    message_buffer.new_listeners.append(listener)
+
+    message_buffer.add(unique_message(1), 'host1')
+    message_buffer.flush()
+
+    for _ in range(5):
+        message_buffer.add(unique_message(1), 'host1')
+    message_buffer.add(unique_message(2), 'host1')
+    eq_(unique_message(2), message_buffer.sorted_counts[0][0])
+    subject, report, _ = message_buffer.flush()
+
+    ok_('1 new' in subject)
+    ok_('[NEW] 1X message 2' in report)
+    ok_('[NEW] 5X message 1' not in report)
+    eq_([((unique_message(1),),), ((unique_message(2),),)],
+        listener.call_args_list)
+    seen.close()
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+def test_sharded_flags_new():
+    "A sharded buffer flags new messages until they're flushed"
+    seen = SeenSet(_seen_path(), 1 << 16, 5)
+    message_buffer = ShardedMessageBuffer(Mock(), Mock(), 4, seen=seen)
+    for i in range(10):
+        message_buffer.add(unique_message(i), 'host1')
+    eq_(10, len(message_buffer.new_uniques))
+    message_buffer.flush()
+    eq_(0, len(message_buffer.new_uniques))
+    seen.close()
+
+
+@patch('failnozzle.mail.new_error_mailer')
+@patch('gevent.spawn')
+@patch.multiple('failnozzle.settings', FLUSH_SECONDS=60, create=True)
+def test_new_error_notifier_limit(spawn, new_error_mailer):
+    "Only so many new error emails are sent"
+    notifier = NewErrorNotifier(2)
+    for i in range(5):
+        notifier(unique_message(i))
+    eq_(2, spawn.call_count)
+    spawn.assert_called_with(new_error_mailer, unique_message(1))
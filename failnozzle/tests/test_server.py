@@ -2,17 +2,26 @@
 Tests for the basic operation of the failnozzzle server
 """
 from mock import ANY, call, DEFAULT, Mock, patch
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 import os
 import sys
 
 from jinja2.environment import Environment
 from jinja2.loaders import FileSystemLoader
 
-from failnozzle import server
-from failnozzle.server import calc_recips, flusher, is_just_monitoring_error, \
-    mailer, MessageBuffer, MessageCounts, MessageRate, \
-    _process_one_message, _package_unique_message, UniqueMessage, setting
+from failnozzle import mail, server
+from failnozzle.buffer import MessageBuffer
+from failnozzle.config import OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, \
+    OVERFLOW_SHED_DUPLICATES, UniqueMessage, _build_config
+from failnozzle.context import setting
+from failnozzle.counts import MessageCounts, TopSourceCounts
+from failnozzle.flushing import PageNotice, flusher
+from failnozzle.mail import calc_recips, is_just_monitoring_error, mailer, \
+    send_email
+from failnozzle.processing import MessageQueue, _package_unique_message, \
+    _process_one_message, _truncate_exc_text
+from failnozzle.rates import MessageRate
+from failnozzle.sharding import ShardedMessageBuffer, ShardedMessageQueue
 
 
 # Fix path to import failnozzle
@@ -60,11 +69,169 @@ def test_message_buffer():
     eq_({'app'}, body_template.render.call_args[0][0]['kinds'])
 
 
+def test_message_buffer_shed():
+    """
+    Test that shed messages are reported even if nothing else arrived.
+    """
+    subject_template = Mock()
+    body_template = Mock()
+
+    buf = MessageBuffer(subject_template, body_template)
+    buf.add_shed('app')
+    buf.add_shed('app')
+    buf.add_shed('api')
+    eq_(3, buf.accounting.total_shed)
+
+    buf.flush()
+    params = body_template.render.call_args[0][0]
+    eq_(3, params['total_shed'])
+    eq_([('api', 1), ('app', 2)], params['shed_by_kind'])
+    eq_(0, buf.accounting.total_shed)
+
+
+def _queue_record(message, kind='app'):
+    "Make a minimal incoming record for MessageQueue tests"
+    return {'message': message, 'kind': kind, 'source': 'host1'}
+
+
+def test_message_queue_drop_newest():
+    buf = MessageBuffer(Mock(), Mock())
+    queue = MessageQueue(buf, maxsize=2, policy=OVERFLOW_DROP_NEWEST)
+    for i in range(4):
+        queue.put(_queue_record('m%d' % i))
+
+    eq_(2, queue.qsize())
+    eq_('m0', queue.get()['message'])
+    eq_({'app': 2}, buf.accounting.shed_by_kind)
+
+
+def test_message_queue_drop_oldest():
+    buf = MessageBuffer(Mock(), Mock())
+    queue = MessageQueue(buf, maxsize=2, policy=OVERFLOW_DROP_OLDEST)
+    queue.put(_queue_record('m0', kind='old'))
+    queue.put(_queue_record('m1'))
+    queue.put(_queue_record('m2'))
+
+    eq_(2, queue.qsize())
+    eq_('m1', queue.get()['message'])
+    eq_({'old': 1}, buf.accounting.shed_by_kind)
+
+
+def test_message_queue_shed_duplicates():
+    buf = MessageBuffer(Mock(), Mock())
+    queue = MessageQueue(buf, maxsize=1, policy=OVERFLOW_SHED_DUPLICATES)
+    queue.put(_queue_record('known'))
+    _process_one_message(queue, buf)
+
+    queue.put(_queue_record('queued'))
+    # Full: a duplicate of a buffered message is shed...
+    queue.put(_queue_record('known'))
+    eq_(1, queue.qsize())
+    eq_({'app': 1}, buf.accounting.shed_by_kind)
+    # ...but a new unique message is admitted past the bound.
+    queue.put(_queue_record('new'))
+    eq_(2, queue.qsize())
+
+
+def test_message_buffer_interning():
+    """
+    Test that equal strings from different packets end up as one copy.
+    """
+    buf = MessageBuffer(Mock(), Mock())
+
+    def fresh(text):
+        "Make an equal but distinct copy of text"
+        return ''.join(list(text))
+
+    exc_text = 'Traceback (most recent call last):\nValueError: oops'
+    for i in range(3):
+        buf.add(UniqueMessage('test', 'test', 'test', 'message%d' % i,
+                              fresh('test.py'), i, fresh(exc_text),
+                              fresh('app')),
+                fresh('host1'))
+
+    uniques = buf.unique_messages
+    eq_(3, len(uniques))
+    eq_(1, len(set(id(unique.exc_text) for unique in uniques)))
+    eq_(1, len(set(id(unique.pathname) for unique in uniques)))
+    sources = [source for counts in buf.counts_by_unique.values()
+               for source in counts.sources]
+    eq_(1, len(set(id(source) for source in sources)))
+
+    buf.flush()
+    eq_(0, len(buf.interner))
+
+
+@patch('failnozzle.settings.INTERN_STRINGS', False)
+def test_message_buffer_no_interning():
+    buf = MessageBuffer(Mock(), Mock())
+    eq_(None, buf.interner)
+    buf.add(UniqueMessage('test', 'test', 'test', 'message', 'test.py', 1,
+                          'exception text', 'app'), 'host1')
+    eq_(1, buf.total)
+
+
+def test_sharded_message_buffer():
+    """
+    Test that a sharded buffer spreads messages out but reports on them as
+    one.
+    """
+    subject_template = Mock()
+    body_template = Mock()
+
+    buf = ShardedMessageBuffer(subject_template, body_template, 4)
+    messages = [UniqueMessage('test', 'test', 'test', 'message%d' % i,
+                              'test%d.py' % i, i, 'exception text', 'app')
+                for i in range(20)]
+    for i, msg in enumerate(messages):
+        for _ in range(i + 1):
+            buf.add(msg, 'host1')
+
+    eq_(210, buf.total)
+    eq_(20, buf.total_unique)
+    ok_(len([shard for shard in buf.shards if shard.total_unique]) > 1)
+    eq_(sum(shard.total for shard in buf.shards), buf.total)
+    ok_(buf.contains(messages[3]))
+    eq_('message19', buf.sorted_counts[0][0].message)
+
+    buf.add_shed('app')
+    _, _, uniq_messages = buf.flush()
+    eq_(20, len(uniq_messages))
+    params = body_template.render.call_args[0][0]
+    eq_(210, params['total'])
+    eq_(1, params['total_shed'])
+    eq_(0, buf.total)
+    eq_(0, buf.accounting.total_shed)
+
+
+def test_sharded_message_queue():
+    """
+    Test that records are queued on the shard that will hold their unique
+    message.
+    """
+    buf = ShardedMessageBuffer(Mock(), Mock(), 4)
+    queue = ShardedMessageQueue(buf, maxsize=40)
+    eq_([10] * 4, [shard_queue.maxsize for shard_queue in queue.queues])
+
+    for i in range(20):
+        queue.put({'message': 'message\n%d' % i, 'pathname': 'test%d.py' % i,
+                   'lineno': i, 'kind': 'app', 'source': 'host1'})
+    eq_(20, queue.qsize())
+
+    for shard_queue, shard in zip(queue.queues, buf.shards):
+        while shard_queue.qsize():
+            _process_one_message(shard_queue, shard)
+    for shard in buf.shards:
+        for unique in shard.unique_messages:
+            ok_(buf.shard_for(unique) is shard)
+    eq_(20, buf.total)
+
+
 def test_message_counts():
     counts = MessageCounts()
     counts.increment('host1')
     eq_(1, counts.total)
-    for i in range(10):
+    for _ in range(10):
         counts.increment('host2')
 
     eq_(11, counts.total)
@@ -73,6 +240,105 @@ def test_message_counts():
     eq_(('host2', 10), counts.sources_sorted[1])
 
 
+def test_top_source_counts():
+    counts = TopSourceCounts(10, 10)
+    for _ in range(500):
+        counts.increment('busy')
+    counts.increment('quiet')
+    eq_(2, counts.distinct_sources)
+    ok_(not counts.sources_approximate)
+
+    for i in range(1000):
+        counts.increment('host%d' % i)
+    counts.merge({'busy': 10, 'host999': 5}, None, None)
+    eq_(1516, counts.total)
+    eq_(10, len(counts.sources))
+    eq_(1516, sum(counts.sources.values()))
+    ok_(counts.sources_approximate)
+    ok_(950 <= counts.distinct_sources <= 1050)
+    # The busy source keeps its exact count, and the rest show what they are
+    # known to have sent.
+    eq_([('busy', 510), ('host999', 6)], counts.sources_sorted[:2])
+    eq_(1, counts.sources_sorted[2][1])
+
+
+@patch.multiple('failnozzle.settings', create=True, SERVER_NAME='test',
+                SOURCES_TOP_K=3, SOURCES_HLL_PRECISION=10)
+def test_fleet_wide_digest():
+    env = Environment(loader=FileSystemLoader(os.path.dirname(
+        server.__file__)))
+    buf = MessageBuffer(env.get_template('subject-template.txt'),
+                        env.get_template('body-template.txt'))
+    msg = UniqueMessage('test', 'test', 'test', 'message', 'test.py', 1,
+                        'exception text', 'app')
+    for i in range(2000):
+        buf.add(msg, 'host%d' % i)
+    for _ in range(1000):
+        buf.add(msg, 'host1')
+    _, body, _ = buf.flush()
+    lines = [line for line in body.splitlines() if line.startswith('- on ')]
+    eq_(1, len(lines))
+    ok_(lines[0].startswith('- on ~1,9') or lines[0].startswith('- on ~2,0'),
+        lines[0])
+    # host1 was evicted after its first message, which is no longer counted.
+    ok_(lines[0].endswith('hosts, top: host1 (1000X), host1998 (1X), '
+                          'host1999 (1X)'),
+        lines[0])
+
+
+def _kind_message(kind, i):
+    "Make a unique message of `kind` with a 1000 character traceback"
+    return UniqueMessage('test', 'test', 'test', 'message %d' % i, 'test.py',
+                         i, 'x' * 1000, kind)
+
+
+@patch.multiple('failnozzle.settings', create=True, SERVER_NAME='test',
+                BUFFER_KIND_QUOTAS={'noisy': 5000},
+                BUFFER_DEFAULT_KIND_QUOTA=None)
+def test_kind_quota():
+    env = Environment(loader=FileSystemLoader(os.path.dirname(
+        server.__file__)))
+    buf = MessageBuffer(env.get_template('subject-template.txt'),
+                        env.get_template('body-template.txt'))
+    for i in range(10):
+        buf.add(_kind_message('noisy', i), 'host1')
+        buf.add(_kind_message('quiet', i), 'host1')
+    # Messages already buffered keep counting.
+    buf.add(_kind_message('noisy', 0), 'host2')
+
+    # Each noisy message takes about 2KB, so three fit in the quota.
+    eq_(14, buf.total)
+    eq_({'noisy': 7}, buf.accounting.overflow_by_kind)
+    eq_(21, buf.accounting.added)
+    noisy_bytes = buf.accounting.bytes_by_kind['noisy']
+    quiet_bytes = buf.accounting.bytes_by_kind['quiet']
+    ok_(5000 <= noisy_bytes < 5000 + 2000, noisy_bytes)
+    ok_(quiet_bytes > 2 * noisy_bytes)
+
+    _, body, _, params = buf.flush(snapshot=True)
+    eq_(7, params['total_overflow'])
+    eq_([('noisy', noisy_bytes), ('quiet', quiet_bytes)],
+        params['bytes_by_kind'])
+    ok_('** 7 messages were only counted, not listed, because their kind '
+        'was over its buffer quota: noisy (7X) **' in body, body)
+    ok_('** Buffered: noisy ~' in body, body)
+    eq_(({}, {}), (buf.accounting.bytes_by_kind,
+                   buf.accounting.overflow_by_kind))
+
+
+@patch.multiple('failnozzle.settings', create=True,
+                BUFFER_KIND_QUOTAS={}, BUFFER_DEFAULT_KIND_QUOTA=8000)
+def test_sharded_kind_quota():
+    buf = ShardedMessageBuffer(Mock(), Mock(), 2)
+    for i in range(20):
+        buf.add(_kind_message('app', i), 'host1')
+    # Each shard stops at its half of the quota.
+    for shard in buf.shards:
+        ok_(4000 <= shard.accounting.bytes_by_kind['app'] < 4000 + 2000)
+    eq_(20, buf.total + buf.accounting.total_overflow)
+    ok_(buf.accounting.total_overflow)
+
+
 def test_message_rate():
     rate = MessageRate(3, 3)
     eq_((False, 1), rate.add_and_check(1))
@@ -84,6 +350,22 @@ def test_message_rate():
     eq_((False, 2), rate.add_and_check(2))
 
 
+def test_message_rate_seconds():
+    "The window covers the same seconds however often flushes happen"
+    # Three periods of 60 seconds.
+    rate = MessageRate(3, 10, period=60)
+    eq_((False, 4), rate.add_and_check(4, now=1000))
+    # Early flushes every 10 seconds stay within the window...
+    for i in range(1, 5):
+        eq_((False, 4 + i), rate.add_and_check(1, now=1000 + i * 10))
+    eq_((True, 10), rate.add_and_check(2, now=1060))
+    # ...and a flush 180 seconds later only counts itself.
+    eq_((False, 3), rate.add_and_check(3, now=1240))
+    eq_([3], rate.counts)
+    # Nor does the window stretch when flushes slow down.
+    eq_((False, 5), rate.add_and_check(5, now=1840))
+
+
 def test_is_just_monitoring_error():
     def check_is_just_monitoring_error(text, expected):
         "Verify the given message text is(n't) a monitoring error"
@@ -110,8 +392,8 @@ def test_calc_recips():
 
     def check_calc_recips(msg, expected):
         "Patch the server's matchers and verify the patterns work as expected"
-        with patch('failnozzle.server.RECIP_MATCHERS',
-                   new=list(server.RECIP_MATCHERS)) as matchers:
+        with patch('failnozzle.mail.RECIP_MATCHERS',
+                   new=list(mail.RECIP_MATCHERS)) as matchers:
             for i, matcher in enumerate(matchers):
                 if matcher[1].__name__ == 'is_just_monitoring_error':
                     matchers[i] = (monitoring_to, matcher[1])
@@ -165,6 +447,50 @@ def test_process_one_message():
                                                message['source'])
 
 
+def _traceback(lines, middle='frame'):
+    "Build a traceback of `lines` lines, with `middle` in its middle ones"
+    return '\n'.join(['Traceback (most recent call last):'] +
+                     ['  %s %d' % (middle, i) for i in range(lines - 2)] +
+                     ['RuntimeError: maximum recursion depth exceeded'])
+
+
+def test_truncate_exc_text():
+    # Short tracebacks are left alone.
+    eq_(_traceback(21), _truncate_exc_text(_traceback(21), 10, None))
+    eq_('x' * 200, _truncate_exc_text('x' * 200, None, 100))
+
+    # Long ones keep their first and last lines...
+    cut = _truncate_exc_text(_traceback(1000), 10, None)
+    lines = cut.splitlines()
+    eq_(21, len(lines))
+    eq_(_traceback(1000).splitlines()[:10], lines[:10])
+    eq_(_traceback(1000).splitlines()[-10:], lines[-10:])
+    ok_(lines[10].startswith('[... '), lines[10])
+    ok_(' characters elided, sha1 ' in lines[10], lines[10])
+    # ...and tracebacks that differ only in the middle stay different.
+    ok_(cut != _truncate_exc_text(_traceback(1000, 'other'), 10, None))
+    ok_(cut != _truncate_exc_text(_traceback(1001), 10, None))
+
+    # A giant line is cut too.
+    cut = _truncate_exc_text('a' * 100 + 'b' * 100000 + 'c' * 100, 10, 100)
+    ok_(cut.startswith('a' * 100 + '\n[... 100000 characters elided'), cut)
+    ok_(cut.endswith('...]\n' + 'c' * 100), cut)
+
+
+def test_process_one_truncates():
+    message_queue = Mock()
+    message_queue.get.return_value = {'message': 'message', 'kind': 'app',
+                                      'exc_text': _traceback(5000),
+                                      'source': 'host1'}
+    message_buffer = Mock()
+    with patch.multiple('failnozzle.settings', EXC_TEXT_KEEP_LINES=50,
+                        EXC_TEXT_KEEP_BYTES=None):
+        _process_one_message(message_queue, message_buffer,
+                             _build_config())
+    (unique, _), _ = message_buffer.add.call_args
+    eq_(101, len(unique.exc_text.splitlines()))
+
+
 def test_process_one_multiline():
     """
     Test we gracefully handle a message where the message file is split
@@ -247,7 +573,7 @@ def test_process_one_fill_exc():
                                                message['source'])
 
 
-@patch('failnozzle.server.send_email')
+@patch('failnozzle.mail.send_email')
 def test_mailer_no_recips(send_email_mock):
     """
     Make sure if we don't have anyone to send an email to we send it to a
@@ -263,6 +589,24 @@ def test_mailer_no_recips(send_email_mock):
                                             reply_to=setting('REPLY_TO', ''))
 
 
+@patch('smtplib.SMTP')
+@patch('smtplib.SMTP_SSL')
+@patch.multiple('failnozzle.settings',
+                SMTP_HOST='localhost', SMTP_PORT=2525, SMTP_USE_SSL=False,
+                SMTP_USER='', create=True)
+def test_send_email_plain(smtp_ssl, smtp):
+    """
+    Make sure we can talk to a plain SMTP server without logging in.
+    """
+    send_email('from@example.com', 'to@example.com', 'subject', 'body')
+
+    eq_(0, smtp_ssl.call_count)
+    smtp.assert_called_once_with('localhost', 2525)
+    eq_(0, smtp.return_value.login.call_count)
+    smtp.return_value.sendmail.assert_called_once_with(
+        'from@example.com', ['to@example.com'], ANY)
+
+
 @patch('gevent.joinall')
 @patch('gevent.spawn')
 def test_flusher_none(spawn, joinall):
@@ -320,7 +664,7 @@ def test_flusher_message(spawn, joinall):
 
 
 @patch.multiple('gevent', spawn=DEFAULT, joinall=DEFAULT)
-@patch.multiple('failnozzle.server', pager=DEFAULT, mailer=DEFAULT)
+@patch.multiple('failnozzle.flushing', pager=DEFAULT, mailer=DEFAULT)
 def test_flusher_rate_excede(spawn, joinall, pager, mailer):
     """
     Test that we complain extra loudly if we get too many errors.
@@ -346,9 +690,10 @@ def test_flusher_rate_excede(spawn, joinall, pager, mailer):
                            'source')
 
     flusher(message_buffer, message_rate)
-    eq_([call(pager, pager_limit + 1),
+    eq_([call(pager, [PageNotice('page', None, ANY)]),
          call(mailer, ANY, ANY, ANY)],
         spawn.call_args_list)
+    ok_('received 11 errors' in spawn.call_args_list[0][0][1][0].text)
 
     # We shouldn't have done anything
     eq_(2, spawn.call_count)
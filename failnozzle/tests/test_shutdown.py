@@ -0,0 +1,92 @@
+"""
+Tests for stopping cleanly
+"""
+
+import gevent
+import gevent.socket
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+
+from failnozzle.buffer import MessageBuffer
+from failnozzle.listener import Listener
+from failnozzle.pipeline import Pipeline, shutdown_pipelines
+from failnozzle.rates import MessageRate
+from failnozzle.scheduler import FlushScheduler
+from failnozzle.tests.helpers import packet, record
+
+
+SHUTDOWN_SETTINGS = dict(SHUTDOWN_DRAIN_SECONDS=5, SHUTDOWN_FLUSH_SECONDS=5,
+                         FLUSH_SECONDS=60, INCOMING_MESSAGE_MAX_SIZE=65536,
+                         SOURCE_FIELD_NAME='source')
+
+
+@patch.multiple('failnozzle.settings', create=True, **SHUTDOWN_SETTINGS)
+def test_shutdown_loses_nothing():
+    """
+    Make sure every packet received before a stop makes the final flush,
+    including those still in the socket and the queue.
+    """
+    sock = gevent.socket.socket(family=gevent.socket.AF_INET,
+                                type=gevent.socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    pipeline = Pipeline(None, {})
+    pipeline.start()
+    message_buffer = pipeline.message_buffer
+    message_buffer.render_pool = Mock()
+    listener = Listener(sock, pipeline.message_queue, message_buffer)
+    listener.start()
+
+    sender = gevent.socket.socket(family=gevent.socket.AF_INET,
+                                  type=gevent.socket.SOCK_DGRAM)
+    address = sock.getsockname()
+    # Some packets are read and processed...
+    for i in range(50):
+        sender.sendto(packet(i % 7, source='host%d' % (i % 3)), address)
+    gevent.sleep(0.1)
+    # ...some only queued...
+    for i in range(50, 100):
+        pipeline.message_queue.put(record(i % 7, source='host%d' % (i % 3)))
+    # ...and some still waiting in the socket.
+    for i in range(100, 150):
+        sender.sendto(packet(i % 7, source='host%d' % (i % 3)), address)
+
+    flushed = []
+
+    def fake_flusher(message_buffer, _message_rate):
+        "Record what would have been flushed"
+        flushed.append(message_buffer.total)
+        message_buffer.flush()
+
+    with patch('failnozzle.scheduler.flusher', fake_flusher):
+        ok_(shutdown_pipelines([listener], [pipeline]))
+    eq_([150], flushed)
+    ok_(listener.greenlet.dead)
+    ok_(pipeline.scheduler.greenlet.dead)
+    ok_(all(greenlet.dead for greenlet in pipeline.processors))
+    # The render pool's workers are stopped.
+    eq_(1, message_buffer.render_pool.close.call_count)
+    sender.close()
+
+
+@patch.multiple('failnozzle.settings', create=True, **SHUTDOWN_SETTINGS)
+def test_shutdown_waits_for_running_flush():
+    "The final flush waits for a running one to finish"
+    message_buffer = MessageBuffer(Mock(), Mock())
+    scheduler = FlushScheduler(message_buffer, MessageRate(5, 100))
+    order = []
+    scheduler.flusher_greenlet = gevent.spawn(
+        lambda: (gevent.sleep(0.05), order.append('running')))
+    with patch('failnozzle.scheduler.flusher',
+               lambda *args: order.append('final')):
+        ok_(scheduler.stop(5))
+    eq_(['running', 'final'], order)
+
+
+@patch.multiple('failnozzle.settings', create=True, **SHUTDOWN_SETTINGS)
+def test_shutdown_flush_timeout():
+    "Stopping gives up on a final flush that takes too long"
+    scheduler = FlushScheduler(MessageBuffer(Mock(), Mock()),
+                               MessageRate(5, 100))
+    with patch('failnozzle.scheduler.flusher',
+               lambda *args: gevent.sleep(10)):
+        ok_(not scheduler.stop(0.05))
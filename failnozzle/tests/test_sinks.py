@@ -0,0 +1,143 @@
+"""
+Tests for sending digests to files and webhooks
+"""
+import gzip
+import json
+import os
+
+import gevent
+import gevent.pywsgi
+import gevent.socket
+from mock import Mock, patch
+from nose.tools import eq_, ok_, with_setup
+
+from failnozzle.buffer import MessageBuffer
+from failnozzle.compat import BytesIO
+from failnozzle.fingerprint import fingerprint
+from failnozzle.flushing import flusher
+from failnozzle.rates import MessageRate
+from failnozzle.sinks import JsonFileSink, WebhookSink
+from failnozzle.tests.helpers import TEMP_DIRS, make_temp_dir, \
+    remove_temp_dirs, unique_message
+
+
+# The webhook's HTTP client only yields to other greenlets with the socket
+# module patched, as the daemon patches it at startup; the tests that need it
+# patch it for their duration only.
+cooperative_sockets = patch.multiple(
+    'socket', socket=gevent.socket.socket,
+    create_connection=gevent.socket.create_connection)
+
+
+class StandIn(object):
+    """
+    A local HTTP endpoint that records the digests POSTed to it, answering
+    with each of `statuses` in turn (then 200s) after `delay` seconds.
+    """
+    def __init__(self, statuses=(), delay=0):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.requests = []
+        self.server = gevent.pywsgi.WSGIServer(('127.0.0.1', 0), self.app,
+                                               log=None)
+        self.server.start()
+        self.url = 'http://127.0.0.1:%d/digests' % self.server.server_port
+
+    def app(self, environ, start_response):
+        "Record a request"
+        body = environ['wsgi.input'].read()
+        gevent.sleep(self.delay)
+        self.requests.append(dict(
+            path=environ['PATH_INFO'],
+            port=environ['REMOTE_PORT'],
+            encoding=environ.get('HTTP_CONTENT_ENCODING'),
+            digests=json.loads(gzip.GzipFile(
+                fileobj=BytesIO(body)).read())['digests']))
+        status = self.statuses.pop(0) if self.statuses else 200
+        start_response('%d Whatever' % status, [('Content-Length', '0')])
+        return [b'']
+
+
+@cooperative_sockets
+def test_webhook_batches_when_slow():
+    "Digests sent while a delivery runs go in the next batch"
+    stand_in = StandIn(delay=0.2)
+    sink = WebhookSink(stand_in.url)
+    try:
+        sink.send({'n': 1})
+        gevent.sleep(0.05)
+        # These pile up while the first is being delivered.
+        for i in range(2, 5):
+            sink.send({'n': i})
+        ok_(sink.close(5))
+    finally:
+        stand_in.server.stop()
+    eq_([[1], [2, 3, 4]], [[digest['n'] for digest in request['digests']]
+                           for request in stand_in.requests])
+    eq_(['gzip', 'gzip'], [request['encoding']
+                           for request in stand_in.requests])
+    eq_('/digests', stand_in.requests[0]['path'])
+    # Over one kept-alive connection.
+    eq_(1, len(set(request['port'] for request in stand_in.requests)))
+
+
+@cooperative_sockets
+def test_webhook_retries():
+    "Failed deliveries are retried, except for client errors"
+    stand_in = StandIn(statuses=[503, 500])
+    sink = WebhookSink(stand_in.url, retries=2, backoff=0.01)
+    try:
+        ok_(sink.deliver([{'n': 1}]))
+        # Client errors aren't retried, and retries run out.
+        stand_in.statuses = [400]
+        ok_(not sink.deliver([{'n': 2}]))
+        stand_in.statuses = [500, 500, 500]
+        ok_(not sink.deliver([{'n': 3}]))
+    finally:
+        sink.close(1)
+        stand_in.server.stop()
+    eq_([1, 1, 1, 2, 3, 3, 3], [request['digests'][0]['n']
+                                for request in stand_in.requests])
+
+
+@cooperative_sockets
+def test_webhook_unreachable():
+    "An unreachable webhook doesn't hold up stopping"
+    sink = WebhookSink('http://127.0.0.1:1/', retries=1, backoff=0.01)
+    ok_(not sink.deliver([{'n': 1}]))
+    # Still backing off when it's time to stop.
+    sink.backoff = 10
+    sink.send({'n': 2})
+    ok_(not sink.close(0.1))
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+@patch.multiple('failnozzle.settings', create=True, SERVER_NAME='test')
+@patch('failnozzle.flushing.mailer', Mock())
+def test_flusher_sends_to_sinks():
+    "Each flush sends its digest to the sinks"
+    path = os.path.join(TEMP_DIRS[-1], 'digests.jsonl')
+    message_buffer = MessageBuffer(Mock(), Mock())
+    message_buffer.sinks = [JsonFileSink(path)]
+    message = unique_message(1)
+    message_buffer.add(message, 'host1')
+    message_buffer.add(message, 'host2')
+    message_buffer.add(message, 'host2')
+    message_buffer.add_shed('app', 4)
+    flusher(message_buffer, MessageRate(5, 100))
+    # Nothing to report, so nothing sent.
+    flusher(message_buffer, MessageRate(5, 100))
+
+    with open(path) as handle:
+        documents = [json.loads(line) for line in handle]
+    eq_(1, len(documents))
+    document = documents[0]
+    eq_(('test', 3, 1, 4, {'app': 4}),
+        (document['server'], document['total'], document['total_unique'],
+         document['total_shed'], document['shed_by_kind']))
+    entry = document['messages'][0]
+    eq_(fingerprint(message), entry['fingerprint'])
+    eq_('exception text', entry['fields']['exc_text'])
+    eq_({'host1': 1, 'host2': 2}, entry['sources'])
+    eq_(3, entry['total'])
+    ok_(entry['first_seen'] <= entry['last_seen'])
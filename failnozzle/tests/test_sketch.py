@@ -0,0 +1,110 @@
+"""
+Tests for per-kind and per-source rate alerting
+"""
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+
+from failnozzle.buffer import MessageBuffer
+from failnozzle.flushing import PageNotice, flusher
+from failnozzle.rates import KindAlert, KindRate, MessageRate
+from failnozzle.sketch import CountMinSketch, HyperLogLog, WindowedSketch
+from failnozzle.tests.helpers import unique_message
+
+
+def test_count_min_sketch():
+    "Count-min estimates are never under and rarely much over"
+    sketch = CountMinSketch(256, 4)
+    for i in range(1000):
+        sketch.add(('source', 'host%d' % i), i % 10)
+    sketch.add('hot', 5000)
+    total = 5000 + sum(i % 10 for i in range(1000))
+    ok_(5000 <= sketch.estimate('hot') <= 5000 + 4 * total / 256)
+    for i in range(1000):
+        estimate = sketch.estimate(('source', 'host%d' % i))
+        # Never under, rarely much over.
+        ok_(estimate >= i % 10)
+        ok_(estimate <= i % 10 + 4 * total / 256)
+    sketch.clear()
+    eq_(0, sketch.estimate('hot'))
+
+
+def test_windowed_sketch():
+    "A windowed sketch counts only its last few periods"
+    sketch = WindowedSketch(3, 64, 2)
+    sketch.add('key', 1)
+    sketch.advance()
+    sketch.add('key', 2)
+    sketch.advance()
+    sketch.add('key', 4)
+    eq_(7, sketch.estimate('key'))
+    sketch.advance()
+    eq_(6, sketch.estimate('key'))
+
+
+def test_hyperloglog():
+    "HyperLogLog estimates distinct items closely"
+    for count in (0, 1, 30, 5000, 50000):
+        sketch = HyperLogLog(10)
+        for i in range(count):
+            sketch.add('host%d.example.com' % i)
+            # Repeats don't count.
+            sketch.add('host0.example.com')
+        # Within three standard errors.
+        ok_(abs(sketch.estimate() - count) <= 0.1 * count, count)
+
+
+def test_kind_rate():
+    "A kind over its limit alerts, with its busiest source"
+    kind_rate = KindRate(3, {'quiet': 10}, default_limit=100)
+    eq_([], kind_rate.add_and_check({('quiet', 'host1'): 4,
+                                     ('noisy', 'host1'): 60}))
+    alerts = kind_rate.add_and_check({('quiet', 'host1'): 2,
+                                      ('quiet', 'host2'): 5,
+                                      ('noisy', 'host2'): 70})
+    eq_([KindAlert('noisy', 130, 100, 'host2', 70),
+         KindAlert('quiet', 11, 10, 'host1', 6)], alerts)
+
+    # Counts slide out of the window.
+    eq_([], kind_rate.add_and_check({}))
+    eq_([], kind_rate.add_and_check({('quiet', 'host1'): 2}))
+
+    # Kinds without a limit never alert.
+    eq_(None, KindRate(3, {}).limit('any'))
+
+
+def test_kind_rate_seconds():
+    "The window covers the same seconds however often flushes happen"
+    kind_rate = KindRate(3, {'quiet': 10}, period=60)
+    # Early flushes share their period's slot, so none of them fall out.
+    for i in range(6):
+        eq_([], kind_rate.add_and_check({('quiet', 'host1'): 1},
+                                        now=6000 + i * 10))
+    alerts = kind_rate.add_and_check({('quiet', 'host1'): 4}, now=6070)
+    eq_([KindAlert('quiet', 10, 10, 'host1', 10)], alerts)
+    # A flush after a long interval starts a fresh window.
+    eq_([], kind_rate.add_and_check({('quiet', 'host1'): 1}, now=6600))
+    eq_(1, kind_rate.sketch.estimate(('kind', 'quiet')))
+
+
+@patch('failnozzle.flushing.pager')
+@patch.multiple('gevent', spawn=Mock(), joinall=Mock())
+@patch.multiple('failnozzle.settings', PAGER_KIND_LIMITS={'db': 3},
+                create=True)
+def test_flusher_pages_by_kind(pager):
+    "The flusher pages for a noisy kind on its own"
+    import gevent
+    message_rate = MessageRate(5, 10, KindRate(5, {'db': 3}))
+    message_buffer = MessageBuffer(Mock(), Mock())
+    for _ in range(20):
+        message_buffer.add(unique_message(1, 'db'), 'db1')
+    for i in range(5):
+        message_buffer.add(unique_message(i, 'web'), 'web%d' % i)
+    flusher(message_buffer, message_rate)
+
+    # The noisy 'db' kind pages on its own and doesn't trip the global limit.
+    eq_([5], message_rate.counts)
+    spawned = [call[0] for call in gevent.spawn.call_args_list]
+    eq_([(pager, [PageNotice('page', 'db', u'Danger: received 20 db errors '
+                             u'within the alert window (limit 3), 20 of them '
+                             u'from db1.')])],
+        [args for args in spawned if args[0] is pager])
@@ -0,0 +1,97 @@
+"""
+Tests for spooling packets when the processors fall behind
+"""
+import os
+
+import gevent
+import gevent.socket
+from mock import Mock, patch
+from nose.tools import eq_, ok_, with_setup
+
+from failnozzle.buffer import MessageBuffer
+from failnozzle.listener import Listener
+from failnozzle.processing import MessageQueue, processor
+from failnozzle.spool import Spool
+from failnozzle.tests.helpers import TEMP_DIRS, make_temp_dir, \
+    packet, remove_temp_dirs
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+def test_ring():
+    "The spool is a ring that refuses packets once full"
+    spool = Spool(os.path.join(TEMP_DIRS[-1], 'spool'), 100)
+    eq_(None, spool.pop())
+    # The header takes 40 bytes, leaving room for three 16 byte packets.
+    for i in range(3):
+        ok_(spool.append(b'packet %08d' % i))
+    ok_(not spool.append(b'packet 00000003'))
+    eq_(b'packet 00000000', spool.pop())
+
+    # The next one wraps around to the start of the ring.
+    ok_(spool.append(b'packet 00000003'))
+    ok_(not spool.append(b'x'))
+    eq_([b'packet %08d' % i for i in range(1, 4)],
+        [spool.pop() for _ in range(3)])
+    eq_(0, len(spool))
+    ok_(spool.append(b'a' * 56))
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+def test_replay_after_crash():
+    "Packets spooled before a crash are there after it"
+    path = os.path.join(TEMP_DIRS[-1], 'spool')
+    spool = Spool(path, 4096)
+    for i in range(10):
+        spool.append(b'packet %d' % i)
+    spool.pop()
+
+    # Not closed, as if the process had died.
+    spool = Spool(path, 8192)
+    eq_(9, len(spool))
+    eq_(4096, spool.size)
+    eq_([b'packet %d' % i for i in range(1, 10)],
+        [spool.pop() for _ in range(9)])
+
+    # An empty spool starts over at the new size.
+    spool.close()
+    eq_(8192, Spool(path, 8192).size)
+
+
+@with_setup(make_temp_dir, remove_temp_dirs)
+@patch.multiple('failnozzle.settings', create=True,
+                INCOMING_MESSAGE_MAX_SIZE=65536, SOURCE_FIELD_NAME='source')
+def test_listener_spools_burst():
+    """
+    Make sure a burst past the high-water mark is spooled undecoded, then
+    processed in order.
+    """
+    sock = gevent.socket.socket(family=gevent.socket.AF_INET,
+                                type=gevent.socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    message_buffer = MessageBuffer(Mock(), Mock())
+    message_queue = MessageQueue(message_buffer, maxsize=20)
+    spool = Spool(os.path.join(TEMP_DIRS[-1], 'spool'), 1024 * 1024)
+    listener = Listener(sock, message_queue, message_buffer, spool, 10)
+    listener.start()
+
+    sender = gevent.socket.socket(family=gevent.socket.AF_INET,
+                                  type=gevent.socket.SOCK_DGRAM)
+    for i in range(200):
+        sender.sendto(packet(i), sock.getsockname())
+    gevent.sleep(0.1)
+    # Nothing processed yet: ten queued, the rest spooled, none shed.
+    eq_(10, message_queue.qsize())
+    eq_(190, len(spool))
+    eq_(0, message_buffer.accounting.total_shed)
+
+    processed = []
+    message_buffer.add = Mock(side_effect=lambda unique, source:
+                              processed.append(unique.lineno))
+    worker = gevent.spawn(processor, message_queue, message_buffer)
+    gevent.sleep(0.5)
+    worker.kill()
+    listener.greenlet.kill()
+    eq_(0, listener.close_spool())
+    sock.close()
+    sender.close()
+    eq_(list(range(200)), processed)
@@ -0,0 +1,86 @@
+"""
+Tests for the UDP socket's kernel statistics
+"""
+import os
+import socket
+import tempfile
+
+from jinja2.environment import Environment
+from jinja2.loaders import FileSystemLoader
+from mock import Mock
+from nose.tools import eq_, ok_
+
+from failnozzle.buffer import MessageBuffer
+from failnozzle.flushing import _sample_drops
+from failnozzle.sharding import ShardedMessageBuffer
+from failnozzle.udpstats import DropCounter
+
+PROC_HEADER = ('   sl  local_address rem_address   st tx_queue rx_queue tr '
+               'tm->when retrnsmt   uid  timeout inode ref pointer drops\n')
+PROC_LINE = ('  %d: 0100007F:%04X 00000000:0000 07 00000000:00000000 '
+             '00:00000000 00000000     0        0 %s 2 0000000000000000 %d\n')
+
+
+def _write_proc(path, inode, drops):
+    "Write a fake /proc/net/udp with our socket and another one"
+    with open(path, 'w') as handle:
+        handle.write(PROC_HEADER)
+        handle.write(PROC_LINE % (0, 53, '1', 99))
+        handle.write(PROC_LINE % (1, 1549, inode, drops))
+
+
+def test_drop_counter():
+    "Drops are counted from the socket's line in /proc"
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    handle, path = tempfile.mkstemp(prefix='failnozzle-test-')
+    os.close(handle)
+    try:
+        _write_proc(path, inode, 5)
+        counter = DropCounter(sock, proc_paths=('/nonexistent', path))
+        eq_(5, counter.last)
+        eq_(0, counter.sample())
+        _write_proc(path, inode, 12)
+        eq_(7, counter.sample())
+        eq_(12, counter.last)
+
+        message_buffer = Mock()
+        _write_proc(path, inode, 15)
+        eq_(3, _sample_drops(counter, message_buffer))
+        message_buffer.add_dropped.assert_called_once_with(3)
+    finally:
+        os.remove(path)
+        sock.close()
+
+
+def test_drop_counter_unavailable():
+    "Without /proc, drops aren't counted"
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    counter = DropCounter(sock, proc_paths=('/nonexistent',))
+    eq_(None, counter.sample())
+    message_buffer = Mock()
+    eq_(None, _sample_drops(counter, message_buffer))
+    eq_(0, message_buffer.add_dropped.call_count)
+    sock.close()
+
+
+def test_flush_reports_drops():
+    "A digest reports the datagrams the kernel dropped"
+    template_dir = os.path.join(os.path.dirname(__file__), '..')
+    env = Environment(loader=FileSystemLoader(template_dir))
+    message_buffer = MessageBuffer(env.get_template('subject-template.txt'),
+                                   env.get_template('body-template.txt'))
+    message_buffer.add_dropped(40)
+    message_buffer.add_dropped(2)
+    _, report, _ = message_buffer.flush()
+    ok_('** 42 datagrams were dropped by the kernel' in report, report)
+    eq_(0, message_buffer.accounting.dropped)
+
+
+def test_sharded_drops():
+    "A sharded buffer keeps its drop count until it flushes"
+    message_buffer = ShardedMessageBuffer(Mock(), Mock(), 4)
+    message_buffer.add_dropped(3)
+    eq_(3, message_buffer.accounting.dropped)
+    message_buffer.flush()
+    eq_(0, message_buffer.accounting.dropped)
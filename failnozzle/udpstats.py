@@ -0,0 +1,75 @@
+"""
+Kernel-level statistics for failnozzle's UDP socket.
+
+When packets arrive faster than failnozzle reads them the kernel's receive
+buffer fills and further datagrams are dropped before failnozzle ever sees
+them. Linux counts those drops per socket in the last column of
+/proc/net/udp (and /proc/net/udp6), keyed by the socket's inode, which is
+what DropCounter samples. Elsewhere drops can't be measured, and sampling
+returns None.
+"""
+import logging
+import os
+import socket
+
+
+def set_receive_buffer(sock, size):
+    """
+    Asks the kernel for a receive buffer of `size` bytes on `sock` and returns
+    the size it actually granted. Linux doubles the request (for bookkeeping
+    overhead) and caps it at net.core.rmem_max unless running privileged.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    return receive_buffer(sock)
+
+
+def receive_buffer(sock):
+    """
+    Returns the size of `sock`'s receive buffer.
+    """
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+class DropCounter(object):
+    """
+    Samples the kernel's count of datagrams dropped on `sock`. The proc
+    files to read can be overridden for testing.
+    """
+    def __init__(self, sock, proc_paths=('/proc/net/udp', '/proc/net/udp6')):
+        self.inode = str(os.fstat(sock.fileno()).st_ino)
+        self.proc_paths = proc_paths
+        self.last = self.read()
+        if self.last is None:
+            logging.info('UDP drop counts are not available on this system')
+
+    def read(self):
+        """
+        Returns the total drops on the socket since it was created, or None
+        if they can't be read.
+        """
+        for path in self.proc_paths:
+            try:
+                with open(path) as handle:
+                    lines = handle.readlines()
+            except IOError:
+                continue
+            for line in lines[1:]:
+                fields = line.split()
+                # sl local rem st queues tr retrnsmt uid timeout inode ref
+                # pointer drops
+                if len(fields) >= 13 and fields[9] == self.inode:
+                    return int(fields[12])
+        return None
+
+    def sample(self):
+        """
+        Returns the number of datagrams dropped since the previous sample, or
+        None if drops can't be read.
+        """
+        current = self.read()
+        if current is None or self.last is None:
+            self.last = current
+            return None
+        dropped = max(0, current - self.last)
+        self.last = current
+        return dropped